@@ -14,6 +14,7 @@ logger = logging.getLogger('zentral.core.stores.backends.datadog')
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 100
     machine_events = True
     machine_events_url = True
     probe_events = True
@@ -134,15 +135,23 @@ class EventStore(BaseEventStore):
         event_d["_zentral"] = metadata
         return event_from_event_d(event_d)
 
-    def store(self, event):
-        ddevent = self._serialize_event(event)
-        r = self._session.post(
+    def _post_ddevents(self, ddevents):
+        return self._session.post(
             self.input_url,
-            data=zlib.compress(json.dumps([ddevent]).encode("utf-8")),
+            data=zlib.compress(json.dumps(ddevents).encode("utf-8")),
             headers={"Content-Encoding": "deflate"}
         )
+
+    def store(self, event):
+        r = self._post_ddevents([self._serialize_event(event)])
         r.raise_for_status()
 
+    def bulk_store(self, events):
+        event_keys, ddevents = self.prepare_event_batch(events, self._serialize_event)
+        if ddevents:
+            self.send_with_retries(lambda: self._post_ddevents(ddevents), "bulk store request")
+        return event_keys
+
     @staticmethod
     def _prepare_datetime(dt, tick=1):
         return str(int(time.mktime(dt.timetuple())) * tick)
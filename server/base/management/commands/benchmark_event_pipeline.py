@@ -0,0 +1,344 @@
+from datetime import datetime
+import json
+import random
+import socket
+import time
+import tracemalloc
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection as db_connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from kombu import Connection, Queue
+from zentral.core.events import event_cls_from_type, event_from_event_d
+from zentral.core.events.base import EventMetadata, EventRequest
+from zentral.core.events.pipeline import city_db_reader, enrich_event, get_city, process_event
+from zentral.core.probes.conf import all_probes_event_index
+from zentral.core.queues.backends.kombu import (EnrichWorker, PreprocessWorker, ProcessWorker, StoreWorker,
+                                                enrich_events_queue, process_events_queue, raw_events_exchange)
+from zentral.core.stores.backends.base import BaseEventStore
+
+
+# synthetic events
+
+
+def random_hex(length):
+    return get_random_string(length, "0123456789abcdef")
+
+
+def build_santa_event(serial_number):
+    team_id = get_random_string(10, "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
+    name = get_random_string(8)
+    return "santa_event", {
+        "decision": random.choice(("ALLOW_BINARY", "ALLOW_CERTIFICATE", "ALLOW_UNKNOWN", "BLOCK_BINARY")),
+        "file_name": name,
+        "file_path": f"/Applications/{name}.app/Contents/MacOS",
+        "file_sha256": random_hex(64),
+        "cdhash": random_hex(40),
+        "executing_user": "root",
+        "execution_time": time.time(),
+        "pid": random.randint(100, 99999),
+        "ppid": 1,
+        "team_id": team_id,
+        "signing_id": f"{team_id}:com.example.{name}",
+        "signing_chain": [
+            {"cn": f"Developer ID Application: {name} ({team_id})",
+             "org": name,
+             "ou": team_id,
+             "sha256": random_hex(64),
+             "valid_from": 1500000000,
+             "valid_until": 2000000000},
+            {"cn": "Developer ID Certification Authority",
+             "org": "Apple Inc.",
+             "ou": "Apple Certification Authority",
+             "sha256": random_hex(64),
+             "valid_from": 1328134536,
+             "valid_until": 1801519736},
+        ],
+    }
+
+
+def build_osquery_event(serial_number):
+    return "osquery_result", {
+        "name": "pack/benchmark/1/running_apps/1/1",
+        "action": random.choice(("added", "removed")),
+        "hostIdentifier": serial_number,
+        "unixTime": int(time.time()),
+        "columns": {"bundle_identifier": f"com.example.{get_random_string(8)}",
+                    "is_active": random.choice(("0", "1")),
+                    "pid": str(random.randint(100, 99999))},
+    }
+
+
+def build_mdm_event(serial_number):
+    return "mdm_request", {
+        "status": "success",
+        "udid": str(uuid.uuid4()).upper(),
+        "channel": "device",
+        "command": {"request_type": random.choice(("DeviceInformation", "InstalledApplicationList",
+                                                   "ProfileList", "SecurityInfo")),
+                    "uuid": str(uuid.uuid4())},
+    }
+
+
+def build_inventory_event(serial_number):
+    name = get_random_string(8)
+    return "add_machine_osx_app_instance", {
+        "app": {"bundle_id": f"com.example.{name}",
+                "bundle_name": name,
+                "bundle_version": "1.0",
+                "bundle_version_str": "1.0"},
+        "bundle_path": f"/Applications/{name}.app",
+    }
+
+
+EVENT_BUILDERS = {
+    "inventory": build_inventory_event,
+    "mdm": build_mdm_event,
+    "osquery": build_osquery_event,
+    "santa": build_santa_event,
+}
+
+
+# pipeline stand-ins
+
+
+class BenchmarkPreprocessor:
+    routing_key = "zentral_benchmark"
+
+    def process_raw_event(self, raw_event):
+        yield event_from_event_d(raw_event)
+
+
+def benchmark_enrich_event(event):
+    """enrich_event stand-in, the probes are matched but the incident updates are not applied"""
+    if isinstance(event, dict):
+        event = event_from_event_d(event)
+    if event.metadata.request and event.metadata.request.ip and not event.metadata.request.geo and city_db_reader:
+        city = get_city(event.metadata.request.ip)
+        if city:
+            event.metadata.request.set_geo_from_city(city)
+    for probe in all_probes_event_index.iter_matching_probes(event):
+        event.metadata.add_probe(probe)
+    yield event
+
+
+def benchmark_process_event(event):
+    """process_event stand-in, the probes are matched but their actions are not triggered"""
+    if isinstance(event, dict):
+        event = event_from_event_d(event)
+    for probe in event.metadata.iter_loaded_probes():
+        pass
+
+
+class BenchmarkEventStore(BaseEventStore):
+    def store(self, event):
+        if not isinstance(event, dict):
+            event = event.serialize()
+        json.dumps(event)
+
+
+# measures
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.message_count = 0
+        self.duration = 0
+        self.latencies = []
+        self.query_count = 0
+        self.peak_memory = None
+
+    def wrap_callback(self, callback):
+        def wrapped_callback(body, message):
+            start = time.perf_counter()
+            callback(body, message)
+            self.latencies.append(time.perf_counter() - start)
+        return wrapped_callback
+
+    def wrap_process_batch(self, process_batch):
+        def wrapped_process_batch(batch):
+            start = time.perf_counter()
+            process_batch(batch)
+            latency = (time.perf_counter() - start) / len(batch)
+            self.latencies.extend(latency for _ in batch)
+        return wrapped_process_batch
+
+    def serialize(self):
+        d = {"stage": self.name,
+             "messages": self.message_count,
+             "duration": self.duration,
+             "events_per_second": None,
+             "p50_latency_ms": None,
+             "p99_latency_ms": None,
+             "queries_per_event": None,
+             "peak_memory_kib": None}
+        if self.message_count:
+            d["queries_per_event"] = self.query_count / self.message_count
+            if self.duration:
+                d["events_per_second"] = self.message_count / self.duration
+        for p in (50, 99):
+            latency = percentile(self.latencies, p)
+            if latency is not None:
+                d[f"p{p}_latency_ms"] = 1000 * latency
+        if self.peak_memory is not None:
+            d["peak_memory_kib"] = self.peak_memory / 1024
+        return d
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the events pipeline. Synthetic events go through the preprocess, enrich, "
+            "process and store workers, over an in-memory kombu transport.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=1000, help="number of events, 1000 by default")
+        parser.add_argument("--machines", type=int, default=100, help="number of machines, 100 by default")
+        parser.add_argument("--kind", action="append", choices=sorted(EVENT_BUILDERS.keys()),
+                            help="kind of events to generate, all by default. Can be repeated.")
+        parser.add_argument("--batch-size", type=int, default=1,
+                            help="enrich & process workers batch size, 1 by default")
+        parser.add_argument("--with-probes", action="store_true",
+                            help="apply the incident updates and trigger the actions of the matching probes")
+        parser.add_argument("--trace-memory", action="store_true",
+                            help="trace the memory allocations (slower)")
+        parser.add_argument("--json", action="store_true", help="JSON output")
+
+    # events
+
+    def iter_raw_events(self, count, machine_count, kinds):
+        serial_numbers = [get_random_string(10, "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
+                          for _ in range(max(1, machine_count))]
+        builders = [EVENT_BUILDERS[kind] for kind in kinds]
+        for i in range(count):
+            serial_number = random.choice(serial_numbers)
+            event_type, payload = builders[i % len(builders)](serial_number)
+            metadata = EventMetadata(
+                machine_serial_number=serial_number,
+                request=EventRequest(user_agent="zentral/benchmark", ip="192.0.2.{}".format(i % 254 + 1)),
+                created_at=datetime.utcnow(),
+            )
+            yield event_cls_from_type(event_type)(metadata, payload).serialize(machine_metadata=False)
+
+    # stages
+
+    @staticmethod
+    def get_message_count(connection, queue):
+        return queue(connection.default_channel).queue_declare(passive=True).message_count
+
+    def run_stage(self, stats, worker, connection, queue):
+        stats.message_count = self.get_message_count(connection, queue)
+        worker.metrics_exporter = None
+        if self.trace_memory:
+            tracemalloc.start()
+        with CaptureQueriesContext(db_connection) as queries:
+            start = time.perf_counter()
+            try:
+                for _ in worker.consume(limit=stats.message_count, timeout=5):
+                    pass
+            except socket.timeout:
+                self.stderr.write(f"{stats.name}: timeout")
+            stats.duration = time.perf_counter() - start
+        stats.query_count = len(queries.captured_queries)
+        if self.trace_memory:
+            _, stats.peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    def run_pipeline(self, options):
+        connection = Connection("memory://")
+        channel = connection.default_channel
+        preprocessor = BenchmarkPreprocessor()
+        preprocess_queue = Queue(preprocessor.routing_key, exchange=raw_events_exchange,
+                                 routing_key=preprocessor.routing_key, durable=True)
+        store = BenchmarkEventStore({"store_name": "benchmark"})
+        store_worker = StoreWorker(connection.clone(), store)
+        # the fanout exchanges only deliver to the declared queues
+        for queue in (preprocess_queue, enrich_events_queue, process_events_queue, store_worker.input_queue):
+            queue(channel).declare()
+            queue(channel).purge()
+
+        # raw events
+        producer = connection.Producer()
+        for raw_event in self.iter_raw_events(options["events"], options["machines"],
+                                              options["kind"] or sorted(EVENT_BUILDERS.keys())):
+            producer.publish(raw_event,
+                             serializer="json",
+                             exchange=raw_events_exchange,
+                             routing_key=preprocessor.routing_key,
+                             declare=[raw_events_exchange])
+
+        batch_kwargs = {"batch_size": options["batch_size"]}
+        all_stats = []
+
+        # preprocess
+        stats = StageStats("preprocess")
+        worker = PreprocessWorker(connection.clone())
+        worker.preprocessors = {preprocessor.routing_key: preprocessor}
+        worker.do_preprocess_raw_event = stats.wrap_callback(worker.do_preprocess_raw_event)
+        self.run_stage(stats, worker, connection, preprocess_queue)
+        all_stats.append(stats)
+
+        # enrich
+        stats = StageStats("enrich")
+        worker = EnrichWorker(connection.clone(),
+                              enrich_event if options["with_probes"] else benchmark_enrich_event,
+                              **batch_kwargs)
+        worker.do_enrich_event = stats.wrap_callback(worker.do_enrich_event)
+        worker.process_batch = stats.wrap_process_batch(worker.process_batch)
+        self.run_stage(stats, worker, connection, enrich_events_queue)
+        all_stats.append(stats)
+
+        # process
+        stats = StageStats("process")
+        worker = ProcessWorker(connection.clone(),
+                               process_event if options["with_probes"] else benchmark_process_event,
+                               **batch_kwargs)
+        worker.do_process_event = stats.wrap_callback(worker.do_process_event)
+        worker.process_batch = stats.wrap_process_batch(worker.process_batch)
+        self.run_stage(stats, worker, connection, process_events_queue)
+        all_stats.append(stats)
+
+        # store
+        stats = StageStats("store")
+        store_worker.do_store_event = stats.wrap_callback(store_worker.do_store_event)
+        self.run_stage(stats, store_worker, connection, store_worker.input_queue)
+        all_stats.append(stats)
+
+        connection.release()
+        return [stats.serialize() for stats in all_stats]
+
+    # output
+
+    def write_table(self, results):
+        columns = (("stage", "Stage", "{}"),
+                   ("messages", "Messages", "{}"),
+                   ("events_per_second", "Events/s", "{:.1f}"),
+                   ("p50_latency_ms", "p50 (ms)", "{:.3f}"),
+                   ("p99_latency_ms", "p99 (ms)", "{:.3f}"),
+                   ("queries_per_event", "Queries/event", "{:.2f}"),
+                   ("peak_memory_kib", "Peak mem. (KiB)", "{:.1f}"))
+        rows = [[header for _, header, _ in columns]]
+        for result in results:
+            rows.append(["-" if result[key] is None else fmt.format(result[key]) for key, _, fmt in columns])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+        for row in rows:
+            self.stdout.write("  ".join(val.rjust(width) for val, width in zip(row, widths)))
+
+    def handle(self, *args, **options):
+        self.trace_memory = options["trace_memory"]
+        if options["with_probes"]:
+            self.stderr.write(self.style.WARNING(
+                "The incident updates and actions of the probes matching the synthetic events will be applied!"
+            ))
+        results = self.run_pipeline(options)
+        if options["json"]:
+            self.stdout.write(json.dumps({"stages": results}, indent=2))
+        else:
+            self.write_table(results)
@@ -0,0 +1,47 @@
+from unittest.mock import patch
+from django.test import SimpleTestCase
+from django.utils.crypto import get_random_string
+from zentral.core.events.base import BaseEvent, register_event_type
+
+
+class TestEvent4(BaseEvent):
+    event_type = "event_type_4"
+
+
+register_event_type(TestEvent4)
+
+
+class EventPostTestCase(SimpleTestCase):
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_post_one_machine_request_payload(self, post_event, post_events):
+        msn = get_random_string(12)
+        TestEvent4.post_machine_request_payloads(msn, "godzilla", "1.2.3.4", [{"yolo": 1}])
+        post_events.assert_not_called()
+        post_event.assert_called_once()
+        event = post_event.call_args.args[0]
+        self.assertIsInstance(event, TestEvent4)
+        self.assertEqual(event.metadata.machine_serial_number, msn)
+        self.assertEqual(event.payload, {"yolo": 1})
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_post_machine_request_payloads_in_bulk(self, post_event, post_events):
+        msn = get_random_string(12)
+        TestEvent4.post_machine_request_payloads(msn, "godzilla", "1.2.3.4", [{"yolo": i} for i in range(3)])
+        post_event.assert_not_called()
+        post_events.assert_called_once()
+        events = post_events.call_args.args[0]
+        self.assertEqual(len(events), 3)
+        for index, event in enumerate(events):
+            self.assertIsInstance(event, TestEvent4)
+            self.assertEqual(event.metadata.machine_serial_number, msn)
+            self.assertEqual(event.metadata.index, index)
+            self.assertEqual(event.payload, {"yolo": index})
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_post_no_machine_request_payloads(self, post_event, post_events):
+        TestEvent4.post_machine_request_payloads(get_random_string(12), "godzilla", "1.2.3.4", [])
+        post_event.assert_not_called()
+        post_events.assert_not_called()
@@ -3,7 +3,7 @@ from zentral.contrib.inventory.models import MetaBusinessUnit, Tag
 from zentral.core.events import event_types
 from zentral.core.events.base import BaseEvent, EventMetadata
 from zentral.core.incidents.models import Severity
-from zentral.core.probes.base import BaseProbe, get_flattened_payload_values
+from zentral.core.probes.base import BaseProbe, PayloadPaths, get_flattened_payload_values
 from zentral.core.probes.models import ProbeSource
 from tests.inventory.utils import MockMetaMachine
 
@@ -317,6 +317,30 @@ class PayloadFilterBaseProbeTestCase(TestCase):
                                        ({"a": [{"b": [2, 3, 3]}]}, ["a", "b"], {"2", "3"})):
             self.assertEqual(set(get_flattened_payload_values(payload, attrs)), result)
 
+    def test_payload_paths_extract(self):
+        payload_paths = PayloadPaths([("a",), ("a", "b"), ("a", "c"), ("d",)])
+        self.assertEqual(
+            payload_paths.extract({"a": [{"b": [2, 3, 3]}, {"b": 4, "c": True}], "d": None}),
+            {("a",): {"{'b': [2, 3, 3]}", "{'b': 4, 'c': True}"},
+             ("a", "b"): {"2", "3", "4"},
+             ("a", "c"): {"True"},
+             ("d",): set()}
+        )
+
+    def test_payload_paths_same_values(self):
+        payload_paths = PayloadPaths(path for payload_filter in self.probe.payload_filters
+                                     for path in payload_filter.iter_payload_paths())
+        for payload in ({},
+                        {"yo": "yoval1", "yo2": ["yo2val"]},
+                        {"a": [{"b": [{"d": "u"}, {"c": "abc", "d": "d"}]}]},
+                        {"a": 1, "ewuew": "z99", "yo_int": 42, "yo_bool": True}):
+            payload_values = payload_paths.extract(payload)
+            for path in payload_paths.paths:
+                self.assertEqual(payload_values[path], set(get_flattened_payload_values(payload, list(path))))
+            for payload_filter in self.probe.payload_filters:
+                self.assertEqual(payload_filter.test_event_payload(payload, payload_values),
+                                 payload_filter.test_event_payload(payload))
+
     def test_dotted_payload_attribute(self):
         payload_filter = self.probe.payload_filters[2]
         for payload, result in (({"a": 1}, False),
@@ -1,6 +1,7 @@
 from django.test import TestCase
 from django.utils.crypto import get_random_string
-from zentral.core.probes.conf import all_probes, all_probes_dict
+from zentral.core.events import event_from_event_d
+from zentral.core.probes.conf import all_probes, all_probes_dict, all_probes_event_index
 from zentral.core.probes.models import ProbeSource
 
 
@@ -27,3 +28,73 @@ class ProbesConfTestCase(TestCase):
         self.assertEqual(all_probes_dict[self.probe.pk], self.probe)
         with self.assertRaises(KeyError):
             all_probes_dict[self.inactive_probe.pk]
+
+    def _create_probe(self, body):
+        return ProbeSource.objects.create(model="BaseProbe",
+                                          name=get_random_string(12),
+                                          status=ProbeSource.ACTIVE,
+                                          body=body).load()
+
+    @staticmethod
+    def _pks(probes):
+        return sorted(probe.pk for probe in probes)
+
+    @staticmethod
+    def _build_event(event_type, tags=None, routing_key=None):
+        metadata = {'created_at': '2021-02-18T20:55:00',
+                    'id': 'ff4db218-d5b4-4c2c-b40b-1b7fdee00dfc',
+                    'index': 0,
+                    'type': event_type}
+        if tags:
+            metadata["tags"] = tags
+        if routing_key:
+            metadata["routing_key"] = routing_key
+        return event_from_event_d({"_zentral": metadata, "yolo": "fomo"})
+
+    def test_all_probes_event_index(self):
+        event_type_probe = self._create_probe({"filters": {"metadata": [{"event_types": ["zentral_login"]}]}})
+        tag_probe = self._create_probe({"filters": {"metadata": [{"event_tags": ["fomo"]}]}})
+        routing_key_probe = self._create_probe({"filters": {"metadata": [{"event_routing_keys": ["yolo"]}]}})
+        payload_probe = self._create_probe(
+            {"filters": {"metadata": [{"event_types": ["zentral_login"]}],
+                         "payload": [[{"attribute": "yolo", "operator": "IN", "values": ["fomo"]}]]}}
+        )
+        all_probes.clear()
+        # login event
+        event = self._build_event("zentral_login", tags=["fomo"])
+        self.assertEqual(self._pks(all_probes_event_index.iter_candidate_probes(event)),
+                         self._pks([self.probe, event_type_probe, tag_probe, payload_probe]))
+        self.assertEqual(self._pks(all_probes_event_index.iter_matching_probes(event)),
+                         self._pks([self.probe, event_type_probe, tag_probe, payload_probe]))
+        # routing key event
+        event = self._build_event("zentral_logout", routing_key="yolo")
+        self.assertEqual(self._pks(all_probes_event_index.iter_candidate_probes(event)),
+                         self._pks([self.probe, routing_key_probe]))
+        # other event
+        event = self._build_event("zentral_logout")
+        self.assertEqual(self._pks(all_probes_event_index.iter_matching_probes(event)),
+                         self._pks([self.probe]))
+
+    def test_all_probes_event_index_same_results(self):
+        self._create_probe({"filters": {"metadata": [{"event_types": ["zentral_login"], "event_tags": ["not_a_match"]},
+                                                     {"event_tags": ["zentral"]}]}})
+        self._create_probe({"filters": {"metadata": [{"event_types": ["zentral_logout"]}]}})
+        all_probes.clear()
+        for event in (self._build_event("zentral_login", tags=["zentral"]),
+                      self._build_event("zentral_login"),
+                      self._build_event("zentral_logout", routing_key="yolo")):
+            # same probes, same order
+            self.assertEqual(list(all_probes_event_index.iter_matching_probes(event)),
+                             list(all_probes.event_filtered(event)))
+
+    def test_all_probes_event_index_cleared(self):
+        all_probes.clear()
+        event = self._build_event("zentral_login")
+        self.assertEqual(self._pks(all_probes_event_index.iter_matching_probes(event)),
+                         self._pks([self.probe]))
+        event_type_probe = self._create_probe({"filters": {"metadata": [{"event_types": ["zentral_login"]}]}})
+        self.assertEqual(self._pks(all_probes_event_index.iter_matching_probes(event)),
+                         self._pks([self.probe]))
+        all_probes.clear()
+        self.assertEqual(self._pks(all_probes_event_index.iter_matching_probes(event)),
+                         self._pks([self.probe, event_type_probe]))
@@ -1,6 +1,10 @@
+import queue
+import threading
+from unittest.mock import patch
 from django.test import SimpleTestCase
 from django.utils.crypto import get_random_string
 from zentral.core.queues.backends.aws_sns_sqs import build_sns_filter_policy_for_event_store
+from zentral.core.queues.backends.aws_sns_sqs.sqs import SQSSendThread
 from zentral.core.stores.backends.base import BaseEventStore
 
 
@@ -64,3 +68,27 @@ class SNSFilterPolicyTestCase(SimpleTestCase):
             build_sns_filter_policy_for_event_store(store),
             {"zentral.tags": [{"anything-but": ["fomo", "jomo", "yolo"]}]}
         )
+
+
+class SQSSendThreadTestCase(SimpleTestCase):
+    @patch("zentral.core.queues.backends.aws_sns_sqs.sqs.boto3.client")
+    def test_send_entries_max_batch_payload_bytes(self, boto3_client):
+        client = boto3_client.return_value
+        client.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+            "Successful": [{"Id": e["Id"]} for e in Entries]
+        }
+        stop_event = threading.Event()
+        in_queue = queue.Queue()
+        out_queue = queue.Queue()
+        thread = SQSSendThread("https://sqs.example.com/queue", stop_event, in_queue, out_queue)
+        for i in range(3):
+            in_queue.put((f"receipt_handle_{i}", "yolo", {"data": get_random_string(100 * 1024)}, 0))
+        stop_event.set()
+        thread.run()
+        # 3 entries of ~100KiB → 2 batches, below the SQS batch payload size limit
+        self.assertEqual([len(c.kwargs["Entries"]) for c in client.send_message_batch.call_args_list], [2, 1])
+        for call_args in client.send_message_batch.call_args_list:
+            self.assertLessEqual(sum(thread.get_entry_payload_bytes(e) for e in call_args.kwargs["Entries"]),
+                                 thread.max_batch_payload_bytes)
+        self.assertEqual(sorted(out_queue.get_nowait() for _ in range(3)),
+                         [f"receipt_handle_{i}" for i in range(3)])
@@ -0,0 +1,142 @@
+from django.test import SimpleTestCase
+from django.utils.crypto import get_random_string
+from kombu import Connection
+from zentral.core.queues.backends.kombu import (EnrichWorker, EventQueues, ProcessWorker,
+                                                enrich_events_queue, events_exchange,
+                                                enriched_events_exchange, process_events_queue)
+
+
+class FakeEvent:
+    event_type = "fake_event"
+
+    def __init__(self, body):
+        self.body = body
+
+    def serialize(self, machine_metadata):
+        return self.body
+
+
+class KombuBatchWorkersTestCase(SimpleTestCase):
+    def setUp(self):
+        # the memory transport state is shared between the connections
+        self.connection = Connection("memory://")
+        channel = self.connection.default_channel
+        for queue in (enrich_events_queue, process_events_queue):
+            queue(channel).declare()
+            queue(channel).purge()
+
+    def tearDown(self):
+        self.connection.release()
+
+    def publish(self, exchange, count):
+        bodies = []
+        producer = self.connection.Producer()
+        for i in range(count):
+            body = {"_zentral": {"type": "fake_event", "id": get_random_string(12), "index": i}}
+            producer.publish(body, serializer="json", exchange=exchange, declare=[exchange])
+            bodies.append(body)
+        return bodies
+
+    def get_queue_bodies(self, queue):
+        bodies = []
+        bound_queue = queue(self.connection.default_channel)
+        while True:
+            message = bound_queue.get(no_ack=True)
+            if message is None:
+                break
+            bodies.append(message.payload)
+        return bodies
+
+    def run_worker(self, worker, message_count):
+        worker.metrics_exporter = None
+        for _ in worker.consume(limit=message_count, timeout=1):
+            pass
+
+    def test_event_queues_worker_batch_settings(self):
+        event_queues = EventQueues({"backend_url": "memory://",
+                                    "enrich_worker": {"batch_size": 17, "flush_interval": 3}})
+        enrich_worker = event_queues.get_enrich_worker(lambda e: [e])
+        self.assertEqual(enrich_worker.batch_size, 17)
+        self.assertEqual(enrich_worker.flush_interval, 3)
+        process_worker = event_queues.get_process_worker(lambda e: None)
+        self.assertEqual(process_worker.batch_size, 1)
+        self.assertEqual(process_worker.flush_interval, 1)
+
+    def test_enrich_worker_batches(self):
+        bodies = self.publish(events_exchange, 5)
+        enrich_batch_sizes = []
+        worker = EnrichWorker(self.connection.clone(), lambda body: [FakeEvent(body)],
+                              batch_size=3, flush_interval=60)
+        original_process_batch = worker.process_batch
+
+        def process_batch(batch):
+            enrich_batch_sizes.append(len(batch))
+            return original_process_batch(batch)
+
+        worker.process_batch = process_batch
+        self.run_worker(worker, 5)
+        # one full batch, the rest is flushed when the consumer exits
+        self.assertEqual(enrich_batch_sizes, [3, 2])
+        self.assertEqual(self.get_queue_bodies(process_events_queue), bodies)
+        self.assertEqual(self.get_queue_bodies(enrich_events_queue), [])
+
+    def test_enrich_worker_batch_requeue(self):
+        bodies = self.publish(events_exchange, 3)
+        failing_id = bodies[1]["_zentral"]["id"]
+
+        def enrich_event(body):
+            if body["_zentral"]["id"] == failing_id:
+                raise ValueError("YOLO")
+            return [FakeEvent(body)]
+
+        worker = EnrichWorker(self.connection.clone(), enrich_event, batch_size=3, flush_interval=60)
+        with self.assertLogs("zentral.core.queues.backends.kombu", level="ERROR"):
+            self.run_worker(worker, 3)
+        self.assertEqual(self.get_queue_bodies(process_events_queue), [bodies[0], bodies[2]])
+        self.assertEqual(self.get_queue_bodies(enrich_events_queue), [bodies[1]])
+
+    def test_process_worker_batches(self):
+        bodies = self.publish(enriched_events_exchange, 4)
+        processed_bodies = []
+        worker = ProcessWorker(self.connection.clone(), processed_bodies.append,
+                               batch_size=10, flush_interval=60)
+        self.run_worker(worker, 4)
+        self.assertEqual(processed_bodies, bodies)
+        self.assertEqual(self.get_queue_bodies(process_events_queue), [])
+
+    def test_process_worker_batch_reject(self):
+        bodies = self.publish(enriched_events_exchange, 3)
+        failing_id = bodies[1]["_zentral"]["id"]
+        processed_bodies = []
+
+        def process_event(body):
+            if body["_zentral"]["id"] == failing_id:
+                raise ValueError("YOLO")
+            processed_bodies.append(body)
+
+        worker = ProcessWorker(self.connection.clone(), process_event, batch_size=3, flush_interval=60)
+        processed_events = []
+        worker.inc_counter = lambda name, label: processed_events.append((name, label))
+        with self.assertLogs("zentral.core.queues.backends.kombu", level="ERROR"):
+            self.run_worker(worker, 3)
+        self.assertEqual(processed_bodies, [bodies[0], bodies[2]])
+        self.assertEqual(processed_events, 2 * [("processed_events", "fake_event")])
+        # nothing redelivered
+        self.assertEqual(self.get_queue_bodies(process_events_queue), [])
+
+    def test_process_worker_no_batch(self):
+        bodies = self.publish(enriched_events_exchange, 2)
+        processed_bodies = []
+        worker = ProcessWorker(self.connection.clone(), processed_bodies.append)
+        self.assertEqual(worker.batch_size, 1)
+        self.run_worker(worker, 2)
+        self.assertEqual(processed_bodies, bodies)
+        self.assertEqual(worker.batch, [])
+
+    def test_event_queues_post_events(self):
+        event_queues = EventQueues({"backend_url": "memory://"})
+        event_queues.connection = self.connection.clone()
+        bodies = [{"_zentral": {"type": "fake_event", "id": get_random_string(12), "index": i}}
+                  for i in range(3)]
+        event_queues.post_events(FakeEvent(body) for body in bodies)
+        self.assertEqual(self.get_queue_bodies(enrich_events_queue), bodies)
@@ -1,7 +1,13 @@
+import base64
 from datetime import datetime
+import json
+from unittest.mock import Mock
 from dateutil import parser
 from django.test import SimpleTestCase
-from zentral.core.stores.backends.azure_log_analytics import datetime_to_iso8601z_truncated_to_milliseconds
+from django.utils.crypto import get_random_string
+from accounts.events import EventMetadata, LoginEvent
+from zentral.core.stores.backends.azure_log_analytics import (datetime_to_iso8601z_truncated_to_milliseconds,
+                                                              EventStore)
 
 
 class TestDateTimeConverstion(SimpleTestCase):
@@ -32,3 +38,41 @@ class TestDateTimeConverstion(SimpleTestCase):
             datetime_to_iso8601z_truncated_to_milliseconds(datetime(2019, 1, 1, 0, 0, 0).replace(tzinfo=None)),
             "2019-01-01T00:00:00Z"
         )
+
+
+class AzureLogAnalyticsStoreTestCase(SimpleTestCase):
+    def get_store(self, **kwargs):
+        kwargs.setdefault("store_name", get_random_string(12))
+        kwargs.setdefault("customer_id", get_random_string(12))
+        kwargs.setdefault("shared_key", base64.b64encode(b"yolo").decode("ascii"))
+        return EventStore(kwargs)
+
+    def build_login_event(self):
+        return LoginEvent(EventMetadata(), {"user": {"username": get_random_string(12)}})
+
+    def test_store(self):
+        mock_response = Mock()
+        mock_response.raise_for_status.return_value = None
+        mock_post = Mock(return_value=mock_response)
+        store = self.get_store()
+        store._session.post = mock_post
+        store.store(self.build_login_event().serialize())
+        mock_post.assert_called_once()
+        mock_response.raise_for_status.assert_called_once()
+        azure_events = json.loads(mock_post.call_args.kwargs["data"])
+        self.assertEqual(len(azure_events), 1)
+        self.assertEqual(azure_events[0]["Type"], "zentral_login")
+
+    def test_bulk_store(self):
+        mock_response = Mock()
+        mock_response.ok = True
+        mock_post = Mock(return_value=mock_response)
+        store = self.get_store(batch_size=10)
+        store._session.post = mock_post
+        events = [self.build_login_event() for i in range(2)]
+        event_keys = store.bulk_store([events[0], events[1].serialize()])
+        self.assertEqual(event_keys, [(str(evt.metadata.uuid), evt.metadata.index) for evt in events])
+        mock_post.assert_called_once()
+        azure_events = json.loads(mock_post.call_args.kwargs["data"])
+        self.assertEqual([azure_event["Id"] for azure_event in azure_events],
+                         [str(evt.metadata.uuid) for evt in events])
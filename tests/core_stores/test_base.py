@@ -1,3 +1,4 @@
+from unittest.mock import Mock, patch
 from django.test import SimpleTestCase
 from django.utils.crypto import get_random_string
 from accounts.events import EventMetadata, LoginEvent
@@ -58,3 +59,73 @@ class TestBaseStore(SimpleTestCase):
         }))
         event = self.build_login_event(routing_key="yolo")
         self.assertFalse(store.is_serialized_event_included(event.serialize()))
+
+    def test_prepare_event_batch_batch_size_error(self):
+        store = self.build_store()
+        with self.assertRaises(RuntimeError) as cm:
+            store.prepare_event_batch([self.build_login_event()], lambda e: e)
+        self.assertEqual(cm.exception.args[0], "bulk_store is not available when batch_size < 2")
+
+    def test_prepare_event_batch(self):
+        store = self.build_store()
+        store.batch_size = 2
+        event1 = self.build_login_event()
+        event2 = self.build_login_event()
+        event_keys, serialized_events = store.prepare_event_batch(
+            [event1, event2.serialize()],
+            lambda e: e.pop("_zentral")["type"] if isinstance(e, dict) else e.event_type
+        )
+        self.assertEqual(event_keys, [(str(event1.metadata.uuid), 0), (str(event2.metadata.uuid), 0)])
+        self.assertEqual(serialized_events, ["zentral_login", "zentral_login"])
+
+    @patch("zentral.core.stores.backends.base.time.sleep")
+    def test_send_with_retries_ok(self, sleep):
+        response = Mock()
+        response.ok = True
+        send_request = Mock(return_value=response)
+        store = self.build_store()
+        self.assertEqual(store.send_with_retries(send_request), response)
+        send_request.assert_called_once()
+        sleep.assert_not_called()
+
+    @patch("zentral.core.stores.backends.base.time.sleep")
+    def test_send_with_retries_error_retry(self, sleep):
+        response = Mock()
+        response.ok = False
+        response.status_code = 503
+        response.raise_for_status.side_effect = Exception("BOOM!")
+        send_request = Mock(return_value=response)
+        store = self.build_store()
+        with self.assertRaises(Exception) as cm:
+            store.send_with_retries(send_request)
+        self.assertEqual(cm.exception.args[0], "BOOM!")
+        self.assertEqual(len(send_request.call_args_list), 3)
+        self.assertEqual(len(sleep.call_args_list), 2)
+
+    @patch("zentral.core.stores.backends.base.time.sleep")
+    def test_send_with_retries_internal_server_error_retry(self, sleep):
+        error_response = Mock()
+        error_response.ok = False
+        error_response.status_code = 500
+        response = Mock()
+        response.ok = True
+        send_request = Mock(side_effect=[error_response, response])
+        store = self.build_store()
+        self.assertEqual(store.send_with_retries(send_request), response)
+        self.assertEqual(len(send_request.call_args_list), 2)
+        self.assertEqual(len(sleep.call_args_list), 1)
+        error_response.raise_for_status.assert_not_called()
+
+    @patch("zentral.core.stores.backends.base.time.sleep")
+    def test_send_with_retries_error_no_retry(self, sleep):
+        response = Mock()
+        response.ok = False
+        response.status_code = 400
+        response.raise_for_status.side_effect = Exception("BOOM!")
+        send_request = Mock(return_value=response)
+        store = self.build_store()
+        with self.assertRaises(Exception) as cm:
+            store.send_with_retries(send_request)
+        self.assertEqual(cm.exception.args[0], "BOOM!")
+        send_request.assert_called_once()
+        sleep.assert_not_called()
@@ -1,4 +1,6 @@
+import json
 from unittest.mock import Mock
+import zlib
 from django.test import SimpleTestCase
 from django.utils.crypto import get_random_string
 from accounts.events import EventMetadata, LoginEvent
@@ -67,3 +69,16 @@ class DatadogStoreTestCase(SimpleTestCase):
         store.store(event)
         mock_post.assert_called_once()
         mock_response.raise_for_status.assert_called_once()
+
+    def test_bulk_store(self):
+        mock_response = Mock()
+        mock_response.ok = True
+        mock_post = Mock(return_value=mock_response)
+        store = self.get_store(batch_size=10)
+        store._session.post = mock_post
+        events = [self.build_login_event() for i in range(3)]
+        event_keys = store.bulk_store(events)
+        self.assertEqual(event_keys, [(str(evt.metadata.uuid), evt.metadata.index) for evt in events])
+        mock_post.assert_called_once()
+        ddevents = json.loads(zlib.decompress(mock_post.call_args.kwargs["data"]))
+        self.assertEqual([ddevent["id"] for ddevent in ddevents], [str(evt.metadata.uuid) for evt in events])
@@ -1,7 +1,11 @@
+import json
+from unittest.mock import Mock
 from django.test import TestCase
 from django.utils.crypto import get_random_string
+from elastic_transport import ApiResponseMeta
+from elasticsearch import ApiError
 from zentral.core.stores.backends.elasticsearch import EventStore as ElasticsearchEventStore
-from . import BaseTestEventStore
+from . import BaseTestEventStore, make_event
 
 
 class TestElasticsearchEventStore(TestCase, BaseTestEventStore):
@@ -22,3 +26,101 @@ class TestElasticsearchEventStore(TestCase, BaseTestEventStore):
         super().tearDownClass()
         cls.event_store._client.indices.delete(index=cls.index, ignore=[404])
         cls.event_store.close()
+
+
+class TestElasticsearchParallelBulk(TestCase):
+    def get_event_store(self, **config):
+        event_store = ElasticsearchEventStore(
+            {'servers': ["http://elastic:9200"],
+             'index': "zentral-events",
+             'store_name': 'elasticsearch_parallel_bulk_test',
+             'batch_size': 100,
+             'bulk_concurrency': 4,
+             **config}
+        )
+        event_store.configured = True
+        event_store.version = [8]
+        event_store.use_mapping_types = False
+        event_store.bulk_initial_backoff = 0.001
+        event_store._client = Mock()
+        self.addCleanup(event_store.close)
+        return event_store
+
+    @staticmethod
+    def bulk_response(body, statuses=None):
+        items = []
+        for idx, line in enumerate(body.splitlines()[::2]):
+            status = statuses[idx] if statuses else 201
+            items.append({"index": {"_id": json.loads(line)["index"]["_id"], "status": status}})
+        return {"items": items}
+
+    def test_config(self):
+        event_store = self.get_event_store(bulk_concurrency=1000, bulk_max_chunk_bytes=1024)
+        self.assertEqual(event_store.bulk_concurrency, 10)
+        self.assertEqual(event_store.bulk_max_chunk_bytes, 1024)
+        self.assertEqual(ElasticsearchEventStore({'servers': ["http://elastic:9200"],
+                                                  'index': "zentral-events",
+                                                  'store_name': 'elasticsearch_test'}).bulk_concurrency, 1)
+
+    def test_parallel_bulk_store_chunks_by_bytes(self):
+        event_store = self.get_event_store(bulk_max_chunk_bytes=2048)
+        event_store._client.bulk.side_effect = lambda body: self.bulk_response(body)
+        metrics_exporter = Mock()
+        event_store.setup_metrics_exporter(metrics_exporter)
+        events = [make_event(idx=i) for i in range(20)]
+        event_keys = [(str(e.metadata.uuid), e.metadata.index) for e in events]
+        self.assertEqual(sorted(event_store.bulk_store(events)), sorted(event_keys))
+        self.assertTrue(event_store._client.bulk.call_count > 1)
+        for call in event_store._client.bulk.call_args_list:
+            self.assertTrue(len(call.kwargs["body"]) <= 2048)
+        self.assertEqual(
+            [c.args[0] for c in metrics_exporter.add_counter.call_args_list],
+            ["store_bulk_chunks", "store_bulk_chunk_seconds", "store_bulk_rejected_events"]
+        )
+        self.assertEqual(
+            [c.args for c in metrics_exporter.inc.call_args_list if c.args[0] == "store_bulk_chunks"],
+            event_store._client.bulk.call_count * [("store_bulk_chunks", "elasticsearch_parallel_bulk_test", "ok")]
+        )
+
+    def test_parallel_bulk_store_retries_rejected_events(self):
+        event_store = self.get_event_store()
+        attempts = {}
+
+        def bulk(body):
+            lines = body.splitlines()
+            statuses = []
+            for doc_line in lines[1::2]:
+                idx = json.loads(doc_line)["ns_event_type_1"]["idx"]
+                attempts[idx] = attempts.get(idx, 0) + 1
+                if idx == 0:
+                    statuses.append(400)
+                elif idx == 2 and attempts[idx] == 1:
+                    statuses.append(429)
+                else:
+                    statuses.append(201)
+            return self.bulk_response(body, statuses)
+
+        event_store._client.bulk.side_effect = bulk
+        metrics_exporter = Mock()
+        event_store.setup_metrics_exporter(metrics_exporter)
+        events = [make_event(idx=i) for i in range(3)]
+        event_keys = [(str(e.metadata.uuid), e.metadata.index) for e in events]
+        self.assertEqual(sorted(event_store.bulk_store(events)), sorted(event_keys[1:]))
+        # error not retried, rejection retried once
+        self.assertEqual(attempts, {0: 1, 1: 1, 2: 2})
+        metrics_exporter.inc.assert_any_call("store_bulk_chunks", "elasticsearch_parallel_bulk_test", "rejected",
+                                             value=1)
+        metrics_exporter.inc.assert_any_call("store_bulk_rejected_events", "elasticsearch_parallel_bulk_test",
+                                             value=1)
+        # backoff reset after the successful retry
+        self.assertEqual(event_store._bulk_backoff, 0)
+
+    def test_parallel_bulk_store_request_rejected(self):
+        event_store = self.get_event_store()
+        event_store.max_retries = 2
+        event_store._client.bulk.side_effect = ApiError(
+            "rejected", ApiResponseMeta(429, "1.1", {}, 0.1, None), {}
+        )
+        self.assertEqual(list(event_store.bulk_store([make_event()])), [])
+        self.assertEqual(event_store._client.bulk.call_count, 2)
+        self.assertTrue(event_store._bulk_backoff > 0)
@@ -60,3 +60,17 @@ class HttpStoreTestCase(SimpleTestCase):
         event = self.build_login_event()
         store.store(event)
         mock_post.assert_called_once()
+
+    def test_bulk_store(self):
+        mock_response = Mock()
+        mock_response.ok = True
+        mock_post = Mock(return_value=mock_response)
+        store = self.get_store(batch_size=10)
+        store.client.session.post = mock_post
+        events = [self.build_login_event() for i in range(2)]
+        event_keys = store.bulk_store(events)
+        self.assertEqual(event_keys, [(str(evt.metadata.uuid), evt.metadata.index) for evt in events])
+        mock_post.assert_called_once()
+        payloads = mock_post.call_args.kwargs["json"]
+        self.assertEqual(len(payloads), 2)
+        self.assertEqual([payload["id"] for payload in payloads], [str(evt.metadata.uuid) for evt in events])
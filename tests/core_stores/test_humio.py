@@ -1,3 +1,5 @@
+import gzip
+import json
 from unittest.mock import Mock
 from django.test import SimpleTestCase
 from django.utils.crypto import get_random_string
@@ -58,3 +60,20 @@ class HumioStoreTestCase(SimpleTestCase):
         store.store(event)
         mock_post.assert_called_once()
         mock_response.raise_for_status.assert_called_once()
+
+    def test_bulk_store(self):
+        mock_response = Mock()
+        mock_response.ok = True
+        mock_post = Mock(return_value=mock_response)
+        store = self.get_store(batch_size=10)
+        store._session.post = mock_post
+        events = [self.build_login_event() for i in range(2)]
+        event_keys = store.bulk_store(events)
+        self.assertEqual(event_keys, [(str(evt.metadata.uuid), evt.metadata.index) for evt in events])
+        mock_post.assert_called_once()
+        self.assertEqual(mock_post.call_args.kwargs["headers"], {"Content-Encoding": "gzip"})
+        entries = json.loads(gzip.decompress(mock_post.call_args.kwargs["data"]))
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]["tags"], {"event_type": "zentral_login"})
+        self.assertEqual([humio_event["attributes"]["id"] for humio_event in entries[0]["events"]],
+                         [str(evt.metadata.uuid) for evt in events])
@@ -1,3 +1,4 @@
+import socket
 from unittest.mock import Mock, patch
 from django.test import SimpleTestCase
 from django.utils.crypto import get_random_string
@@ -36,3 +37,32 @@ class SyslogStoreTestCase(SimpleTestCase):
         store.store(event)
         mock_socket.connect.assert_called_once()
         mock_socket.send.assert_called_once()
+
+    @patch("zentral.core.stores.backends.syslog.socket")
+    def test_bulk_store_udp(self, syslog_socket):
+        mock_socket = Mock()
+        syslog_socket.SOCK_STREAM = socket.SOCK_STREAM
+        syslog_socket.SOCK_DGRAM = socket.SOCK_DGRAM
+        syslog_socket.socket.return_value = mock_socket
+        store = self.get_store(batch_size=10)
+        events = [self.build_login_event() for i in range(3)]
+        event_keys = store.bulk_store(events)
+        self.assertEqual(event_keys, [(str(evt.metadata.uuid), evt.metadata.index) for evt in events])
+        self.assertEqual(len(mock_socket.send.call_args_list), 3)
+        mock_socket.sendall.assert_not_called()
+
+    @patch("zentral.core.stores.backends.syslog.socket")
+    def test_bulk_store_tcp(self, syslog_socket):
+        mock_socket = Mock()
+        syslog_socket.SOCK_STREAM = socket.SOCK_STREAM
+        syslog_socket.SOCK_DGRAM = socket.SOCK_DGRAM
+        syslog_socket.socket.return_value = mock_socket
+        store = self.get_store(batch_size=10, protocol="tcp")
+        events = [self.build_login_event() for i in range(3)]
+        event_keys = store.bulk_store(events)
+        self.assertEqual(event_keys, [(str(evt.metadata.uuid), evt.metadata.index) for evt in events])
+        mock_socket.send.assert_not_called()
+        mock_socket.sendall.assert_called_once()
+        data = mock_socket.sendall.call_args.args[0]
+        self.assertEqual(data.count(b"\x00"), 3)
+        self.assertTrue(data.endswith(b"\x00"))
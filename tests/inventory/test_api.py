@@ -9,7 +9,7 @@ from rest_framework import status
 from rest_framework.test import APITestCase
 from accounts.models import APIToken, User
 from zentral.contrib.inventory.models import (CurrentMachineSnapshot, MachineSnapshot,
-                                              MachineSnapshotCommit, MachineTag,
+                                              MachineSnapshotCommit, MachineSnapshotTombstone, MachineTag,
                                               MetaBusinessUnit, Tag, Taxonomy)
 from zentral.core.events.base import AuditEvent
 
@@ -143,6 +143,11 @@ class InventoryAPITests(APITestCase):
             CurrentMachineSnapshot.objects.filter(serial_number__in=[serial_number, serial_number2]).count(),
             1
         )
+        self.assertEqual(
+            list(MachineSnapshotTombstone.objects.filter(serial_number__in=[serial_number, serial_number2])
+                                                 .values_list("serial_number", flat=True)),
+            [serial_number]
+        )
 
     # prune machines
 
@@ -496,7 +501,8 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.put(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(callbacks), 1)
+        # audit event + inventory search generation bump
+        self.assertEqual(len(callbacks), 2)
         prev_updated_at = meta_business_unit.updated_at
         meta_business_unit.refresh_from_db()
         self.assertEqual(meta_business_unit.name, updated_name)
@@ -674,7 +680,8 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.post(reverse('inventory_api:tags'), data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(len(callbacks), 1)
+        # audit event + inventory search generation bump
+        self.assertEqual(len(callbacks), 2)
         tag = Tag.objects.get(name=name)
         self.assertEqual(tag.meta_business_unit, meta_business_unit)
         self.assertEqual(tag.name, name)
@@ -772,7 +779,8 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.put(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(callbacks), 1)
+        # audit event + inventory search generation bump
+        self.assertEqual(len(callbacks), 2)
         tag.refresh_from_db()
         self.assertEqual(tag.name, updated_name)
         event = post_event.call_args_list[0].args[0]
@@ -849,7 +857,8 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.delete(reverse('inventory_api:tag', args=(tag.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        # audit event + osquery conf & inventory search generation bumps
+        self.assertEqual(len(callbacks), 3)
         self.assertEqual(Tag.objects.filter(pk=tag.pk).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
@@ -0,0 +1,123 @@
+from datetime import timedelta
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MachineSnapshot, MachineSnapshotCommit
+from zentral.contrib.inventory.utils import cleanup_inventory_in_chunks, get_cleanup_max_date
+from zentral.contrib.inventory.utils.cleanup import CHUNKED_CLEANUP_STATE_CACHE_KEY
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class InventoryChunkedCleanupTestCase(TestCase):
+    def setUp(self):
+        cache.delete(CHUNKED_CLEANUP_STATE_CACHE_KEY)
+        self.results = {}
+
+    # utils
+
+    def result_callback(self, key, result):
+        self.results[key] = result
+
+    def commit_machine_snapshots(self, count, days_ago=40):
+        serial_number = get_random_string(12)
+        msc_pks = []
+        for i in range(count):
+            tree = {"source": {"module": "tests.zentral.io", "name": "Zentral Tests"},
+                    "serial_number": serial_number,
+                    "os_version": {"name": "OS X", "major": 10, "minor": 11, "patch": i}}
+            msc, _, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+            msc_pks.append(msc.pk)
+        # in the past, in order
+        for i, msc_pk in enumerate(msc_pks):
+            MachineSnapshotCommit.objects.filter(pk=msc_pk).update(
+                created_at=timezone.now() - timedelta(days=days_ago, seconds=count - i)
+            )
+        return serial_number, msc_pks
+
+    def cleanup(self, cursor=None, **kwargs):
+        with connection.cursor() as default_cursor:
+            return cleanup_inventory_in_chunks(cursor or default_cursor, self.result_callback,
+                                               get_cleanup_max_date(30), **kwargs)
+
+    # tests
+
+    def test_chunked_cleanup(self):
+        serial_number, msc_pks = self.commit_machine_snapshots(3)
+        recent_serial_number, recent_msc_pks = self.commit_machine_snapshots(2, days_ago=1)
+        _, complete = self.cleanup(chunk_size=1)
+        self.assertTrue(complete)
+        # last old commit kept
+        self.assertEqual(
+            list(MachineSnapshotCommit.objects.filter(serial_number=serial_number).values_list("pk", flat=True)),
+            msc_pks[-1:]
+        )
+        self.assertEqual(MachineSnapshot.objects.filter(serial_number=serial_number).count(), 1)
+        # recent commits kept
+        self.assertEqual(MachineSnapshotCommit.objects.filter(serial_number=recent_serial_number).count(), 2)
+        msc_result = self.results["machine_snapshot_commit"]
+        self.assertEqual(msc_result["rowcount"], 2)
+        self.assertTrue(msc_result["chunks"] >= len(msc_pks) + len(recent_msc_pks))
+        self.assertTrue(msc_result["complete"])
+        self.assertEqual(msc_result["status"], 0)
+        self.assertEqual(self.results["inventory_machinesnapshot"]["rowcount"], 2)
+        self.assertTrue(all(r["status"] == 0 for r in self.results.values()))
+        self.assertIsNone(cache.get(CHUNKED_CLEANUP_STATE_CACHE_KEY))
+
+    def test_chunked_cleanup_time_budget_resume(self):
+        serial_number, msc_pks = self.commit_machine_snapshots(3)
+        # no time budget → stops after the first chunk
+        _, complete = self.cleanup(chunk_size=1, time_budget=0, resume=True)
+        self.assertFalse(complete)
+        self.assertEqual(list(self.results.keys()), ["machine_snapshot_commit"])
+        msc_result = self.results["machine_snapshot_commit"]
+        self.assertEqual(msc_result["chunks"], 1)
+        self.assertFalse(msc_result["complete"])
+        state = cache.get(CHUNKED_CLEANUP_STATE_CACHE_KEY)
+        self.assertEqual(state["key"], "machine_snapshot_commit")
+        # resume
+        self.results = {}
+        _, complete = self.cleanup(chunk_size=10000, resume=True)
+        self.assertTrue(complete)
+        self.assertEqual(self.results["machine_snapshot_commit"]["chunks"], 1)
+        self.assertEqual(
+            list(MachineSnapshotCommit.objects.filter(serial_number=serial_number).values_list("pk", flat=True)),
+            msc_pks[-1:]
+        )
+        self.assertIsNone(cache.get(CHUNKED_CLEANUP_STATE_CACHE_KEY))
+
+    def test_chunked_cleanup_crash_resume(self):
+        serial_number, msc_pks = self.commit_machine_snapshots(3)
+
+        class CrashingCursor:
+            # the process is killed during the second chunk
+            def __init__(self, cursor):
+                self.cursor = cursor
+                self.delete_count = 0
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+            def execute(self, query, args=None):
+                if query.startswith("DELETE"):
+                    self.delete_count += 1
+                    if self.delete_count > 1:
+                        raise KeyboardInterrupt
+                return self.cursor.execute(query, args)
+
+        with connection.cursor() as cursor:
+            with self.assertRaises(KeyboardInterrupt):
+                self.cleanup(cursor=CrashingCursor(cursor), chunk_size=1, resume=True)
+        # checkpoint after the first chunk
+        self.assertEqual(cache.get(CHUNKED_CLEANUP_STATE_CACHE_KEY),
+                         {"key": "machine_snapshot_commit", "min_id": msc_pks[0] + 1})
+        # resume
+        _, complete = self.cleanup(chunk_size=1, resume=True)
+        self.assertTrue(complete)
+        self.assertEqual(self.results["machine_snapshot_commit"]["chunks"], 2)
+        self.assertEqual(
+            list(MachineSnapshotCommit.objects.filter(serial_number=serial_number).values_list("pk", flat=True)),
+            msc_pks[-1:]
+        )
+        self.assertIsNone(cache.get(CHUNKED_CLEANUP_STATE_CACHE_KEY))
@@ -1,11 +1,13 @@
 from datetime import datetime
+from unittest.mock import patch
 import uuid
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.crypto import get_random_string
+from jmespath.visitor import TreeInterpreter
 from zentral.core.compliance_checks.models import MachineStatus, Status
 from zentral.contrib.inventory.events import JMESPathCheckStatusUpdated
 from zentral.contrib.inventory.models import MachineTag, Tag
-from zentral.contrib.inventory.compliance_checks import jmespath_checks_cache
+from zentral.contrib.inventory.compliance_checks import SharedSubexpressionsInterpreter, jmespath_checks_cache
 from .utils import force_jmespath_check
 
 
@@ -181,3 +183,104 @@ class InventoryComplianceChecksTestCase(TestCase):
         # missmatch, no status
         ms_qs = MachineStatus.objects.filter(compliance_check=jmespath_check_non_matching_tags.compliance_check)
         self.assertEqual(ms_qs.count(), 0)
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_skip_if_unchanged(self):
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        jmespath_check = force_jmespath_check(source_name, profile_uuid)
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        events = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow()))
+        self.assertEqual(len(events), 1)
+        # same checks, not evaluated
+        with self.assertNumQueries(0):
+            events = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow(), skip_if_unchanged=True))
+        self.assertEqual(len(events), 0)
+        # new check version, evaluated
+        compliance_check = jmespath_check.compliance_check
+        compliance_check.version = 2
+        compliance_check.save()
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        events = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow(), skip_if_unchanged=True))
+        self.assertEqual(len(events), 0)  # same status, no events
+        ms = MachineStatus.objects.get(compliance_check=compliance_check, serial_number=serial_number)
+        self.assertEqual(ms.compliance_check_version, 2)
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_skip_if_unchanged_machine_tags_updated(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        force_jmespath_check(source_name, profile_uuid, tags=[tag])
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        events = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow()))
+        self.assertEqual(len(events), 0)  # tags mismatch
+        # machine tagged, evaluated
+        MachineTag.objects.create(serial_number=serial_number, tag=tag)
+        events = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow(), skip_if_unchanged=True))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].payload["status"], Status.OK.name)
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_skip_if_unchanged_machine_tags_cached(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        force_jmespath_check(source_name, profile_uuid, tags=[tag])
+        MachineTag.objects.create(serial_number=serial_number, tag=tag)
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        events = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow()))
+        self.assertEqual(len(events), 1)
+        # same checks & cached machine tags, no queries
+        with self.assertNumQueries(0):
+            events = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow(), skip_if_unchanged=True))
+        self.assertEqual(len(events), 0)
+
+    def test_shared_subexpressions(self):
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        force_jmespath_check(source_name, profile_uuid)
+        force_jmespath_check(source_name, jmespath_expression="length(profiles[*].uuid) == `2`")
+        force_jmespath_check(source_name, jmespath_expression="length(profiles[*].identifier) == `3`")
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        with patch.object(SharedSubexpressionsInterpreter, "visit_projection", autospec=True,
+                          side_effect=TreeInterpreter.visit_projection) as visit_projection:
+            events = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow()))
+        # profiles[*].uuid projected once, profiles[*].identifier projected once
+        self.assertEqual(visit_projection.call_count, 2)
+        self.assertEqual(sorted(e.payload["status"] for e in events),
+                         [Status.FAILED.name, Status.OK.name, Status.OK.name])
+
+    @patch("base.notifier.Notifier.send_notification")
+    def test_jmespath_check_change_notification(self, send_notification):
+        with self.captureOnCommitCallbacks(execute=True):
+            jmespath_check = force_jmespath_check()
+        send_notification.assert_called_with("inventory.jmespath_checks")
+        send_notification.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            jmespath_check.tags.set([Tag.objects.create(name=get_random_string(12))])
+        send_notification.assert_called_with("inventory.jmespath_checks")
+        send_notification.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name=get_random_string(12))
+        send_notification.assert_not_called()
+
+    def test_jmespath_checks_reset(self):
+        source_name = get_random_string(12)
+        tree = self._build_tree(source_name, str(uuid.uuid4()))
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        self.assertEqual(len(list(jmespath_checks_cache.process_tree(tree, datetime.utcnow()))), 0)
+        force_jmespath_check(source_name, jmespath_expression="`true`")
+        # not reloaded
+        self.assertEqual(len(list(jmespath_checks_cache.process_tree(tree, datetime.utcnow()))), 0)
+        # change notified
+        jmespath_checks_cache._reset("")
+        self.assertEqual(len(list(jmespath_checks_cache.process_tree(tree, datetime.utcnow()))), 1)
@@ -1,19 +1,28 @@
 import csv
+from datetime import datetime
+import gzip
+import importlib.util
 import json
+import unittest
+from unittest.mock import patch
 import zipfile
 from django.core.files.storage import default_storage
+from django.db import connection
 from django.test import TestCase
 from django.utils.crypto import get_random_string
-from zentral.contrib.inventory.models import MachineSnapshotCommit
-from zentral.contrib.inventory.utils import (do_full_export,
+from zentral.contrib.inventory.models import (CurrentMachineSnapshot, InventoryExportWatermark,
+                                              MachineSnapshotCommit, MachineSnapshotTombstone, MetaMachine)
+from zentral.contrib.inventory.utils import (ConcurrentIncrementalExportError,
+                                             do_full_export, do_incremental_export, do_streaming_full_export,
                                              export_machine_macos_app_instances,
                                              export_machine_snapshots)
+from zentral.contrib.inventory.utils.full_export import FULL_EXPORT_QUERIES
 
 
 class InventoryExportsTests(TestCase):
     # utils
 
-    def commit_machine_snapshot(self, serial_number=None):
+    def commit_machine_snapshot(self, serial_number=None, bundle_version="123"):
         if serial_number is None:
             serial_number = get_random_string(12)
         source = {"module": "tests.zentral.io", "name": "Zentral Tests"}
@@ -34,7 +43,7 @@ class InventoryExportsTests(TestCase):
             "osx_app_instances": [
                 {'app': {'bundle_id': 'io.zentral.baller',
                          'bundle_name': 'Baller.app',
-                         'bundle_version': '123',
+                         'bundle_version': bundle_version,
                          'bundle_version_str': '1.2.3'},
                  'bundle_path': "/Applications/Baller.app"},
             ],
@@ -66,6 +75,173 @@ class InventoryExportsTests(TestCase):
                     self.assertEqual(machine_d["serial_number"], serial_number)
         default_storage.delete(result["filepath"])
 
+    def read_streaming_full_export_manifest(self, result):
+        self.assertEqual(result["headers"]["Content-Type"], "application/json")
+        with default_storage.open(result["filepath"]) as f:
+            manifest = json.load(f)
+        self.addCleanup(default_storage.delete, result["filepath"])
+        for file_d in manifest["files"]:
+            self.addCleanup(default_storage.delete, file_d["filepath"])
+        return manifest
+
+    def test_streaming_full_export_jsonl(self):
+        serial_number = self.commit_machine_snapshot()
+        manifest = self.read_streaming_full_export_manifest(do_streaming_full_export(max_workers=1))
+        self.assertEqual(manifest["format"], "jsonl")
+        files = {file_d["model"]: file_d for file_d in manifest["files"]}
+        # one file per table, even if empty
+        self.assertEqual(files["certificate"]["rows"], 0)
+        self.assertEqual(files["machine"]["rows"], 1)
+        self.assertTrue(files["machine"]["filepath"].endswith("/zentral_machine.jsonl.gz"))
+        with default_storage.open(files["machine"]["filepath"]) as f:
+            content = gzip.decompress(f.read()).decode("utf-8").splitlines()
+        self.assertEqual(len(content), 1)
+        machine_d = json.loads(content[0])
+        self.assertEqual(machine_d["serial_number"], serial_number)
+        self.assertEqual(json.loads(machine_d["extra_facts"]), {"un": 1, "deux": "zwei"})
+
+    def test_streaming_full_export_workers_in_transaction(self):
+        serial_number = get_random_string(12)
+        self.commit_machine_snapshot(serial_number)
+        # in the test transaction → no exported snapshot, no workers
+        with patch("zentral.contrib.inventory.utils.full_export._threaded_stream_model_export") as threaded_export:
+            manifest = self.read_streaming_full_export_manifest(do_streaming_full_export(max_workers=2))
+        threaded_export.assert_not_called()
+        self.assertEqual(len(manifest["files"]), len(FULL_EXPORT_QUERIES))
+        # the uncommitted machine snapshot is exported
+        machine_file = next(f for f in manifest["files"] if f["model"] == "machine")
+        self.assertEqual(machine_file["rows"], 1)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_streaming_full_export_parquet(self):
+        import pyarrow.parquet as pq
+        serial_number = self.commit_machine_snapshot()
+        manifest = self.read_streaming_full_export_manifest(
+            do_streaming_full_export(output_format="parquet", max_workers=1)
+        )
+        self.assertEqual(manifest["format"], "parquet")
+        files = {file_d["model"]: file_d for file_d in manifest["files"]}
+        with default_storage.open(files["machine"]["filepath"]) as f:
+            table = pq.read_table(f)
+        self.assertEqual(table.num_rows, 1)
+        machine_d = table.to_pylist()[0]
+        self.assertEqual(machine_d["serial_number"], serial_number)
+        self.assertEqual(json.loads(machine_d["extra_facts"]), {"un": 1, "deux": "zwei"})
+
+    def test_streaming_full_export_unknown_format(self):
+        with self.assertRaises(ValueError):
+            do_streaming_full_export(output_format="yolo")
+
+    def read_incremental_export(self, name):
+        manifest = self.read_streaming_full_export_manifest(
+            do_incremental_export(name, max_workers=1, settle_delay=0)
+        )
+        self.assertEqual(manifest["name"], name)
+        rows = {}
+        for file_d in manifest["files"]:
+            with default_storage.open(file_d["filepath"]) as f:
+                rows[file_d["model"]] = [json.loads(line)
+                                         for line in gzip.decompress(f.read()).decode("utf-8").splitlines()]
+            self.assertEqual(len(rows[file_d["model"]]), file_d["rows"])
+        return manifest, rows
+
+    def test_incremental_export(self):
+        serial_number1 = self.commit_machine_snapshot()
+        serial_number2 = self.commit_machine_snapshot()
+        name = get_random_string(12)
+        # first export → all current machines
+        manifest, rows = self.read_incremental_export(name)
+        self.assertIsNone(manifest["watermark"]["machine_snapshot_commit"]["from"])
+        self.assertEqual(sorted(r["serial_number"] for r in rows["machine"]), sorted([serial_number1, serial_number2]))
+        self.assertEqual(len(rows["macos_app"]), 1)
+        self.assertEqual(len(rows["macos_app_instance"]), 1)
+        self.assertEqual(len(rows["machine_macos_app_instance"]), 2)
+        self.assertEqual(len(rows["source"]), 1)
+        self.assertEqual(rows["machine_tombstone"], [])
+        watermark = InventoryExportWatermark.objects.get(name=name)
+        last_msc = MachineSnapshotCommit.objects.order_by("-created_at", "-id").first()
+        self.assertEqual(watermark.machine_snapshot_commit_id, last_msc.pk)
+        self.assertEqual(watermark.machine_snapshot_commit_created_at, last_msc.created_at)
+        # no changes
+        _, rows = self.read_incremental_export(name)
+        self.assertTrue(all(model_rows == [] for model_rows in rows.values()))
+        # one updated machine, one archived machine
+        self.commit_machine_snapshot(serial_number1, bundle_version="124")
+        MetaMachine(serial_number2).archive()
+        tombstone = MachineSnapshotTombstone.objects.get(serial_number=serial_number2)
+        _, rows = self.read_incremental_export(name)
+        self.assertEqual([r["serial_number"] for r in rows["machine"]], [serial_number1])
+        self.assertEqual([r["bundle_version"] for r in rows["macos_app"]], ["124"])
+        self.assertEqual(len(rows["macos_app_instance"]), 1)
+        self.assertEqual(rows["machine_tombstone"],
+                         [{"serial_number": serial_number2,
+                           "source_id": tombstone.source_id,
+                           "archived_at": tombstone.created_at.isoformat()[:23]}])
+        watermark.refresh_from_db()
+        self.assertEqual(watermark.tombstone_id, tombstone.pk)
+
+    def test_incremental_export_machine_seen_without_commit(self):
+        serial_number1 = self.commit_machine_snapshot()
+        self.commit_machine_snapshot()
+        name = get_random_string(12)
+        self.read_incremental_export(name)
+        commit_count = MachineSnapshotCommit.objects.count()
+        # last seen updated without new commit
+        CurrentMachineSnapshot.objects.filter(serial_number=serial_number1).update(last_seen=datetime.utcnow())
+        manifest, rows = self.read_incremental_export(name)
+        self.assertEqual(MachineSnapshotCommit.objects.count(), commit_count)
+        self.assertEqual([r["serial_number"] for r in rows["machine"]], [serial_number1])
+        self.assertIsNotNone(manifest["watermark"]["current_machine_snapshot_last_seen"]["from"])
+        self.assertIsNotNone(InventoryExportWatermark.objects.get(name=name).current_machine_snapshot_last_seen)
+        # no changes
+        _, rows = self.read_incremental_export(name)
+        self.assertEqual(rows["machine"], [])
+
+    def test_incremental_export_archived_machine_seen_again(self):
+        serial_number = self.commit_machine_snapshot()
+        name = get_random_string(12)
+        self.read_incremental_export(name)
+        MetaMachine(serial_number).archive()
+        self.commit_machine_snapshot(serial_number, bundle_version="124")
+        _, rows = self.read_incremental_export(name)
+        self.assertEqual([r["serial_number"] for r in rows["machine"]], [serial_number])
+        self.assertEqual(rows["machine_tombstone"], [])
+
+    def test_incremental_export_outside_of_transaction(self):
+        name = get_random_string(12)
+        atomic_block_depths = []
+
+        def stream_model_exports(*args):
+            atomic_block_depths.append(len(connection.atomic_blocks))
+            return []
+
+        with patch("zentral.contrib.inventory.utils.full_export.stream_model_exports",
+                   side_effect=stream_model_exports):
+            self.read_streaming_full_export_manifest(do_incremental_export(name, settle_delay=0))
+        # no transaction opened for the export → exported snapshot for the workers
+        self.assertEqual(atomic_block_depths, [len(connection.atomic_blocks)])
+        self.assertTrue(InventoryExportWatermark.objects.filter(name=name).exists())
+
+    def test_incremental_export_concurrent_export(self):
+        self.commit_machine_snapshot()
+        name = get_random_string(12)
+        self.read_incremental_export(name)
+        watermark = InventoryExportWatermark.objects.get(name=name)
+
+        def stream_model_exports(*args):
+            # concurrent export with the same name
+            InventoryExportWatermark.objects.get(name=name).save()
+            return []
+
+        with patch("zentral.contrib.inventory.utils.full_export.stream_model_exports",
+                   side_effect=stream_model_exports):
+            with self.assertRaises(ConcurrentIncrementalExportError):
+                do_incremental_export(name, settle_delay=0)
+        updated_watermark = InventoryExportWatermark.objects.get(name=name)
+        self.assertEqual(updated_watermark.machine_snapshot_commit_id, watermark.machine_snapshot_commit_id)
+        self.assertEqual(updated_watermark.current_machine_snapshot_last_seen,
+                         watermark.current_machine_snapshot_last_seen)
+
     def test_export_machine_snapshots(self):
         serial_number = self.commit_machine_snapshot()
         result = export_machine_snapshots(source_name="ZENTRAL TESTS")
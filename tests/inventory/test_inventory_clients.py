@@ -1,5 +1,13 @@
-from django.test import SimpleTestCase
+import copy
+import threading
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase, TestCase
+from django.utils.crypto import get_random_string
 from zentral.conf import settings
+from zentral.contrib.inventory.clients.dummy import DUMMY_MACHINES, InventoryClient
+from zentral.contrib.inventory.models import CurrentMachineSnapshot, MachineSnapshot
+from zentral.contrib.inventory.utils.db import (TREES_COUNTER, TREES_SECONDS_COUNTER,
+                                                commit_machine_snapshot_trees)
 from zentral.contrib.inventory.workers import get_workers
 
 
@@ -13,3 +21,67 @@ class InventoryClientsTestCase(SimpleTestCase):
             worker_count,
             len(settings.get('apps', {}).get('zentral.contrib.inventory', {}).get('clients', []))
         )
+
+    @patch("zentral.contrib.inventory.utils.db._commit_machine_snapshot_tree_batch")
+    def test_commit_machine_snapshot_trees_worker_pool(self, commit_batch):
+        batches = []
+
+        def fake_commit_batch(trees, pk_cache):
+            batches.append(([tree["serial_number"] for tree in trees], pk_cache, threading.get_ident()))
+            return [tree["serial_number"] for tree in trees], [], [("zentral", "updated") for _ in trees]
+
+        commit_batch.side_effect = fake_commit_batch
+        serial_numbers = [get_random_string(12) for _ in range(10)]
+        # each machine 3 times
+        trees = ({"serial_number": serial_numbers[i % 10]} for i in range(30))
+        metrics_exporter = Mock()
+        results = commit_machine_snapshot_trees(trees, max_workers=2, batch_size=3,
+                                                metrics_exporter=metrics_exporter)
+        self.assertEqual(len(results), 30)
+        self.assertEqual(sorted(results), sorted(3 * serial_numbers))
+        self.assertTrue(all(len(batch_serial_numbers) <= 3 for batch_serial_numbers, _, _ in batches))
+        # the trees of a machine are always committed by the same worker, with the same pk cache
+        serial_number_workers = {}
+        pk_cache_workers = {}
+        for batch_serial_numbers, pk_cache, worker in batches:
+            for serial_number in batch_serial_numbers:
+                self.assertEqual(serial_number_workers.setdefault(serial_number, worker), worker)
+            self.assertEqual(pk_cache_workers.setdefault(id(pk_cache), worker), worker)
+        self.assertEqual(
+            [c.args for c in metrics_exporter.inc.call_args_list if c.args[0] == TREES_COUNTER],
+            30 * [(TREES_COUNTER, "zentral", "updated")]
+        )
+        # one seconds counter increment per batch
+        self.assertEqual(
+            len([c for c in metrics_exporter.inc.call_args_list if c.args[0] == TREES_SECONDS_COUNTER]),
+            len(batches)
+        )
+
+
+class DummyInventoryClient(InventoryClient):
+    commit_max_workers = 1
+
+    def get_machines(self):
+        yield from copy.deepcopy(DUMMY_MACHINES)
+
+
+class InventoryClientSyncTestCase(TestCase):
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
+    def test_sync(self, post_events):
+        client = DummyInventoryClient({"backend": "zentral.contrib.inventory.clients.dummy",
+                                       "name": get_random_string(12)})
+        # stale current machine snapshot
+        tree = {"serial_number": get_random_string(12),
+                "source": copy.deepcopy(client.source)}
+        stale_ms, _ = MachineSnapshot.objects.commit(tree)
+        CurrentMachineSnapshot.objects.create(serial_number=stale_ms.serial_number,
+                                              source=stale_ms.source,
+                                              machine_snapshot=stale_ms,
+                                              last_seen=stale_ms.mt_created_at)
+        client.sync()
+        self.assertEqual(
+            sorted(CurrentMachineSnapshot.objects.filter(source=stale_ms.source)
+                                                 .values_list("serial_number", flat=True)),
+            sorted(m["serial_number"] for m in DUMMY_MACHINES)
+        )
+        post_events.assert_called_once()
@@ -1,5 +1,6 @@
 import copy
 from datetime import datetime, timedelta
+from unittest.mock import Mock, patch
 from dateutil import parser
 from django.core.cache import cache
 from django.test import TestCase, override_settings
@@ -15,8 +16,12 @@ from zentral.contrib.inventory.models import (BusinessUnit,
                                               MetaBusinessUnitTag,
                                               MetaMachine,
                                               Source,
-                                              Tag, Taxonomy)
-from zentral.contrib.inventory.utils.db import inventory_events_from_machine_snapshot_commit
+                                              Tag, Taxonomy,
+                                              machine_info_local_cache)
+from zentral.contrib.inventory.utils.db import (TREES_COUNTER,
+                                                commit_machine_snapshot_and_trigger_events,
+                                                commit_machine_snapshot_trees,
+                                                inventory_events_from_machine_snapshot_commit)
 from zentral.utils.mt_models import MTOError
 
 
@@ -276,6 +281,104 @@ class MachineSnapshotTestCase(TestCase):
                                msg="Duplicated subtree in key osx_app_instances"):
             MachineSnapshot.objects.commit(tree)
 
+    def test_bulk_commit_same_objects_as_commit(self):
+        tree = copy.deepcopy(self.machine_snapshot5)
+        tree["business_unit"] = {"name": get_random_string(12),
+                                 "reference": get_random_string(12),
+                                 "source": copy.deepcopy(self.source)}
+        tree["certificates"][0]["signed_by"] = copy.deepcopy(self.certificate)
+        [(ms, created)] = MachineSnapshot.objects.bulk_commit([copy.deepcopy(tree)])
+        self.assertTrue(created)
+        ms.refresh_from_db()
+        self.assertEqual(ms.hash(), ms.mt_hash)
+        self.assertEqual(ms.osx_app_instances.count(), 1)
+        self.assertEqual(ms.certificates.count(), 2)
+        self.assertEqual(ms.certificates.get(common_name="Yolo-ID-1").signed_by.common_name, "Apple Root CA")
+        # custom save → meta business unit created
+        self.assertEqual(ms.business_unit.meta_business_unit.name, tree["business_unit"]["name"])
+        # same tree with the recursive commit
+        ms2, created2 = MachineSnapshot.objects.commit(copy.deepcopy(tree))
+        self.assertFalse(created2)
+        self.assertEqual(ms2, ms)
+
+    def test_bulk_commit_existing_objects(self):
+        tree = copy.deepcopy(self.machine_snapshot3)
+        ms, _ = MachineSnapshot.objects.commit(copy.deepcopy(tree))
+        # 1 query for the existing snapshot + 1 query to fetch it
+        with self.assertNumQueries(2):
+            [(ms2, created)] = MachineSnapshot.objects.bulk_commit([copy.deepcopy(tree)])
+        self.assertFalse(created)
+        self.assertEqual(ms2, ms)
+
+    def test_bulk_commit_multiple_trees(self):
+        trees = []
+        for i in range(3):
+            tree = copy.deepcopy(self.machine_snapshot3)
+            tree["serial_number"] = get_random_string(12)
+            trees.append(tree)
+        trees.append(copy.deepcopy(trees[0]))
+        results = MachineSnapshot.objects.bulk_commit(trees)
+        self.assertEqual(len(results), 4)
+        self.assertEqual([ms.serial_number for ms, _ in results], [t["serial_number"] for t in trees])
+        self.assertEqual(results[0][0], results[3][0])
+        for ms, created in results:
+            self.assertTrue(created)
+            ms.refresh_from_db()
+            self.assertEqual(ms.hash(), ms.mt_hash)
+            self.assertEqual(ms.osx_app_instances.count(), 2)
+        # the shared sub objects are only created once
+        self.assertEqual(Certificate.objects.filter(sha_256=self.certificate["sha_256"]).count(), 1)
+
+    def test_bulk_commit_concurrently_created(self):
+        tree = copy.deepcopy(self.machine_snapshot3)
+        bulk_create = MachineSnapshot.objects.bulk_create
+        concurrent_ms = []
+
+        def concurrent_bulk_create(objs, *args, **kwargs):
+            # the machine snapshot is committed between the resolution and the creation
+            concurrent_ms.append(MachineSnapshot.objects.commit(copy.deepcopy(self.machine_snapshot3))[0])
+            return bulk_create(objs, *args, **kwargs)
+
+        with patch.object(MachineSnapshot.objects, "bulk_create", side_effect=concurrent_bulk_create):
+            [(ms, created)] = MachineSnapshot.objects.bulk_commit([tree])
+        self.assertFalse(created)
+        self.assertEqual(ms, concurrent_ms[0])
+        self.assertEqual(MachineSnapshot.objects.filter(mt_hash=ms.mt_hash).count(), 1)
+
+    def test_bulk_commit_missing_after_bulk_create(self):
+        tree = copy.deepcopy(self.machine_snapshot3)
+        with patch.object(MachineSnapshot.objects, "bulk_create"):
+            with self.assertRaises(MTOError) as cm:
+                MachineSnapshot.objects.bulk_commit([tree])
+        self.assertTrue(cm.exception.message.startswith("MachineSnapshot "))
+        self.assertTrue(cm.exception.message.endswith(" not found after the bulk create"))
+
+    def test_bulk_commit_source_error(self):
+        tree = copy.deepcopy(self.machine_snapshot_source_error)
+        with self.assertRaises(MTOError,
+                               msg="Field 'source' of MachineSnapshot has "
+                                   "many_to_one: True, many_to_many: False"):
+            MachineSnapshot.objects.bulk_commit([tree])
+
+    def test_bulk_commit_duplicated_subtrees(self):
+        tree = copy.deepcopy(self.machine_snapshot3)
+        tree["osx_app_instances"].append(copy.deepcopy(self.osx_app_instance2))
+        with self.assertRaises(MTOError,
+                               msg="Duplicated subtree in key osx_app_instances"):
+            MachineSnapshot.objects.bulk_commit([tree])
+
+    def test_bulk_commit_pk_cache(self):
+        pk_cache = {Source: {}}
+        tree = copy.deepcopy(self.machine_snapshot3)
+        [(ms, _)] = MachineSnapshot.objects.bulk_commit([tree], pk_cache)
+        self.assertEqual(pk_cache, {Source: {ms.source.mt_hash: ms.source.pk}})
+        tree = copy.deepcopy(self.machine_snapshot3)
+        tree["serial_number"] = get_random_string(12)
+        with patch.object(Source.objects, "filter", side_effect=AssertionError("Source query")):
+            [(ms2, created)] = MachineSnapshot.objects.bulk_commit([tree], pk_cache)
+        self.assertTrue(created)
+        self.assertEqual(ms2.source, ms.source)
+
     def test_commit_certificate(self):
         tree = copy.deepcopy(self.certificate)
         cert, _ = Certificate.objects.commit(tree)
@@ -371,6 +474,156 @@ class MachineSnapshotTestCase(TestCase):
         self.assertFalse(mm.has_recent_source_snapshot(module))
         self.assertFalse(mm.has_recent_source_snapshot(module, max_age=2*age))
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_meta_machine_cached_info_invalidation(self, post_event):
+        tree = copy.deepcopy(self.machine_snapshot)
+        commit_machine_snapshot_and_trigger_events(tree)
+        mm = MetaMachine(self.serial_number)
+        cache_key = "mm-probe-fvs_{}".format(mm.get_urlsafe_serial_number())
+        self.assertEqual(mm.cached_probe_filtering_values, mm.get_probe_filtering_values())
+        # process local cache and django cache
+        self.assertEqual(machine_info_local_cache.get(cache_key), mm.cached_probe_filtering_values)
+        self.assertEqual(cache.get(cache_key), mm.cached_probe_filtering_values)
+        # served from the process local cache
+        cache.delete(cache_key)
+        with self.assertNumQueries(0):
+            self.assertEqual(MetaMachine(self.serial_number).cached_probe_filtering_values,
+                             mm.cached_probe_filtering_values)
+        # invalidated after a new commit
+        tree = copy.deepcopy(self.machine_snapshot2)
+        commit_machine_snapshot_and_trigger_events(tree)
+        self.assertIsNone(machine_info_local_cache.get(cache_key))
+        self.assertIsNone(cache.get(cache_key))
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_commit_machine_snapshot_trees(self, post_event, post_events):
+        last_seen = datetime(2023, 1, 1)
+        trees = []
+        for i in range(3):
+            tree = copy.deepcopy(self.machine_snapshot2)
+            tree["serial_number"] = get_random_string(12)
+            tree["last_seen"] = last_seen
+            trees.append(tree)
+        serial_numbers = [t["serial_number"] for t in trees]
+        metrics_exporter = Mock()
+        machine_snapshots = commit_machine_snapshot_trees(trees, max_workers=1, batch_size=2,
+                                                          metrics_exporter=metrics_exporter)
+        self.assertEqual([ms.serial_number for ms in machine_snapshots], serial_numbers)
+        self.assertEqual(
+            set(CurrentMachineSnapshot.objects.filter(serial_number__in=serial_numbers)
+                                              .values_list("serial_number", flat=True)),
+            set(serial_numbers)
+        )
+        # one bulk post per batch. add_machine + inventory_heartbeat events for each machine
+        post_event.assert_not_called()
+        self.assertEqual([len(c.args[0]) for c in post_events.call_args_list], [4, 2])
+        self.assertEqual(
+            sorted(e.event_type for c in post_events.call_args_list for e in c.args[0]),
+            3 * ["add_machine"] + 3 * ["inventory_heartbeat"]
+        )
+        self.assertEqual(
+            [c.args for c in metrics_exporter.inc.call_args_list if c.args[0] == TREES_COUNTER],
+            3 * [(TREES_COUNTER, "zentral", "updated")]
+        )
+        # same trees, same last seen → no new commits, no inventory events
+        trees = []
+        for serial_number in serial_numbers:
+            tree = copy.deepcopy(self.machine_snapshot2)
+            tree["serial_number"] = serial_number
+            tree["last_seen"] = last_seen
+            trees.append(tree)
+        post_event.reset_mock()
+        post_events.reset_mock()
+        metrics_exporter.reset_mock()
+        commit_machine_snapshot_trees(trees, max_workers=1, metrics_exporter=metrics_exporter)
+        self.assertEqual(
+            [c.args for c in metrics_exporter.inc.call_args_list if c.args[0] == TREES_COUNTER],
+            3 * [(TREES_COUNTER, "zentral", "unchanged")]
+        )
+        post_event.assert_not_called()
+        post_events.assert_not_called()
+
+    @patch("zentral.contrib.inventory.utils.db.save_dead_letter")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
+    def test_commit_machine_snapshot_trees_error(self, post_events, save_dead_letter):
+        tree = copy.deepcopy(self.machine_snapshot2)
+        metrics_exporter = Mock()
+        with self.assertLogs("zentral.contrib.inventory.snapshots.db", level="ERROR"):
+            machine_snapshots = commit_machine_snapshot_trees(
+                [copy.deepcopy(self.machine_snapshot_source_error), tree],
+                max_workers=1,
+                metrics_exporter=metrics_exporter
+            )
+        self.assertEqual(len(machine_snapshots), 1)
+        self.assertEqual(machine_snapshots[0].serial_number, self.serial_number)
+        save_dead_letter.assert_called_once()
+        self.assertEqual(
+            sorted(c.args for c in metrics_exporter.inc.call_args_list if c.args[0] == TREES_COUNTER),
+            [(TREES_COUNTER, "UNKNOWN", "error"),
+             (TREES_COUNTER, "zentral", "updated")]
+        )
+
+    def test_update_unchanged_machine_snapshots(self):
+        tree = copy.deepcopy(self.machine_snapshot3)
+        tree["last_seen"] = datetime(2023, 1, 1)
+        msc, ms, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        # same tree, new last seen & system uptime
+        tree = copy.deepcopy(self.machine_snapshot3)
+        tree["last_seen"] = datetime(2023, 1, 2)
+        tree["system_uptime"] = 1234
+        last_seen, system_uptime = MachineSnapshotCommit.objects.prepare_machine_snapshot_tree(tree)
+        with self.assertNumQueries(1):
+            result = MachineSnapshotCommit.objects.update_unchanged_machine_snapshots(
+                [(tree, last_seen, system_uptime)]
+            )
+        self.assertEqual(list(result.keys()), [ms.mt_hash])
+        ms2, last_seen_updated = result[ms.mt_hash]
+        self.assertEqual(ms2, ms)
+        self.assertEqual(ms2.source_id, ms.source_id)
+        self.assertTrue(last_seen_updated)
+        # last commit updated, no new commit
+        self.assertEqual(MachineSnapshotCommit.objects.filter(serial_number=self.serial_number).count(), 1)
+        msc.refresh_from_db()
+        self.assertEqual(msc.last_seen, datetime(2023, 1, 2))
+        self.assertEqual(msc.system_uptime, 1234)
+        cms = CurrentMachineSnapshot.objects.get(serial_number=self.serial_number)
+        self.assertEqual(cms.last_seen, datetime(2023, 1, 2))
+        # same last seen
+        tree = copy.deepcopy(self.machine_snapshot3)
+        tree["last_seen"] = datetime(2023, 1, 2)
+        last_seen, system_uptime = MachineSnapshotCommit.objects.prepare_machine_snapshot_tree(tree)
+        result = MachineSnapshotCommit.objects.update_unchanged_machine_snapshots([(tree, last_seen, system_uptime)])
+        self.assertFalse(result[ms.mt_hash][1])
+        # changed tree
+        tree = copy.deepcopy(self.machine_snapshot4)
+        last_seen, system_uptime = MachineSnapshotCommit.objects.prepare_machine_snapshot_tree(tree)
+        self.assertEqual(
+            MachineSnapshotCommit.objects.update_unchanged_machine_snapshots([(tree, last_seen, system_uptime)]),
+            {}
+        )
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_commit_unchanged_machine_snapshot_and_trigger_events(self, post_event):
+        tree = copy.deepcopy(self.machine_snapshot2)
+        tree["last_seen"] = datetime(2023, 1, 1)
+        ms = commit_machine_snapshot_and_trigger_events(tree)
+        self.assertEqual(post_event.call_count, 2)  # add_machine & inventory_heartbeat
+        post_event.reset_mock()
+        tree = copy.deepcopy(self.machine_snapshot2)
+        tree["last_seen"] = datetime(2023, 1, 2)
+        with patch.object(MachineSnapshot.objects, "bulk_commit") as bulk_commit:
+            ms2 = commit_machine_snapshot_and_trigger_events(tree)
+        bulk_commit.assert_not_called()
+        self.assertEqual(ms2, ms)
+        self.assertEqual(ms2.source, ms.source)
+        post_event.assert_called_once()
+        event = post_event.call_args.args[0]
+        self.assertEqual(event.event_type, "inventory_heartbeat")
+        self.assertEqual(event.metadata.created_at, datetime(2023, 1, 2))
+        self.assertEqual(event.payload, {"source": ms.source.serialize()})
+        self.assertEqual(MachineSnapshotCommit.objects.filter(serial_number=self.serial_number).count(), 1)
+
     def test_meta_machine(self):
         tree = copy.deepcopy(self.machine_snapshot)
         msc, ms, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
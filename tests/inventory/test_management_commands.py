@@ -2,6 +2,8 @@ from io import StringIO
 from unittest.mock import patch
 from django.core.management import call_command
 from django.test import TestCase
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import CurrentMachineSnapshot, MachineSearchIndex, MachineSnapshotCommit
 
 
 class InventoryManagementCommandsTest(TestCase):
@@ -14,6 +16,14 @@ class InventoryManagementCommandsTest(TestCase):
         self.assertIn('max date', result)
         self.assertIn('machine_snapshot_commit', result)
 
+    def test_cleanup_inventory_history_chunked(self):
+        out = StringIO()
+        call_command('cleanup_inventory_history', '--chunked', '--chunk-size', '100', stdout=out)
+        result = out.getvalue()
+        self.assertIn('max date', result)
+        self.assertIn('rows/s', result)
+        self.assertNotIn('incomplete', result)
+
     def test_cleanup_inventory_history_quiet_legacy(self):
         out = StringIO()
         call_command('cleanup_inventory_history', '-q', stdout=out)
@@ -24,6 +34,23 @@ class InventoryManagementCommandsTest(TestCase):
         call_command('cleanup_inventory_history', '-v', '0', stdout=out)
         self.assertEqual("", out.getvalue())
 
+    # machine search index
+
+    def test_rebuild_machine_search_index(self):
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(
+            {"source": {"module": "tests.zentral.io", "name": "Zentral Tests"},
+             "serial_number": get_random_string(12)}
+        )
+        out = StringIO()
+        call_command('rebuild_machine_search_index', stdout=out)
+        self.assertIn("machine search index rebuilt", out.getvalue())
+        self.assertEqual(MachineSearchIndex.objects.count(), CurrentMachineSnapshot.objects.count())
+
+    def test_rebuild_machine_search_index_quiet(self):
+        out = StringIO()
+        call_command('rebuild_machine_search_index', '-q', stdout=out)
+        self.assertEqual("", out.getvalue())
+
     # full export
 
     def test_export_full_inventory(self):
@@ -33,6 +60,20 @@ class InventoryManagementCommandsTest(TestCase):
         self.assertTrue(result.startswith("File: exports/full_inventory_export-"))
         self.assertTrue(result.endswith(".zip\n"))
 
+    def test_export_full_inventory_streaming(self):
+        out = StringIO()
+        call_command('export_full_inventory', '--streaming', '--max-workers', '1', stdout=out)
+        result = out.getvalue()
+        self.assertTrue(result.startswith("File: exports/full_inventory_export-"))
+        self.assertTrue(result.endswith("/manifest.json\n"))
+
+    def test_export_full_inventory_incremental(self):
+        out = StringIO()
+        call_command('export_full_inventory', '--incremental', '--name', 'yolo', '--max-workers', '1', stdout=out)
+        result = out.getvalue()
+        self.assertTrue(result.startswith("File: exports/incremental_inventory_export-yolo-"))
+        self.assertTrue(result.endswith("/manifest.json\n"))
+
     @patch("zentral.contrib.inventory.management.commands.export_full_inventory.file_storage_has_signed_urls")
     def test_export_full_inventory_download(self, file_storage_has_signed_urls):
         file_storage_has_signed_urls.return_value = True
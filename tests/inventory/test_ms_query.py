@@ -1,8 +1,261 @@
+from datetime import datetime
+import time
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db.models.deletion import Collector
 from django.http import QueryDict
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils.crypto import get_random_string
+from zentral.conf import ConfigDict, settings
+from zentral.contrib.inventory.models import (MachineSearchIndex, MachineSnapshotCommit, MachineTag,
+                                              MetaBusinessUnit, MetaBusinessUnitTag, Tag,
+                                              bump_inventory_search_generation, get_inventory_search_generation)
 from zentral.contrib.inventory.utils import MSQuery
+from zentral.core.compliance_checks.models import Status
+from zentral.core.compliance_checks.utils import update_machine_statuses
+from .utils import force_jmespath_check
 
 
 class MSQueryTestCase(TestCase):
     def test_unexisting_compliance_check_status_filter(self):
         self.assertEqual("?sf=", MSQuery(QueryDict("sf=ccs.100000000").copy()).get_url())
+
+
+class MachineSearchIndexTestCase(TestCase):
+    def setUp(self):
+        settings._collection["apps"]["zentral.contrib.inventory"]["machine_search_index"] = True
+
+    def tearDown(self):
+        settings._collection["apps"]["zentral.contrib.inventory"].pop("machine_search_index", None)
+
+    # utils
+
+    def commit_machine_snapshot(self, meta_business_unit=None):
+        tree = {"source": {"module": "tests.zentral.io", "name": "Zentral Tests"},
+                "serial_number": get_random_string(12)}
+        if meta_business_unit:
+            bu = meta_business_unit.create_enrollment_business_unit()
+            tree["business_unit"] = {"source": {"module": "zentral.contrib.inventory", "name": "inventory"},
+                                     "reference": bu.reference,
+                                     "name": bu.name}
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        return tree["serial_number"]
+
+    def get_index(self, serial_number):
+        return MachineSearchIndex.objects.get(serial_number=serial_number)
+
+    def search(self, query_string):
+        msquery = MSQuery(QueryDict(query_string).copy())
+        return (
+            sorted(sn for sn, _ in msquery.fetch()),
+            [(f.title, sorted((c[0], c[1]) for c in choices)) for f, choices in msquery.grouping_choices()]
+        )
+
+    def assertSameSearch(self, query_string):
+        result = self.search(query_string)
+        settings._collection["apps"]["zentral.contrib.inventory"]["machine_search_index"] = False
+        self.assertEqual(result, self.search(query_string))
+        settings._collection["apps"]["zentral.contrib.inventory"]["machine_search_index"] = True
+        return result[0]
+
+    # tests
+
+    def test_machine_snapshot_commit(self):
+        serial_number = self.commit_machine_snapshot()
+        msi = self.get_index(serial_number)
+        self.assertEqual(msi.tag_ids, [])
+        self.assertIsNone(msi.max_compliance_check_status)
+        self.assertEqual(msi.compliance_check_statuses, {})
+
+    def test_index_disabled(self):
+        settings._collection["apps"]["zentral.contrib.inventory"]["machine_search_index"] = False
+        serial_number = self.commit_machine_snapshot()
+        self.assertFalse(MachineSearchIndex.objects.filter(serial_number=serial_number).exists())
+        self.assertFalse(MSQuery().use_search_index())
+
+    def test_tags(self):
+        mbu = MetaBusinessUnit.objects.create(name=get_random_string(12))
+        serial_number = self.commit_machine_snapshot(mbu)
+        tag1 = Tag.objects.create(name=get_random_string(12))
+        tag2 = Tag.objects.create(name=get_random_string(12))
+        MachineTag.objects.create(serial_number=serial_number, tag=tag1)
+        self.assertEqual(self.get_index(serial_number).tag_ids, [tag1.pk])
+        MetaBusinessUnitTag.objects.create(meta_business_unit=mbu, tag=tag2)
+        self.assertEqual(self.get_index(serial_number).tag_ids, [tag1.pk, tag2.pk])
+        MachineTag.objects.filter(serial_number=serial_number, tag=tag1).delete()
+        self.assertEqual(self.get_index(serial_number).tag_ids, [tag2.pk])
+        MachineTag.objects.bulk_create([MachineTag(serial_number=serial_number, tag=tag1)])
+        self.assertEqual(self.get_index(serial_number).tag_ids, [tag1.pk, tag2.pk])
+
+    def test_tag_deletion(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        serial_numbers = [self.commit_machine_snapshot() for _ in range(3)]
+        MachineTag.objects.bulk_create([MachineTag(serial_number=sn, tag=tag) for sn in serial_numbers])
+        self.assertEqual(self.get_index(serial_numbers[0]).tag_ids, [tag.pk])
+        # no MachineTag delete signals → fast delete of the cascade
+        self.assertTrue(Collector(using="default").can_fast_delete(MachineTag.objects.filter(tag=tag)))
+        tag.delete()
+        for serial_number in serial_numbers:
+            self.assertEqual(self.get_index(serial_number).tag_ids, [])
+
+    def test_machine_tag_instance_deletion(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        serial_number = self.commit_machine_snapshot()
+        machine_tag = MachineTag.objects.create(serial_number=serial_number, tag=tag)
+        self.assertEqual(self.get_index(serial_number).tag_ids, [tag.pk])
+        machine_tag.delete()
+        self.assertEqual(self.get_index(serial_number).tag_ids, [])
+
+    def test_business_unit_meta_business_unit_change(self):
+        mbu1 = MetaBusinessUnit.objects.create(name=get_random_string(12))
+        mbu2 = MetaBusinessUnit.objects.create(name=get_random_string(12))
+        tag1 = Tag.objects.create(name=get_random_string(12))
+        tag2 = Tag.objects.create(name=get_random_string(12))
+        MetaBusinessUnitTag.objects.create(meta_business_unit=mbu1, tag=tag1)
+        MetaBusinessUnitTag.objects.create(meta_business_unit=mbu2, tag=tag2)
+        serial_number = self.commit_machine_snapshot(mbu1)
+        self.assertEqual(self.get_index(serial_number).tag_ids, [tag1.pk])
+        mbu1.businessunit_set.get().set_meta_business_unit(mbu2)
+        self.assertEqual(self.get_index(serial_number).tag_ids, [tag2.pk])
+        self.assertEqual(self.assertSameSearch(f"sf=t&t={tag1.pk}"), [])
+        self.assertEqual(self.assertSameSearch(f"sf=t&t={tag2.pk}"), [serial_number])
+
+    def test_compliance_check_statuses(self):
+        serial_number = self.commit_machine_snapshot()
+        cc1 = force_jmespath_check().compliance_check
+        cc2 = force_jmespath_check().compliance_check
+        update_machine_statuses(serial_number, [(cc1, Status.OK, datetime.utcnow()),
+                                                (cc2, Status.FAILED, datetime.utcnow())])
+        msi = self.get_index(serial_number)
+        self.assertEqual(msi.max_compliance_check_status, Status.FAILED.value)
+        self.assertEqual(msi.compliance_check_statuses, {str(cc1.pk): Status.OK.value,
+                                                         str(cc2.pk): Status.FAILED.value})
+        # new version → statuses out of date
+        cc2.version += 1
+        cc2.save()
+        msi.refresh_from_db()
+        self.assertEqual(msi.max_compliance_check_status, Status.OK.value)
+        self.assertEqual(msi.compliance_check_statuses, {str(cc1.pk): Status.OK.value})
+
+    def test_searches(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        cc = force_jmespath_check().compliance_check
+        serial_number1 = self.commit_machine_snapshot()
+        serial_number2 = self.commit_machine_snapshot()
+        serial_number3 = self.commit_machine_snapshot()
+        MachineTag.objects.create(serial_number=serial_number1, tag=tag)
+        update_machine_statuses(serial_number1, [(cc, Status.FAILED, datetime.utcnow())])
+        update_machine_statuses(serial_number2, [(cc, Status.OK, datetime.utcnow())])
+        self.assertTrue(MSQuery().use_search_index())
+        self.assertEqual(self.assertSameSearch(f"sf=t&t={tag.pk}"), [serial_number1])
+        serial_numbers = self.assertSameSearch("sf=t&t=\u2400")
+        self.assertNotIn(serial_number1, serial_numbers)
+        self.assertIn(serial_number3, serial_numbers)
+        self.assertEqual(self.assertSameSearch(f"sf=cs&cs={Status.FAILED.value}"), [serial_number1])
+        self.assertEqual(self.assertSameSearch(f"sf=ccs.{cc.pk}&ccs.{cc.pk}={Status.OK.value}"),
+                         [serial_number2])
+        serial_numbers = self.assertSameSearch(f"sf=t-cs-ccs.{cc.pk}")
+        self.assertTrue({serial_number1, serial_number2, serial_number3}.issubset(serial_numbers))
+
+    def test_date_time_filter_no_search_index(self):
+        msquery = MSQuery()
+        self.assertTrue(msquery.use_search_index())
+        msquery.filters[0].value = datetime.utcnow()
+        self.assertFalse(msquery.use_search_index())
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MSQueryGroupingCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        settings._collection["apps"]["zentral.contrib.inventory"]["search_facets_cache"] = ConfigDict(
+            {"ttl": 300, "max_stale_age": 60}
+        )
+
+    def tearDown(self):
+        settings._collection["apps"]["zentral.contrib.inventory"].pop("search_facets_cache", None)
+
+    # utils
+
+    def commit_machine_snapshot(self):
+        tree = {"source": {"module": "tests.zentral.io", "name": "Zentral Tests"},
+                "serial_number": get_random_string(12)}
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        return tree["serial_number"]
+
+    def count(self, query_string="sf=t"):
+        return MSQuery(QueryDict(query_string).copy()).count()
+
+    # tests
+
+    def test_generation(self):
+        generation = get_inventory_search_generation()
+        self.assertEqual(get_inventory_search_generation(), generation)
+        self.commit_machine_snapshot()
+        self.assertEqual(get_inventory_search_generation(), generation + 1)
+        tag = Tag.objects.create(name=get_random_string(12))
+        self.assertEqual(get_inventory_search_generation(), generation + 2)
+        MachineTag.objects.bulk_create([MachineTag(serial_number=get_random_string(12), tag=tag)])
+        self.assertEqual(get_inventory_search_generation(), generation + 3)
+        bump_inventory_search_generation()
+        self.assertEqual(get_inventory_search_generation(), generation + 4)
+        # evicted counter
+        cache.clear()
+        self.assertTrue(get_inventory_search_generation() > generation + 4)
+
+    def test_generation_bumped_again_after_commit(self):
+        generation = get_inventory_search_generation()
+        with self.captureOnCommitCallbacks() as callbacks:
+            Tag.objects.create(name=get_random_string(12))
+            self.assertEqual(get_inventory_search_generation(), generation + 1)
+        # the results cached before the commit with the new generation are invalidated
+        for callback in callbacks:
+            callback()
+        self.assertEqual(get_inventory_search_generation(), generation + 2)
+
+    def test_cache_disabled(self):
+        settings._collection["apps"]["zentral.contrib.inventory"]["search_facets_cache"] = ConfigDict({"ttl": 0})
+        count = self.count()
+        self.commit_machine_snapshot()
+        with patch("zentral.contrib.inventory.utils.msquery.get_inventory_search_generation") as gen:
+            self.assertEqual(self.count(), count + 1)
+        gen.assert_not_called()
+
+    def test_cache_hit(self):
+        count = self.count()
+        with patch("zentral.contrib.inventory.utils.msquery.MSQuery._make_grouping_query") as make_grouping_query:
+            self.assertEqual(self.count(), count)
+        make_grouping_query.assert_not_called()
+
+    @patch("zentral.contrib.inventory.tasks.refresh_msquery_grouping_results.apply_async")
+    def test_stale_results_background_refresh(self, apply_async):
+        count = self.count()
+        self.commit_machine_snapshot()
+        # stale
+        self.assertEqual(self.count(), count)
+        self.assertEqual(self.count(), count)
+        apply_async.assert_called_once()
+        urlencoded_query_dict, = apply_async.call_args.args[0]
+        # background refresh
+        from zentral.contrib.inventory.tasks import refresh_msquery_grouping_results
+        refresh_msquery_grouping_results(urlencoded_query_dict)
+        self.assertEqual(self.count(), count + 1)
+
+    def test_too_stale_results(self):
+        count = self.count()
+        self.commit_machine_snapshot()
+        cache_key = MSQuery(QueryDict("sf=t").copy())._get_grouping_cache_key()
+        generation, _, grouping_results = cache.get(cache_key)
+        cache.set(cache_key, (generation, time.time() - 61, grouping_results))
+        self.assertEqual(self.count(), count + 1)
+
+    def test_tag_change_invalidates_results(self):
+        settings._collection["apps"]["zentral.contrib.inventory"]["search_facets_cache"] = ConfigDict(
+            {"ttl": 300, "max_stale_age": 0}
+        )
+        serial_number = self.commit_machine_snapshot()
+        tag = Tag.objects.create(name=get_random_string(12))
+        query_string = f"sf=t&t={tag.pk}"
+        self.assertEqual(self.count(query_string), 0)
+        MachineTag.objects.create(serial_number=serial_number, tag=tag)
+        self.assertEqual(self.count(query_string), 1)
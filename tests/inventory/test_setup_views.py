@@ -357,7 +357,8 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        # audit event + inventory search generation bump
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "inventory/tag_index.html")
         self.assertContains(response, name)
         tag = response.context["tag_list"][0]
@@ -433,7 +434,8 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        # audit event + inventory search generation bump
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "inventory/tag_index.html")
         self.assertContains(response, updated_name)
         tag = response.context["tag_list"][0]
@@ -514,7 +516,8 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        # audit event + osquery conf & inventory search generation bumps
+        self.assertEqual(len(callbacks), 3)
         self.assertTemplateUsed(response, "inventory/tag_index.html")
         self.assertNotContains(response, tag.name)
         event = post_event.call_args_list[0].args[0]
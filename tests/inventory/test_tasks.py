@@ -17,3 +17,10 @@ class InventoryTasksTest(TestCase):
         second_event = post_event.call_args_list[1].args[0]
         self.assertIsInstance(second_event, InventoryCleanupFinished)
         self.assertEqual(second_event.payload["cleanup"]["days"], 17)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_cleanup_inventory_chunked(self, post_event):
+        result = cleanup_inventory(17, {}, chunked=True)
+        self.assertTrue(result["complete"])
+        self.assertTrue(all(tr["status"] == 0 and tr["complete"] for tr in result["tables"].values()))
+        self.assertEqual(len(post_event.call_args_list), 2)
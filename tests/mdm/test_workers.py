@@ -277,6 +277,73 @@ class MDMWorkersTestCase(TestCase):
         w = DevicesAPNSWorker()
         self.assertEqual(w.notification_leaky_bucket.rate, 10)
 
+    @patch("zentral.contrib.mdm.workers.settings")
+    def test_concurrency_value_error(self, settings):
+        settings.__getitem__.return_value = ConfigDict({
+            "zentral.contrib.mdm": {"apns": {"workers": {"concurrency": "A"}}}
+        })
+        with self.assertRaises(
+            ImproperlyConfigured,
+            msg="APNS workers concurrency and topic concurrency must be integers"
+        ):
+            DevicesAPNSWorker()
+
+    @patch("zentral.contrib.mdm.workers.settings")
+    def test_concurrency_min(self, settings):
+        settings.__getitem__.return_value = ConfigDict({
+            "zentral.contrib.mdm": {"apns": {"workers": {"concurrency": "0"}}}
+        })
+        w = DevicesAPNSWorker()
+        self.assertEqual(w.concurrency, 1)
+        self.assertEqual(w.topic_concurrency, 1)
+
+    @patch("zentral.contrib.mdm.workers.settings")
+    def test_concurrency_max(self, settings):
+        settings.__getitem__.return_value = ConfigDict({
+            "zentral.contrib.mdm": {"apns": {"workers": {"concurrency": "20000000"}}}
+        })
+        w = DevicesAPNSWorker()
+        self.assertEqual(w.concurrency, 100)
+        self.assertEqual(w.topic_concurrency, 100)
+
+    def test_concurrency_default(self):
+        w = DevicesAPNSWorker()
+        self.assertEqual(w.concurrency, 10)
+        self.assertEqual(w.topic_concurrency, 10)
+
+    @patch("zentral.contrib.mdm.workers.settings")
+    def test_topic_concurrency_value_error(self, settings):
+        settings.__getitem__.return_value = ConfigDict({
+            "zentral.contrib.mdm": {"apns": {"workers": {"topic_concurrency": "A"}}}
+        })
+        with self.assertRaises(
+            ImproperlyConfigured,
+            msg="APNS workers concurrency and topic concurrency must be integers"
+        ):
+            DevicesAPNSWorker()
+
+    @patch("zentral.contrib.mdm.workers.settings")
+    def test_topic_concurrency_max(self, settings):
+        settings.__getitem__.return_value = ConfigDict({
+            "zentral.contrib.mdm": {"apns": {"workers": {"concurrency": 5, "topic_concurrency": 8}}}
+        })
+        w = DevicesAPNSWorker()
+        self.assertEqual(w.concurrency, 5)
+        self.assertEqual(w.topic_concurrency, 5)
+
+    @patch("zentral.contrib.mdm.workers.settings")
+    def test_topic_semaphore(self, settings):
+        settings.__getitem__.return_value = ConfigDict({
+            "zentral.contrib.mdm": {"apns": {"workers": {"topic_concurrency": 2}}}
+        })
+        w = DevicesAPNSWorker()
+        semaphore = w.get_topic_semaphore("yolo")
+        self.assertIs(w.get_topic_semaphore("yolo"), semaphore)
+        self.assertIsNot(w.get_topic_semaphore("fomo"), semaphore)
+        self.assertTrue(semaphore.acquire(blocking=False))
+        self.assertTrue(semaphore.acquire(blocking=False))
+        self.assertFalse(semaphore.acquire(blocking=False))
+
     def test_get_workers(self):
         workers = list(get_workers())
         self.assertIsInstance(workers[0], DevicesAPNSWorker)
@@ -484,6 +551,54 @@ class MDMWorkersTestCase(TestCase):
             "apns_notification_sent", "device", "no_client"
         )
 
+    @patch("zentral.contrib.mdm.workers.apns_client_cache.get_or_create")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_devices_apns_worker_concurrent_notifications(self, post_event, get_or_create):
+        enrolled_devices = []
+        for _ in range(3):
+            session, _, _ = force_dep_enrollment_session(
+                self.mbu, authenticated=True, completed=True, push_certificate=self.push_certificate
+            )
+            enrolled_device = session.enrolled_device
+            enrolled_device.created_at -= timedelta(seconds=6)  # Old enough
+            enrolled_device.save()
+            enrolled_devices.append(enrolled_device)
+        failing_push_magic = enrolled_devices[1].push_magic
+
+        def send_notification(token, push_magic, **kwargs):
+            if push_magic == failing_push_magic:
+                raise ValueError("YOLO")
+            return True
+
+        client = Mock()
+        client.send_notification.side_effect = send_notification
+        get_or_create.return_value = client
+        metrics_exporter = Mock()
+        w = DevicesAPNSWorker()
+        with self.assertLogs("zentral.contrib.mdm.workers", level="ERROR"):
+            w.run(metrics_exporter=metrics_exporter, only_once=True)
+        self.assertIsNone(w._executor)
+        self.assertEqual(client.send_notification.call_count, 3)
+        for enrolled_device in enrolled_devices:
+            enrolled_device.refresh_from_db()
+            self.assertIsNone(enrolled_device.notification_queued_at)
+            if enrolled_device.push_magic == failing_push_magic:
+                self.assertIsNone(enrolled_device.last_notified_at)
+            else:
+                self.assertIsNotNone(enrolled_device.last_notified_at)
+        self.assertEqual(
+            sorted((e.metadata.machine_serial_number, e.payload["status"])
+                   for e in (c.args[0] for c in post_event.call_args_list)),
+            sorted((ed.serial_number, "failure" if ed.push_magic == failing_push_magic else "success")
+                   for ed in enrolled_devices)
+        )
+        self.assertEqual(
+            sorted(c.args for c in metrics_exporter.inc.call_args_list),
+            [("apns_notification_sent", "device", "failure"),
+             ("apns_notification_sent", "device", "success"),
+             ("apns_notification_sent", "device", "success")]
+        )
+
     # user
 
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
@@ -1274,4 +1274,5 @@ class APIViewsTestCase(TestCase):
         metadata = event.metadata.serialize()
         self.assertEqual(metadata["objects"], {"munki_script_check": [str(prev_pk)]})
         self.assertEqual(sorted(metadata["tags"]), ["munki", "zentral"])
-        self.assertEqual(len(callbacks), 1)
+        # audit event + osquery conf generation bump
+        self.assertEqual(len(callbacks), 2)
@@ -670,7 +670,8 @@ class MunkiAPIViewsTestCase(TestCase):
                                             }]},
                                           HTTP_AUTHORIZATION="MunkiEnrolledMachine {}".format(enrolled_machine.token))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        # compliance check status events + inventory search generation bump
+        self.assertEqual(len(callbacks), 2)
 
         # check all events
         status_updated_event = None
@@ -527,7 +527,8 @@ class MunkiScriptCheckViewsTestCase(TestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.post(reverse("munki:delete_script_check", args=(sc.pk,)), follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        # audit event + osquery conf generation bump
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "munki/scriptcheck_list.html")
         self.assertNotContains(response, prev_name)
         self.assertFalse(ScriptCheck.objects.filter(pk=prev_pk).exists())
@@ -0,0 +1,175 @@
+import csv
+from datetime import datetime
+import json
+import os
+from unittest.mock import patch
+import zipfile
+from django.db import connection
+from django.test import TestCase
+from django.utils.crypto import get_random_string
+from zentral.contrib.osquery.models import DistributedQuery, DistributedQueryResult
+from zentral.contrib.osquery.tasks import (_export_dqr_to_tmp_csv_file,
+                                           _export_dqr_to_tmp_ndjson_file,
+                                           _export_dqr_to_tmp_xlsx_file)
+
+
+class OsqueryDistributedQueryResultsTestCase(TestCase):
+    # utils
+
+    def force_distributed_query(self):
+        return DistributedQuery.objects.create(sql="select * from processes;",
+                                               valid_from=datetime.utcnow(),
+                                               query_version=1)
+
+    def force_results(self, distributed_query):
+        serial_number = get_random_string(12)
+        DistributedQueryResult.objects.bulk_insert(
+            serial_number,
+            [(distributed_query.pk, {"name": "launchd", "pid": "1"}),
+             (distributed_query.pk, {"name": "=1+1", "path": "/sbin/launchd\u0000"})]
+        )
+        distributed_query.refresh_from_db()
+        return serial_number
+
+    def get_partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute("select inhrelid::regclass::text from pg_inherits "
+                           "where inhparent = 'osquery_distributedqueryresult'::regclass")
+            return set(t[0] for t in cursor.fetchall())
+
+    def read_tmp_file(self, tmp_fp, mode="r"):
+        self.addCleanup(os.unlink, tmp_fp)
+        with open(tmp_fp, mode) as f:
+            return f.read()
+
+    # tests
+
+    def test_partition_created_and_dropped(self):
+        dq = self.force_distributed_query()
+        partition = f"osquery_distributedqueryresult_{dq.pk}"
+        self.assertIn(partition, self.get_partitions())
+        self.assertIn("osquery_distributedqueryresult_default", self.get_partitions())
+        self.force_results(dq)
+        self.assertEqual(DistributedQueryResult.objects.filter(distributed_query=dq).count(), 2)
+        dq.delete()
+        self.assertNotIn(partition, self.get_partitions())
+
+    @patch("zentral.contrib.osquery.models.DROP_PARTITION_LOCK_TIMEOUT", "100ms")
+    def test_partition_drop_lock_timeout(self):
+        # the committed partition of a distributed query that does not exist anymore, locked by another connection
+        other_connection = connection.copy()
+        orphan_partition = "osquery_distributedqueryresult_2147483647"
+
+        def drop_orphan_partition():
+            with other_connection.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {orphan_partition}")
+            other_connection.close()
+
+        self.addClassCleanup(drop_orphan_partition)
+        with other_connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {orphan_partition} "
+                           "PARTITION OF osquery_distributedqueryresult FOR VALUES IN (2147483647)")
+            cursor.execute(f"BEGIN; LOCK TABLE {orphan_partition} IN ACCESS SHARE MODE")
+        dq = self.force_distributed_query()
+        dq_pk = dq.pk
+        partition = f"osquery_distributedqueryresult_{dq_pk}"
+        self.force_results(dq)
+        with self.assertLogs("zentral.contrib.osquery.models", level="WARNING") as cm:
+            dq.delete()
+        self.assertEqual(cm.output, [f"WARNING:zentral.contrib.osquery.models:Could not drop distributed query "
+                                     f"{dq_pk} result partition: lock timeout"])
+        # the results are deleted, the partitions are left behind
+        self.assertEqual(DistributedQueryResult.objects.filter(distributed_query_id=dq_pk).count(), 0)
+        partitions = self.get_partitions()
+        self.assertIn(orphan_partition, partitions)
+        self.assertIn(partition, partitions)
+        # the lock timeout is restored
+        with connection.cursor() as cursor:
+            cursor.execute("show lock_timeout")
+            self.assertEqual(cursor.fetchone()[0], "0")
+        # the partitions left behind are dropped with the next one
+        with other_connection.cursor() as cursor:
+            cursor.execute("COMMIT")
+        dq2 = self.force_distributed_query()
+        partition2 = f"osquery_distributedqueryresult_{dq2.pk}"
+        self.assertIn(partition2, self.get_partitions())
+        dq2.delete()
+        partitions = self.get_partitions()
+        self.assertNotIn(orphan_partition, partitions)
+        self.assertNotIn(partition, partitions)
+        self.assertNotIn(partition2, partitions)
+        self.assertIn("osquery_distributedqueryresult_default", partitions)
+
+    def test_bulk_create_partitions(self):
+        dqs = DistributedQuery.objects.bulk_create(
+            [DistributedQuery(sql="select * from processes;", valid_from=datetime.utcnow(), query_version=1)
+             for _ in range(2)]
+        )
+        partitions = self.get_partitions()
+        for dq in dqs:
+            self.assertIn(f"osquery_distributedqueryresult_{dq.pk}", partitions)
+            self.force_results(dq)
+            self.assertEqual(DistributedQueryResult.objects.filter(distributed_query=dq).count(), 2)
+
+    def test_bulk_insert_result_column_names(self):
+        dq = self.force_distributed_query()
+        self.assertEqual(dq.result_column_names, [])
+        serial_number = self.force_results(dq)
+        dq.refresh_from_db()
+        self.assertEqual(dq.result_column_names, ["name", "path", "pid"])
+        self.assertEqual(dq.result_columns(), ["name", "path", "pid"])
+        self.assertEqual(
+            sorted(DistributedQueryResult.objects.filter(serial_number=serial_number)
+                                                 .values_list("row__name", flat=True)),
+            ["=1+1", "launchd"]
+        )
+        DistributedQueryResult.objects.bulk_insert(get_random_string(12), [(dq.pk, {"uid": "0", "pid": "2"})])
+        dq.refresh_from_db()
+        self.assertEqual(dq.result_column_names, ["name", "path", "pid", "uid"])
+
+    def test_legacy_result_columns(self):
+        dq = self.force_distributed_query()
+        self.force_results(dq)
+        DistributedQuery.objects.filter(pk=dq.pk).update(result_column_names=None)
+        dq.refresh_from_db()
+        self.assertEqual(dq.result_columns(), ["name", "path", "pid"])
+        # not recorded anymore
+        DistributedQueryResult.objects.bulk_insert(get_random_string(12), [(dq.pk, {"uid": "0"})])
+        dq.refresh_from_db()
+        self.assertIsNone(dq.result_column_names)
+        self.assertEqual(dq.result_columns(), ["name", "path", "pid", "uid"])
+
+    def test_csv_export(self):
+        dq = self.force_distributed_query()
+        serial_number = self.force_results(dq)
+        rows = list(csv.reader(self.read_tmp_file(_export_dqr_to_tmp_csv_file(dq)).splitlines()))
+        self.assertEqual(rows[0], ["serial number", "name", "path", "pid"])
+        self.assertEqual(sorted(rows[1:]),
+                         [[serial_number, "=1+1", "/sbin/launchd", ""],
+                          [serial_number, "launchd", "", "1"]])
+
+    def test_ndjson_export(self):
+        dq = self.force_distributed_query()
+        serial_number = self.force_results(dq)
+        lines = self.read_tmp_file(_export_dqr_to_tmp_ndjson_file(dq)).splitlines()
+        self.assertEqual(
+            sorted((json.loads(line) for line in lines), key=lambda d: d["row"]["name"]),
+            [{"serial_number": serial_number, "row": {"name": "=1+1", "path": "/sbin/launchd"}},
+             {"serial_number": serial_number, "row": {"name": "launchd", "pid": "1"}}]
+        )
+
+    def test_xlsx_export(self):
+        dq = self.force_distributed_query()
+        serial_number = self.force_results(dq)
+        tmp_fp = _export_dqr_to_tmp_xlsx_file(dq)
+        self.addCleanup(os.unlink, tmp_fp)
+        with zipfile.ZipFile(tmp_fp, mode="r") as zf:
+            sheet = zf.read("xl/worksheets/sheet1.xml").decode("utf-8")
+        # constant memory mode → inline strings
+        for val in ("serial number", "name", "path", "pid", serial_number, "launchd", "/sbin/launchd"):
+            self.assertIn(f"<t>{val}</t>", sheet)
+        # 3 rows, 1 header + 2 results
+        self.assertEqual(sheet.count("<row "), 3)
+        # no formulas
+        self.assertIn("<t>=1+1</t>", sheet)
+        self.assertNotIn("<f>", sheet)
@@ -1,8 +1,10 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 from unittest.mock import patch
 import uuid
+from django.db import connection, IntegrityError
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, NoReverseMatch
 from django.utils.crypto import get_random_string
 from django.utils.text import slugify
@@ -12,11 +14,12 @@ from zentral.contrib.inventory.models import EnrollmentSecret, MachineSnapshot,
 from zentral.contrib.osquery.compliance_checks import sync_query_compliance_check
 from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME
 from zentral.contrib.osquery.events import (OsqueryEnrollmentEvent, OsqueryRequestEvent, OsqueryResultEvent,
-                                            OsqueryCheckStatusUpdated, OsqueryFileCarvingEvent)
+                                            OsqueryCheckStatusUpdated, OsqueryFileCarvingEvent, OsqueryStatusEvent)
 from zentral.contrib.osquery.models import (Configuration, ConfigurationPack,
                                             DistributedQuery, DistributedQueryMachine, DistributedQueryResult,
                                             EnrolledMachine, Enrollment, FileCarvingSession,
                                             Query, Pack, PackQuery)
+from zentral.contrib.osquery.preprocessors import get_preprocessors
 from zentral.contrib.osquery.views.utils import update_tree_with_inventory_query_snapshot
 from zentral.core.compliance_checks.models import MachineStatus, Status
 
@@ -451,6 +454,56 @@ class OsqueryAPIViewsTestCase(TestCase):
                         'removed': False}}}}
         )
 
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_config_cached(self, post_event):
+        _, pack, _ = self.force_query(force_pack=True)
+        ConfigurationPack.objects.create(configuration=self.configuration, pack=pack)
+        em = self.force_enrolled_machine()
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.json()["packs"].keys()), [pack.configuration_key()])
+        # other machine with the same configuration, tags and platform → cached conf
+        em2 = self.force_enrolled_machine()
+        with CaptureQueriesContext(connection) as ctx:
+            response2 = self.post_as_json("config", {"node_key": em2.node_key})
+        self.assertEqual(response2.status_code, 200)
+        self.assertFalse(any("osquery_pack" in q["sql"] for q in ctx.captured_queries))
+        # same output → skipped by osquery
+        self.assertEqual(response.content, response2.content)
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_config_cache_invalidation(self, post_event):
+        query, pack, _ = self.force_query(force_pack=True)
+        cp = ConfigurationPack.objects.create(configuration=self.configuration, pack=pack)
+        em = self.force_enrolled_machine()
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertIn(pack.configuration_key(), response.json()["packs"])
+        # pack query updated
+        pack_query = query.packquery
+        pack_query.interval = 4321
+        pack_query.save()
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        pack_conf = response.json()["packs"][pack.configuration_key()]
+        self.assertEqual([d["interval"] for d in pack_conf["queries"].values()], [4321])
+        # configuration pack restricted to a tag
+        tag = Tag.objects.create(name=get_random_string(12))
+        cp.tags.add(tag)
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertNotIn("packs", response.json())
+        # machine tagged
+        MachineTag.objects.create(serial_number=em.serial_number, tag=tag)
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertIn(pack.configuration_key(), response.json()["packs"])
+        # tag deleted → configuration pack not restricted anymore
+        em2 = self.force_enrolled_machine()
+        response = self.post_as_json("config", {"node_key": em2.node_key})
+        self.assertNotIn("packs", response.json())
+        tag.delete()
+        response = self.post_as_json("config", {"node_key": em2.node_key})
+        self.assertIn(pack.configuration_key(), response.json()["packs"])
+
     def test_config_disable_carver_true_str(self):
         self.configuration.options = {"disable_carver": "true"}
         self.configuration.save()
@@ -813,6 +866,51 @@ class OsqueryAPIViewsTestCase(TestCase):
         self.assertEqual(json_response, {"queries": {}})
         self.assertEqual(dqm_qs.count(), 2)
 
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_distributed_read_nothing_new_cached(self, post_event):
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(list(response.json()["queries"].values()), [dq.sql])
+        # the distributed query machine is found in the DB
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(response.json(), {"queries": {}})
+        # the distributed query is known to be done for this machine → no DB query
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(response.json(), {"queries": {}})
+        self.assertFalse(any("osquery_distributedquery" in q["sql"] for q in ctx.captured_queries))
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_distributed_read_index_invalidation(self, post_event):
+        em = self.force_enrolled_machine()
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(response.json(), {"queries": {}})
+        # new distributed query
+        tag = Tag.objects.create(name=get_random_string(12))
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        # tag added → machine not targeted anymore
+        dq.tags.add(tag)
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(response.json(), {"queries": {}})
+        # tag removed, but expired
+        dq.tags.remove(tag)
+        dq.valid_until = datetime.utcnow() - timedelta(seconds=1)
+        dq.save()
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(response.json(), {"queries": {}})
+        # valid again
+        dq.valid_until = datetime.utcnow() + timedelta(hours=1)
+        dq.save()
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(list(response.json()["queries"].values()), [dq.sql])
+
     def test_distributed_write_405(self):
         response = self.client.get(reverse("osquery_public:distributed_write"))
         self.assertEqual(response.status_code, 405)
@@ -846,6 +944,130 @@ class OsqueryAPIViewsTestCase(TestCase):
         ms_qs = MachineStatus.objects.filter(serial_number=em.serial_number)
         self.assertEqual(ms_qs.count(), 0)
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_distributed_write_statuses_and_results(self, post_event):
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        dqm = DistributedQueryMachine.objects.create(distributed_query=dq, serial_number=em.serial_number)
+        dq2 = DistributedQuery.objects.create(sql="select yolo from users;",
+                                              valid_from=datetime.utcnow(),
+                                              query_version=1)
+        dqm2 = DistributedQueryMachine.objects.create(distributed_query=dq2, serial_number=em.serial_number)
+        rows = [{"username": 'god"zilla\u0000'},
+                {"username": "fomo,\nyolo"}]
+        response = self.post_as_json("distributed_write",
+                                     {"node_key": em.node_key,
+                                      "queries": {str(dqm.pk): rows},
+                                      "statuses": {str(dqm.pk): 0, str(dqm2.pk): 1},
+                                      "messages": {str(dqm2.pk): "no such column: yolo"},
+                                      "stats": {str(dqm.pk): {"memory": "1234",
+                                                              "system_time": 1,
+                                                              "user_time": "2",
+                                                              "wall_time_ms": "yolo"}}})
+        self.assertEqual(response.status_code, 200)
+        dqm.refresh_from_db()
+        self.assertEqual(dqm.status, 0)
+        self.assertIsNone(dqm.error_message)
+        self.assertEqual(dqm.memory, 1234)
+        self.assertEqual(dqm.system_time, 1)
+        self.assertEqual(dqm.user_time, 2)
+        self.assertIsNone(dqm.wall_time_ms)
+        self.assertTrue(dqm.updated_at > dqm.created_at)
+        dqm2.refresh_from_db()
+        self.assertEqual(dqm2.status, 1)
+        self.assertEqual(dqm2.error_message, "no such column: yolo")
+        dqr_qs = DistributedQueryResult.objects.filter(distributed_query=dq, serial_number=em.serial_number)
+        self.assertEqual(sorted(dqr.row["username"] for dqr in dqr_qs), ['fomo,\nyolo', 'god"zilla'])
+        self.assertFalse(DistributedQueryResult.objects.filter(distributed_query=dq2).exists())
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_raw_event")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_distributed_write_async_results(self, post_event, post_raw_event):
+        settings._collection["apps"]["zentral.contrib.osquery"]["async_distributed_query_results"] = True
+        self.addCleanup(settings._collection["apps"]["zentral.contrib.osquery"].pop,
+                        "async_distributed_query_results")
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        dqm = DistributedQueryMachine.objects.create(distributed_query=dq, serial_number=em.serial_number)
+        response = self.post_as_json("distributed_write",
+                                     {"node_key": em.node_key,
+                                      "queries": {str(dqm.pk): [{"username": "godzilla"}]},
+                                      "statuses": {str(dqm.pk): 0}})
+        self.assertEqual(response.status_code, 200)
+        dqm.refresh_from_db()
+        self.assertEqual(dqm.status, 0)
+        dqr_qs = DistributedQueryResult.objects.filter(distributed_query=dq, serial_number=em.serial_number)
+        self.assertEqual(dqr_qs.count(), 0)
+        post_raw_event.assert_called_once()
+        routing_key, raw_event = post_raw_event.call_args.args
+        self.assertEqual(routing_key, "osquery_distributed_query_results")
+        self.assertEqual(raw_event, {"serial_number": em.serial_number,
+                                     "results": [(dq.pk, {"username": "godzilla"})]})
+        # preprocessor
+        preprocessor = list(get_preprocessors())[0]
+        self.assertEqual(preprocessor.routing_key, routing_key)
+        self.assertEqual(list(preprocessor.process_raw_event(json.loads(json.dumps(raw_event)))), [])
+        self.assertEqual(dqr_qs.count(), 1)
+        self.assertEqual(dqr_qs.first().row, {"username": "godzilla"})
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_raw_event")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_distributed_write_async_results_chunked_by_size(self, post_event, post_raw_event):
+        settings._collection["apps"]["zentral.contrib.osquery"]["async_distributed_query_results"] = True
+        self.addCleanup(settings._collection["apps"]["zentral.contrib.osquery"].pop,
+                        "async_distributed_query_results")
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        dqm = DistributedQueryMachine.objects.create(distributed_query=dq, serial_number=em.serial_number)
+        rows = [{"username": get_random_string(50 * 1024)} for _ in range(10)]
+        response = self.post_as_json("distributed_write",
+                                     {"node_key": em.node_key,
+                                      "queries": {str(dqm.pk): rows},
+                                      "statuses": {str(dqm.pk): 0}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(post_raw_event.call_count, 4)
+        posted_rows = []
+        for call_args in post_raw_event.call_args_list:
+            _, raw_event = call_args.args
+            self.assertLess(len(json.dumps(raw_event)), 256 * 1024)
+            posted_rows.extend(row for _, row in raw_event["results"])
+        self.assertEqual(posted_rows, rows)
+
+    def test_distributed_query_results_preprocessor_deleted_distributed_query(self):
+        serial_number = get_random_string(12)
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        dq2 = DistributedQuery.objects.create(sql="select username from users;",
+                                              valid_from=datetime.utcnow(),
+                                              query_version=1)
+        raw_event = {"serial_number": serial_number,
+                     "results": [[dq.pk, {"username": "godzilla"}],
+                                 [dq2.pk, {"username": "yolo"}]]}
+        dq2.delete()
+        preprocessor = list(get_preprocessors())[0]
+        with self.assertLogs("zentral.contrib.osquery.models", level="WARNING"):
+            self.assertEqual(list(preprocessor.process_raw_event(raw_event)), [])
+        self.assertEqual(
+            list(DistributedQueryResult.objects.filter(serial_number=serial_number)
+                                               .values_list("distributed_query_id", "row")),
+            [(dq.pk, {"username": "godzilla"})]
+        )
+
+    def test_distributed_query_results_preprocessor_error(self):
+        preprocessor = list(get_preprocessors())[0]
+        with patch("zentral.contrib.osquery.models.DistributedQueryResultManager.bulk_insert",
+                   side_effect=IntegrityError("YOLO")):
+            with self.assertLogs("zentral.contrib.osquery.preprocessors", level="ERROR"):
+                self.assertEqual(list(preprocessor.process_raw_event({"serial_number": get_random_string(12),
+                                                                      "results": [[1, {}]]})), [])
+
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
     def test_distributed_write_one_carve(self, post_event):
         query, _, distributed_query = self.force_query(force_distributed_query=True)
@@ -1319,6 +1541,155 @@ class OsqueryAPIViewsTestCase(TestCase):
                          {"osquery_pack": [(pack.pk,)],
                           "osquery_query": [(query.pk,)]})
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_raw_event")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_log_async_result(self, post_event, post_raw_event):
+        settings._collection["apps"]["zentral.contrib.osquery"]["async_logs"] = True
+        self.addCleanup(settings._collection["apps"]["zentral.contrib.osquery"].pop, "async_logs")
+        em = self.force_enrolled_machine()
+        query, pack, _ = self.force_query(force_pack=True)
+        carve_guid = uuid.uuid4()
+        post_data = {
+            "node_key": em.node_key,
+            "log_type": "result",
+            "data": [
+                {'name': Pack.DELIMITER.join(['pack', pack.configuration_key(), query.packquery.pack_key()]),
+                 'action': 'added',
+                 "columns": {
+                     'carve': '1',
+                     'carve_guid': str(carve_guid),
+                     'path': '/var/db/santa/rules.db',
+                     'status': 'SCHEDULED',
+                 },
+                 'unixTime': '1480605738',
+                 'decorations': {'serial_number': em.serial_number, 'version': '5.9.1'}},
+                {'action': 'snapshot',
+                 "name": INVENTORY_QUERY_NAME,
+                 "snapshot": self.get_default_inventory_query_snapshot("macos"),
+                 'unixTime': '1480605737',
+                 'decorations': {'serial_number': em.serial_number, 'version': '5.9.1'}},
+            ]
+        }
+        response = self.post_as_json("log", post_data)
+        self.assertEqual(response.json(), {})
+        # only the request event
+        self.assertEqual(len(post_event.call_args_list), 1)
+        self.assertIsInstance(post_event.call_args.args[0], OsqueryRequestEvent)
+        # nothing processed yet
+        self.assertFalse(FileCarvingSession.objects.filter(carve_guid=carve_guid).exists())
+        self.assertFalse(MachineSnapshot.objects.filter(serial_number=em.serial_number).exists())
+        em.refresh_from_db()
+        self.assertEqual(em.osquery_version, "1.2.3")
+        post_raw_event.assert_called_once()
+        routing_key, raw_event = post_raw_event.call_args.args
+        self.assertEqual(routing_key, "osquery_logs")
+        self.assertEqual(raw_event["enrolled_machine"], {"pk": em.pk, "serial_number": em.serial_number})
+        self.assertEqual(raw_event["log_type"], "result")
+        self.assertEqual(len(raw_event["records"]), 2)
+        # preprocessor
+        preprocessor = list(get_preprocessors())[1]
+        self.assertEqual(preprocessor.routing_key, routing_key)
+        events = list(preprocessor.process_raw_event(json.loads(json.dumps(raw_event))))
+        em.refresh_from_db()
+        self.assertEqual(em.osquery_version, "5.9.1")
+        ms = MachineSnapshot.objects.current().get(serial_number=em.serial_number, reference=em.node_key)
+        self.assertEqual(ms.os_version.name, "macOS")
+        fcs = FileCarvingSession.objects.get(carve_guid=carve_guid)
+        self.assertEqual(fcs.serial_number, em.serial_number)
+        self.assertEqual(fcs.pack_query.query, query)
+        file_carving_event = events[0]
+        self.assertIsInstance(file_carving_event, OsqueryFileCarvingEvent)
+        self.assertEqual(file_carving_event.payload["session_id"], str(fcs.pk))
+        self.assertIn("inventory_heartbeat", [e.event_type for e in events])
+        result_event = events[-1]
+        self.assertIsInstance(result_event, OsqueryResultEvent)
+        self.assertEqual(result_event.metadata.machine_serial_number, em.serial_number)
+        self.assertEqual(result_event.metadata.request.ip, raw_event["request"]["ip"])
+        self.assertEqual(result_event.get_linked_objects_keys(),
+                         {"osquery_pack": [(pack.pk,)],
+                          "osquery_query": [(query.pk,)]})
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_raw_event")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_log_async_result_chunked_by_size(self, post_event, post_raw_event):
+        settings._collection["apps"]["zentral.contrib.osquery"]["async_logs"] = True
+        self.addCleanup(settings._collection["apps"]["zentral.contrib.osquery"].pop, "async_logs")
+        em = self.force_enrolled_machine()
+        query, pack, _ = self.force_query(force_pack=True)
+        decorations = {'serial_number': em.serial_number, 'version': '5.9.1'}
+        records = [
+            {'name': Pack.DELIMITER.join(['pack', pack.configuration_key(), query.packquery.pack_key()]),
+             'action': 'added',
+             'columns': {'data': get_random_string(50 * 1024)},
+             'unixTime': str(1480605740 + i),
+             'decorations': decorations}
+            for i in range(10)
+        ]
+        # two inventory snapshots, only the last one is kept
+        for unix_time in ('1480605737', '1480605738'):
+            records.append({'action': 'snapshot',
+                            'name': INVENTORY_QUERY_NAME,
+                            'snapshot': self.get_default_inventory_query_snapshot("macos"),
+                            'unixTime': unix_time,
+                            'decorations': decorations})
+        response = self.post_as_json("log", {"node_key": em.node_key, "log_type": "result", "data": records})
+        self.assertEqual(response.json(), {})
+        self.assertEqual(post_raw_event.call_count, 4)
+        posted_records = []
+        for call_args in post_raw_event.call_args_list:
+            routing_key, raw_event = call_args.args
+            self.assertEqual(routing_key, "osquery_logs")
+            self.assertLess(len(json.dumps(raw_event)), 256 * 1024)
+            self.assertEqual(raw_event["log_type"], "result")
+            posted_records.extend(raw_event["records"])
+        self.assertEqual([r["unixTime"] for r in posted_records],
+                         ['1480605738'] + [str(1480605740 + i) for i in range(10)])
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_raw_event")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_log_async_status(self, post_event, post_raw_event):
+        settings._collection["apps"]["zentral.contrib.osquery"]["async_logs"] = True
+        self.addCleanup(settings._collection["apps"]["zentral.contrib.osquery"].pop, "async_logs")
+        em = self.force_enrolled_machine()
+        post_data = {
+            "node_key": em.node_key,
+            "log_type": "status",
+            "data": [
+                {'filename': 'scheduler.cpp',
+                 'line': '63',
+                 'message': 'Executing scheduled query',
+                 'severity': '0',
+                 'version': '2.1.2',
+                 'unixTime': '1480605737'}
+            ]
+        }
+        response = self.post_as_json("log", post_data)
+        self.assertEqual(response.json(), {})
+        routing_key, raw_event = post_raw_event.call_args.args
+        preprocessor = list(get_preprocessors())[1]
+        events = list(preprocessor.process_raw_event(json.loads(json.dumps(raw_event))))
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0], OsqueryStatusEvent)
+        self.assertEqual(events[0].payload["message"], "Executing scheduled query")
+        self.assertEqual(events[0].metadata.created_at, datetime(2016, 12, 1, 15, 22, 17))
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_log_async_machine_conflict(self, post_event):
+        settings._collection["apps"]["zentral.contrib.osquery"]["async_logs"] = True
+        self.addCleanup(settings._collection["apps"]["zentral.contrib.osquery"].pop, "async_logs")
+        em = self.force_enrolled_machine()
+        post_data = {
+            "node_key": em.node_key,
+            "log_type": "status",
+            "data": [
+                {'message': 'Executing scheduled query',
+                 'unixTime': '1480605737',
+                 'decorations': {'serial_number': get_random_string(63)}}
+            ]
+        }
+        response = self.post_as_json("log", post_data)
+        self.assertContains(response, '{"node_invalid": true}', status_code=200)
+
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
     def test_log_snapshot_result(self, post_event):
         em = self.force_enrolled_machine()
@@ -1414,8 +1785,9 @@ class OsqueryAPIViewsTestCase(TestCase):
                          {"osquery_pack": [(pack.pk,)],
                           "osquery_query": [(query.pk,)]})
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
-    def test_log_snapshot_result_with_compliance_check(self, post_event):
+    def test_log_snapshot_result_with_compliance_check(self, post_event, post_events):
         em = self.force_enrolled_machine()
         query1, pack1, _ = self.force_query(force_pack=True, force_compliance_check=True)
         status_time0 = datetime(2021, 12, 23)
@@ -1468,17 +1840,20 @@ class OsqueryAPIViewsTestCase(TestCase):
         self.assertEqual(ms2.status_time, status_time2)
         self.assertEqual(ms2.status, Status.UNKNOWN.value)
         events = list(call_args.args[0] for call_args in post_event.call_args_list)
-        self.assertEqual(len(events), 6)
+        self.assertEqual(len(events), 3)
         request_event = events[0]
         self.assertIsInstance(request_event, OsqueryRequestEvent)
         self.assertEqual(request_event.payload["request_type"], "log")
-        for event_idx, result_event in enumerate(events[1:4]):
+        post_events.assert_called_once()
+        result_events = list(post_events.call_args.args[0])
+        self.assertEqual(len(result_events), 3)
+        for event_idx, result_event in enumerate(result_events):
             self.assertIsInstance(result_event, OsqueryResultEvent)
             if event_idx == 2:
                 self.assertEqual(result_event.metadata.routing_key, event_routing_key)
             else:
                 self.assertIsNone(result_event.metadata.routing_key)
-        for cc_status_event in events[4:]:
+        for cc_status_event in events[1:]:
             self.assertIsInstance(cc_status_event, OsqueryCheckStatusUpdated)
             if cc_status_event.payload["status"] == Status.UNKNOWN.name:
                 self.assertEqual(cc_status_event.payload["osquery_query"], {"pk": query2.pk})
@@ -1496,8 +1871,9 @@ class OsqueryAPIViewsTestCase(TestCase):
                                   "osquery_pack": [(pack1.pk,)],
                                   "osquery_query": [(query1.pk,)]})
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
-    def test_log_snapshot_result_with_added_tag_check(self, post_event):
+    def test_log_snapshot_result_with_added_tag_check(self, post_event, post_events):
         em = self.force_enrolled_machine()
         query1, pack1, _ = self.force_query(force_pack=True, force_tag=True)
         self.assertEqual(MachineTag.objects.filter(tag=query1.tag, serial_number=em.serial_number).count(), 0)
@@ -1524,15 +1900,19 @@ class OsqueryAPIViewsTestCase(TestCase):
         self.assertEqual(json_response, {})
         self.assertEqual(MachineTag.objects.filter(tag=query1.tag, serial_number=em.serial_number).count(), 1)
         events = list(call_args.args[0] for call_args in post_event.call_args_list)
-        self.assertEqual(len(events), 3)
+        self.assertEqual(len(events), 1)
         request_event = events[0]
         self.assertIsInstance(request_event, OsqueryRequestEvent)
         self.assertEqual(request_event.payload["request_type"], "log")
-        for event_idx, result_event in enumerate(events[1:]):
+        post_events.assert_called_once()
+        result_events = list(post_events.call_args.args[0])
+        self.assertEqual(len(result_events), 2)
+        for result_event in result_events:
             self.assertIsInstance(result_event, OsqueryResultEvent)
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
-    def test_log_snapshot_result_with_query_outdated_no_added_tag_check(self, post_event):
+    def test_log_snapshot_result_with_query_outdated_no_added_tag_check(self, post_event, post_events):
         em = self.force_enrolled_machine()
         query1, pack1, _ = self.force_query(force_pack=True, force_tag=True)
         self.assertEqual(MachineTag.objects.filter(tag=query1.tag, serial_number=em.serial_number).count(), 0)
@@ -1561,15 +1941,19 @@ class OsqueryAPIViewsTestCase(TestCase):
         self.assertEqual(json_response, {})
         self.assertEqual(MachineTag.objects.filter(tag=query1.tag, serial_number=em.serial_number).count(), 0)
         events = list(call_args.args[0] for call_args in post_event.call_args_list)
-        self.assertEqual(len(events), 3)
+        self.assertEqual(len(events), 1)
         request_event = events[0]
         self.assertIsInstance(request_event, OsqueryRequestEvent)
         self.assertEqual(request_event.payload["request_type"], "log")
-        for event_idx, result_event in enumerate(events[1:]):
+        post_events.assert_called_once()
+        result_events = list(post_events.call_args.args[0])
+        self.assertEqual(len(result_events), 2)
+        for result_event in result_events:
             self.assertIsInstance(result_event, OsqueryResultEvent)
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_events")
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
-    def test_log_snapshot_result_with_removed_tag_check(self, post_event):
+    def test_log_snapshot_result_with_removed_tag_check(self, post_event, post_events):
         em = self.force_enrolled_machine()
         query1, pack1, _ = self.force_query(force_pack=True, force_tag=True)
         MachineTag.objects.create(tag=query1.tag, serial_number=em.serial_number)
@@ -1596,11 +1980,14 @@ class OsqueryAPIViewsTestCase(TestCase):
         self.assertEqual(json_response, {})
         self.assertEqual(MachineTag.objects.filter(tag=query1.tag, serial_number=em.serial_number).count(), 0)
         events = list(call_args.args[0] for call_args in post_event.call_args_list)
-        self.assertEqual(len(events), 3)
+        self.assertEqual(len(events), 1)
         request_event = events[0]
         self.assertIsInstance(request_event, OsqueryRequestEvent)
         self.assertEqual(request_event.payload["request_type"], "log")
-        for event_idx, result_event in enumerate(events[1:]):
+        post_events.assert_called_once()
+        result_events = list(post_events.call_args.args[0])
+        self.assertEqual(len(result_events), 2)
+        for result_event in result_events:
             self.assertIsInstance(result_event, OsqueryResultEvent)
 
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
@@ -9,6 +9,7 @@ from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils.crypto import get_random_string
 from accounts.models import User
+from zentral.contrib.osquery.forms import DistributedQueryForm
 from zentral.contrib.osquery.models import (DistributedQuery, DistributedQueryMachine, DistributedQueryResult,
                                             FileCarvingSession, Query)
 
@@ -206,6 +207,22 @@ class OsquerySetupDistributedQueriesViewsTestCase(TestCase):
         distributed_query.refresh_from_db()
         self.assertEqual(distributed_query.shard, 99)
 
+    def test_update_distributed_query_form_result_column_names_not_overwritten(self):
+        distributed_query = self._force_distributed_query()
+        form = DistributedQueryForm(
+            {"valid_from": "2020-07-30 11:50:00",
+             "valid_until": "2021-02-18 20:55:00",
+             "shard": "98"},
+            instance=distributed_query
+        )
+        self.assertTrue(form.is_valid())
+        # results saved concurrently, after the distributed query was loaded
+        DistributedQueryResult.objects.bulk_insert(get_random_string(12), [(distributed_query.pk, {"un": 1})])
+        form.save()
+        distributed_query.refresh_from_db()
+        self.assertEqual(distributed_query.shard, 98)
+        self.assertEqual(distributed_query.result_column_names, ["un"])
+
     def test_update_distributed_query_valid_until_less_than_valid_from(self):
         distributed_query = self._force_distributed_query()
         self._login("osquery.change_distributedquery", "osquery.view_distributedquery")
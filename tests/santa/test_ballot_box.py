@@ -4,7 +4,7 @@ from django.utils.crypto import get_random_string
 from zentral.contrib.santa.ballot_box import (AnonymousVoter, BallotBox, DuplicateVoteError,
                                               ResetNotAllowedError, Voter, VotingError, VotingNotAllowedError)
 from zentral.contrib.santa.events import SantaBallotEvent, SantaRuleUpdateEvent, SantaTargetStateUpdateEvent
-from zentral.contrib.santa.models import Ballot, Rule, Target, TargetState
+from zentral.contrib.santa.models import Ballot, MachineRule, Rule, Target, TargetState
 from zentral.contrib.santa.utils import update_voting_rules
 from .utils import (add_file_to_test_class, force_ballot, force_configuration, force_enrolled_machine,
                     force_realm_group, force_realm_user, force_target, force_voting_group)
@@ -911,6 +911,33 @@ class SantaBallotBoxTestCase(TestCase):
         self.assertEqual(rule.target, self.file_target)
         self.assertEqual(rule.policy, Rule.Policy.BLOCKLIST)
 
+    def test_ballot_box_voting_rule_synced_to_machine_in_sync(self):
+        realm, realm_user = force_realm_user()
+        configuration = force_configuration(
+            voting_realm=realm,
+            default_ballot_target_types=[Target.Type.BINARY],
+            banned_threshold=-26,
+        )
+        force_voting_group(configuration, realm_user, voting_weight=50, can_mark_malware=True)
+        enrolled_machine = force_enrolled_machine(configuration=configuration)
+        # machine in sync, fingerprint recorded
+        rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(enrolled_machine, [])
+        self.assertEqual(rule_batch, [])
+        self.assertIsNone(response_cursor)
+        enrolled_machine.refresh_from_db()
+        self.assertIsNotNone(enrolled_machine.rules_sync_fingerprint)
+        rules_version = configuration.rules_version
+        ballot_box = BallotBox.for_realm_user(self.file_target, realm_user, all_configurations=True)
+        ballot_box.cast_votes([(configuration, False)])
+        configuration.refresh_from_db()
+        self.assertEqual(configuration.rules_version, rules_version + 1)
+        # new voting rule in the next batch
+        rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(enrolled_machine, [])
+        self.assertIsNotNone(response_cursor)
+        self.assertEqual(len(rule_batch), 1)
+        self.assertEqual(rule_batch[0]["identifier"], self.file_target.identifier)
+        self.assertEqual(rule_batch[0]["policy"], "BLOCKLIST")
+
     # target state reset
 
     def test_ballot_box_target_state_reset_not_allowed(self):
@@ -1,3 +1,4 @@
+from unittest.mock import patch
 import uuid
 from django.db.models import F
 from django.test import TestCase
@@ -627,3 +628,93 @@ class SantaRuleEngineTestCase(TestCase):
         # rule added noop
         rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [tags[0].pk, tags[-2].pk])
         self.assertEqual(rule_batch, [])
+
+    def test_rules_version_bumps(self):
+        self.configuration.refresh_from_db()
+        rules_version = self.configuration.rules_version
+        # rule created
+        target, rule = self.create_rule()
+        tags = [Tag.objects.create(name=get_random_string(32)) for _ in range(2)]
+        for func, args in ((rule.save, ()),
+                           (rule.tags.set, (tags[:1],)),
+                           (rule.excluded_tags.set, (tags[1:],)),
+                           (rule.tags.clear, ()),
+                           (tags[1].delete, ()),
+                           (rule.delete, ())):
+            self.configuration.refresh_from_db()
+            self.assertGreater(self.configuration.rules_version, rules_version)
+            rules_version = self.configuration.rules_version
+            func(*args)
+        self.configuration.refresh_from_db()
+        self.assertGreater(self.configuration.rules_version, rules_version)
+
+    def test_stale_configuration_save_rules_sync_fingerprint(self):
+        # in sync
+        self.assertEqual(MachineRule.objects.get_next_rule_batch(self.enrolled_machine, []), ([], None))
+        self.assertIsNotNone(self.enrolled_machine.rules_sync_fingerprint)
+        stale_configuration = Configuration.objects.get(pk=self.configuration.pk)
+        _, _, serialized_rule = self.create_and_serialize_rule()
+        # the stale configuration save reverts the rules version
+        stale_configuration.save()
+        self.configuration.refresh_from_db()
+        self.assertEqual(self.configuration.rules_version, stale_configuration.rules_version)
+        # but the new rule is still distributed
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [serialized_rule])
+
+    def test_rules_sync_fingerprint_short_circuit(self):
+        _, _, serialized_rule = self.create_and_serialize_rule()
+        self.assertIsNone(self.enrolled_machine.rules_sync_fingerprint)
+        rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [serialized_rule])
+        self.assertIsNone(self.enrolled_machine.rules_sync_fingerprint)
+        # ack, in sync → fingerprint recorded
+        rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [],
+                                                                              response_cursor)
+        self.assertEqual(rule_batch, [])
+        self.assertIsNone(response_cursor)
+        fingerprint = self.enrolled_machine.rules_sync_fingerprint
+        self.assertEqual(len(fingerprint), 64)
+        self.enrolled_machine.refresh_from_db()
+        self.assertEqual(self.enrolled_machine.rules_sync_fingerprint, fingerprint)
+        # nothing has changed → no rule diff
+        with patch.object(MachineRule.objects, "_iter_new_rules") as iter_new_rules:
+            self.assertEqual(MachineRule.objects.get_next_rule_batch(self.enrolled_machine, []), ([], None))
+            iter_new_rules.assert_not_called()
+        # machine tags changed → rule diff
+        tag = Tag.objects.create(name=get_random_string(32))
+        with patch.object(MachineRule.objects, "_iter_new_rules", return_value=[]) as iter_new_rules:
+            self.assertEqual(MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [tag.pk]), ([], None))
+            iter_new_rules.assert_called_once_with(self.enrolled_machine, [tag.pk])
+        self.assertNotEqual(self.enrolled_machine.rules_sync_fingerprint, fingerprint)
+        # new rule → rule diff
+        _, _, serialized_rule2 = self.create_and_serialize_rule()
+        rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [tag.pk])
+        self.assertEqual(rule_batch, [serialized_rule2])
+
+    def test_rules_sync_fingerprint_clean_sync(self):
+        _, _, serialized_rule = self.create_and_serialize_rule()
+        _, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [], response_cursor)
+        self.assertIsNotNone(self.enrolled_machine.rules_sync_fingerprint)
+        # clean sync
+        MachineRule.objects.filter(enrolled_machine=self.enrolled_machine).delete()
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [serialized_rule])
+
+    def test_rule_batch_bulk_upsert(self):
+        target, rule, serialized_rule = self.create_and_serialize_rule()
+        _, _, serialized_rule2 = self.create_and_serialize_rule()
+        rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(len(rule_batch), 2)
+        MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [], response_cursor)
+        rule.policy = Rule.Policy.BLOCKLIST
+        rule.version = F("version") + 1
+        rule.save()
+        rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [dict(serialized_rule, policy="BLOCKLIST")])
+        machine_rule = MachineRule.objects.get(enrolled_machine=self.enrolled_machine, target=target)
+        self.assertEqual(machine_rule.policy, Rule.Policy.BLOCKLIST)
+        self.assertEqual(machine_rule.version, 2)
+        self.assertEqual(machine_rule.cursor, response_cursor)
+        self.assertEqual(MachineRule.objects.filter(enrolled_machine=self.enrolled_machine).count(), 2)
@@ -2,7 +2,9 @@ import datetime
 from unittest.mock import patch
 from django.test import TestCase
 from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import File
 from zentral.contrib.santa.events import (_build_file_tree_from_santa_event,
+                                          _commit_files,
                                           _create_bundle_binaries,
                                           _create_missing_bundles,
                                           _update_targets,
@@ -635,6 +637,31 @@ class SantaEventTestCase(TestCase):
         _create_missing_bundles([event_d], {})
         logger_error.assert_called_once_with("Missing BUNDLE target %s", event_d["file_bundle_hash"])
 
+    def test_create_missing_bundles_bulk(self):
+        events = [{"decision": "BLOCK_UNKNOWN",
+                   "file_bundle_hash": new_sha256(),
+                   "file_bundle_name": get_random_string(12),
+                   "file_bundle_binary_count": 3} for _ in range(3)]
+        # a blocked upload bundle already exists
+        existing_target = Target.objects.create(type=Target.Type.BUNDLE, identifier=events[0]["file_bundle_hash"])
+        existing_bundle = Bundle.objects.create(target=existing_target, name="yolo", binary_count=2)
+        targets = {(Target.Type.BUNDLE, existing_target.identifier): (existing_target, False)}
+        for event_d in events[1:]:
+            target = Target.objects.create(type=Target.Type.BUNDLE, identifier=event_d["file_bundle_hash"])
+            targets[(Target.Type.BUNDLE, target.identifier)] = (target, True)
+        with self.assertNumQueries(2):
+            unknown_file_bundle_hashes = _create_missing_bundles(events, targets)
+        self.assertEqual(set(unknown_file_bundle_hashes), set(e["file_bundle_hash"] for e in events))
+        self.assertEqual(Bundle.objects.filter(target__identifier__in=unknown_file_bundle_hashes).count(), 3)
+        existing_bundle.refresh_from_db()
+        self.assertEqual(existing_bundle.name, "yolo")
+        self.assertEqual(existing_bundle.binary_count, 2)
+        for event_d in events[1:]:
+            bundle = Bundle.objects.get(target__identifier=event_d["file_bundle_hash"])
+            self.assertEqual(bundle.name, event_d["file_bundle_name"])
+            self.assertEqual(bundle.binary_count, 3)
+            self.assertEqual(bundle.path, "")
+
     # _create_bundle_binaries
 
     @patch("zentral.contrib.santa.events.logger.error")
@@ -698,3 +725,48 @@ class SantaEventTestCase(TestCase):
         self.assertEqual(b.binary_targets.count(), 2)
         logger_error.assert_called_once_with("Bundle %s as wrong number of binary targets",
                                              event_d["file_bundle_hash"])
+
+    def test_create_bundle_binaries_one_bundle_query(self):
+        events = []
+        bundles = []
+        for _ in range(2):
+            binary_target = Target.objects.create(type=Target.Type.BINARY, identifier=new_sha256())
+            bundle_target = Target.objects.create(type=Target.Type.BUNDLE, identifier=new_sha256())
+            bundles.append(Bundle.objects.create(target=bundle_target, binary_count=1))
+            events.append({"decision": "BUNDLE_BINARY",
+                           "file_bundle_hash": bundle_target.identifier,
+                           "file_sha256": binary_target.identifier})
+        # 1 bundle query + 3 queries per bundle (binary targets insert, count, update)
+        with self.assertNumQueries(7):
+            uploaded_bundles = _create_bundle_binaries(events)
+        self.assertEqual(uploaded_bundles, set(bundles))
+
+    # _commit_files
+
+    def test_commit_files_deduplicated(self):
+        event_d = {"decision": "ALLOW_UNKNOWN",
+                   "file_name": get_random_string(12),
+                   "file_path": "/usr/local/bin",
+                   "file_sha256": new_sha256()}
+        event_d2 = dict(event_d, file_sha256=new_sha256())
+        with patch("zentral.contrib.santa.events.File.objects.bulk_commit",
+                   wraps=File.objects.bulk_commit) as bulk_commit:
+            _commit_files([event_d, event_d.copy(), event_d2])
+        bulk_commit.assert_called_once()
+        self.assertEqual(len(bulk_commit.call_args.args[0]), 2)
+        self.assertEqual(File.objects.filter(sha_256__in=[event_d["file_sha256"], event_d2["file_sha256"]]).count(), 2)
+        # existing files are not committed again
+        with patch("zentral.contrib.santa.events.File.objects.bulk_commit") as bulk_commit:
+            _commit_files([event_d, event_d2])
+        bulk_commit.assert_not_called()
+
+    @patch("zentral.contrib.santa.events.logger.exception")
+    def test_commit_files_bulk_commit_error_fallback(self, logger_exception):
+        event_d = {"decision": "ALLOW_UNKNOWN",
+                   "file_name": get_random_string(12),
+                   "file_path": "/usr/local/bin",
+                   "file_sha256": new_sha256()}
+        with patch("zentral.contrib.santa.events.File.objects.bulk_commit", side_effect=ValueError("YOLO")):
+            _commit_files([event_d])
+        logger_exception.assert_called_once_with("Could not bulk commit files")
+        self.assertEqual(File.objects.filter(sha_256=event_d["file_sha256"]).count(), 1)
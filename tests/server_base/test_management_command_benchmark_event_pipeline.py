@@ -0,0 +1,77 @@
+from io import StringIO
+import json
+from unittest.mock import patch
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.crypto import get_random_string
+from zentral.core.incidents.models import Incident, MachineIncident, Severity
+from zentral.core.probes.conf import all_probes
+from zentral.core.probes.models import ProbeSource
+
+
+class BenchmarkEventPipelineManagementCommandTest(TestCase):
+    def force_santa_event_probe_with_incident(self):
+        ProbeSource.objects.create(
+            model="BaseProbe",
+            name=get_random_string(12),
+            status=ProbeSource.ACTIVE,
+            body={"filters": {"metadata": [{"event_types": ["santa_event"]}]},
+                  "incident_severity": Severity.CRITICAL.value},
+        )
+        all_probes.clear()
+        self.addCleanup(all_probes.clear)
+
+    @patch("base.management.commands.benchmark_event_pipeline.process_event")
+    def test_benchmark_event_pipeline_json(self, process_event):
+        out = StringIO()
+        err = StringIO()
+        call_command("benchmark_event_pipeline", "--events", "8", "--machines", "2", "--json",
+                     stdout=out, stderr=err)
+        # probe actions not triggered by default
+        process_event.assert_not_called()
+        self.assertEqual(err.getvalue(), "")
+        results = json.loads(out.getvalue())
+        self.assertEqual([stage["stage"] for stage in results["stages"]],
+                         ["preprocess", "enrich", "process", "store"])
+        for stage in results["stages"]:
+            self.assertEqual(stage["messages"], 8)
+            self.assertIsNotNone(stage["p99_latency_ms"])
+            self.assertIsNone(stage["peak_memory_kib"])
+
+    def test_benchmark_event_pipeline_batch_table(self):
+        out = StringIO()
+        call_command("benchmark_event_pipeline", "--events", "5", "--kind", "santa", "--kind", "osquery",
+                     "--batch-size", "2", "--trace-memory", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertIn("Events/s", lines[0])
+        for line, stage in zip(lines[1:], ("preprocess", "enrich", "process", "store")):
+            self.assertEqual(line.split()[:2], [stage, "5"])
+
+    @patch("base.management.commands.benchmark_event_pipeline.process_event")
+    def test_benchmark_event_pipeline_with_probes(self, process_event):
+        out = StringIO()
+        err = StringIO()
+        call_command("benchmark_event_pipeline", "--events", "3", "--kind", "santa", "--with-probes", "--json",
+                     stdout=out, stderr=err)
+        self.assertEqual(process_event.call_count, 3)
+        self.assertIn("will be applied", err.getvalue())
+        results = json.loads(out.getvalue())
+        self.assertEqual(results["stages"][2]["messages"], 3)
+
+    @patch("base.management.commands.benchmark_event_pipeline.process_event")
+    def test_benchmark_event_pipeline_no_incidents(self, process_event):
+        self.force_santa_event_probe_with_incident()
+        call_command("benchmark_event_pipeline", "--events", "3", "--kind", "santa", "--json",
+                     stdout=StringIO(), stderr=StringIO())
+        # incident updates not applied by default
+        self.assertEqual(Incident.objects.count(), 0)
+        self.assertEqual(MachineIncident.objects.count(), 0)
+
+    @patch("base.management.commands.benchmark_event_pipeline.process_event")
+    def test_benchmark_event_pipeline_with_probes_incidents(self, process_event):
+        self.force_santa_event_probe_with_incident()
+        call_command("benchmark_event_pipeline", "--events", "3", "--kind", "santa", "--with-probes", "--json",
+                     stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Incident.objects.count(), 1)
+        self.assertEqual(MachineIncident.objects.count(), 3)
@@ -0,0 +1,73 @@
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from zentral.utils import local_cache
+from zentral.utils.local_cache import LocalCache, setup_local_cache_metrics
+
+
+class LocalCacheTestCase(SimpleTestCase):
+    def tearDown(self):
+        local_cache._metrics_exporter = None
+
+    def test_get_set(self):
+        lc = LocalCache("yolo", max_size=2, ttl=10)
+        self.assertIsNone(lc.get("a"))
+        lc.set("a", 1)
+        self.assertEqual(lc.get("a"), 1)
+        self.assertEqual(len(lc), 1)
+
+    def test_lru_eviction(self):
+        lc = LocalCache("yolo", max_size=2, ttl=10)
+        lc.set("a", 1)
+        lc.set("b", 2)
+        self.assertEqual(lc.get("a"), 1)  # a is now the most recently used item
+        lc.set("c", 3)
+        self.assertEqual(len(lc), 2)
+        self.assertIsNone(lc.get("b"))
+        self.assertEqual(lc.get("a"), 1)
+        self.assertEqual(lc.get("c"), 3)
+
+    @patch("zentral.utils.local_cache.time.monotonic")
+    def test_ttl(self, time_monotonic):
+        time_monotonic.return_value = 0
+        lc = LocalCache("yolo", max_size=2, ttl=10)
+        lc.set("a", 1)
+        time_monotonic.return_value = 9
+        self.assertEqual(lc.get("a"), 1)
+        time_monotonic.return_value = 10
+        self.assertEqual(lc.get("a", "default"), "default")
+        self.assertEqual(len(lc), 0)
+
+    def test_disabled(self):
+        for max_size, ttl in ((0, 10), (10, 0)):
+            lc = LocalCache("yolo", max_size=max_size, ttl=ttl)
+            self.assertFalse(lc.enabled)
+            lc.set("a", 1)
+            self.assertIsNone(lc.get("a"))
+            self.assertEqual(len(lc), 0)
+
+    def test_delete_many_clear(self):
+        lc = LocalCache("yolo", max_size=3, ttl=10)
+        lc.set("a", 1)
+        lc.set("b", 2)
+        lc.set("c", 3)
+        lc.delete_many(["a", "b", "z"])
+        self.assertEqual(len(lc), 1)
+        self.assertEqual(lc.get("c"), 3)
+        lc.clear()
+        self.assertEqual(len(lc), 0)
+
+    def test_metrics(self):
+        metrics_exporter = Mock()
+        setup_local_cache_metrics(metrics_exporter)
+        self.assertEqual(
+            [c.args for c in metrics_exporter.add_counter.call_args_list],
+            [("local_cache_hits", ["cache"]), ("local_cache_misses", ["cache"])]
+        )
+        lc = LocalCache("yolo", max_size=3, ttl=10)
+        lc.get("a")
+        lc.set("a", 1)
+        lc.get("a")
+        self.assertEqual(
+            [c.args for c in metrics_exporter.inc.call_args_list],
+            [("local_cache_misses", "yolo"), ("local_cache_hits", "yolo")]
+        )
@@ -1,5 +1,8 @@
+import os.path
+import tempfile
+from django.core.files.storage import FileSystemStorage, InMemoryStorage
 from django.test import SimpleTestCase, override_settings
-from zentral.utils.storage import file_storage_has_signed_urls, select_dist_storage
+from zentral.utils.storage import file_storage_has_signed_urls, open_storage_file_for_writing, select_dist_storage
 
 
 class StorageTestCase(SimpleTestCase):
@@ -21,3 +24,19 @@ class StorageTestCase(SimpleTestCase):
     def test_select_dist_storage_fallback(self):
         storage = select_dist_storage()
         self.assertEqual(storage.__class__.__name__, "S3Storage")
+
+    def test_open_storage_file_for_writing_file_system(self):
+        with tempfile.TemporaryDirectory() as location:
+            storage = FileSystemStorage(location=location)
+            with open_storage_file_for_writing(storage, "yolo/fomo/file.txt") as f:
+                f.write(b"yolo")
+            self.assertTrue(os.path.isdir(os.path.join(location, "yolo", "fomo")))
+            with storage.open("yolo/fomo/file.txt") as f:
+                self.assertEqual(f.read(), b"yolo")
+
+    def test_open_storage_file_for_writing_in_memory(self):
+        storage = InMemoryStorage()
+        with open_storage_file_for_writing(storage, "yolo/fomo/file.txt") as f:
+            f.write(b"fomo")
+        with storage.open("yolo/fomo/file.txt") as f:
+            self.assertEqual(f.read(), b"fomo")
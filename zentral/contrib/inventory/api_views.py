@@ -176,7 +176,7 @@ class ArchiveMachines(APIView):
     def post(self, request, *args, **kwargs):
         serializer = MachineSerialNumbersSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        count, _ = CurrentMachineSnapshot.objects.filter(serial_number__in=serializer.data["serial_numbers"]).delete()
+        count = CurrentMachineSnapshot.objects.archive(serializer.data["serial_numbers"])
         return Response({"current_machine_snapshots": count})
 
 
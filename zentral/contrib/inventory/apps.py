@@ -25,3 +25,9 @@ class ZentralInventoryAppConfig(ZentralAppConfig):
         "tag",
         "taxonomy",
     )
+
+    def ready(self):
+        super().ready()
+        from zentral.core.compliance_checks.models import machine_statuses_updated
+        from .models import refresh_machine_statuses_search_index
+        machine_statuses_updated.connect(refresh_machine_statuses_search_index)
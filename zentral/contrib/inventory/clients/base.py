@@ -1,7 +1,7 @@
 import copy
 import logging
 from zentral.contrib.inventory.models import CurrentMachineSnapshot
-from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
+from zentral.contrib.inventory.utils import commit_machine_snapshot_trees
 
 __all__ = ['BaseInventory', 'InventoryError']
 
@@ -14,6 +14,7 @@ class InventoryError(Exception):
 
 class BaseInventory(object):
     source_config_secret_attributes = None
+    commit_max_workers = 4
 
     def __init__(self, config_d):
         if not hasattr(self, 'name'):
@@ -30,9 +31,7 @@ class BaseInventory(object):
         raise NotImplementedError
 
     # inventory API
-    def sync(self):
-        seen_machines = []
-        inventory_source = None
+    def iter_machine_trees(self, seen_machines):
         for machine_d in self.get_machines():
             source = copy.deepcopy(self.source)
             try:
@@ -53,11 +52,16 @@ class BaseInventory(object):
             business_unit_d = machine_d.get('business_unit', None)
             if business_unit_d:
                 business_unit_d['source'] = source
-            # save all
-            ms = commit_machine_snapshot_and_trigger_events(machine_d)
-            if inventory_source is None and ms:
-                inventory_source = ms.source
-        if seen_machines and inventory_source:
+            yield machine_d
+
+    def sync(self, metrics_exporter=None):
+        seen_machines = []
+        # save all
+        machine_snapshots = commit_machine_snapshot_trees(self.iter_machine_trees(seen_machines),
+                                                          max_workers=self.commit_max_workers,
+                                                          metrics_exporter=metrics_exporter)
+        if seen_machines and machine_snapshots:
+            inventory_source = machine_snapshots[0].source
             (CurrentMachineSnapshot.objects.filter(source=inventory_source)
                                            .exclude(serial_number__in=seen_machines)
                                            .delete())
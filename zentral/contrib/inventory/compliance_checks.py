@@ -1,14 +1,19 @@
+import hashlib
+import json
 import logging
 import threading
 import time
+from django.core.cache import cache
 from django.utils.functional import cached_property, SimpleLazyObject
 import jmespath
+from jmespath.visitor import TreeInterpreter
+from base.notifier import notifier
 from zentral.core.compliance_checks import register_compliance_check_class
 from zentral.core.compliance_checks.compliance_checks import BaseComplianceCheck
 from zentral.core.compliance_checks.models import Status
 from zentral.core.compliance_checks.utils import update_machine_statuses
 from .events import JMESPathCheckStatusUpdated
-from .models import JMESPathCheck, MachineTag
+from .models import JMESPathCheck, MetaMachine
 
 
 logger = logging.getLogger("zentral.contrib.inventory.compliance_checks")
@@ -49,27 +54,76 @@ class InventoryJMESPathCheck(BaseComplianceCheck):
 register_compliance_check_class(InventoryJMESPathCheck)
 
 
+class SharedSubexpressionsInterpreter(TreeInterpreter):
+    """JMESPath interpreter sharing the results of the subexpressions evaluated on the root value
+
+    The sub-structures of the tree used by multiple checks are only projected once.
+    """
+    shared_node_types = {"filter_projection", "flatten", "index_expression",
+                         "projection", "subexpression", "value_projection"}
+
+    def __init__(self, root, subexpression_keys):
+        super().__init__()
+        self._root = root
+        self._subexpression_keys = subexpression_keys
+        self._results = {}
+
+    @classmethod
+    def iter_subexpression_keys(cls, node):
+        if node["type"] in cls.shared_node_types:
+            yield id(node), json.dumps(node, sort_keys=True)
+        for child in node.get("children", []):
+            if isinstance(child, dict):
+                yield from cls.iter_subexpression_keys(child)
+
+    def visit(self, node, value):
+        if value is self._root:
+            key = self._subexpression_keys.get(id(node))
+            if key is not None:
+                try:
+                    return self._results[key]
+                except KeyError:
+                    result = self._results[key] = super().visit(node, value)
+                    return result
+        return super().visit(node, value)
+
+
 class JMESPathChecksCache:
-    # TODO: hard coded ttl
-    ttl = 300  # cache ttl in seconds
+    # the checks are reloaded when a change is notified. Periodic reload as a safety net.
+    ttl = 3600  # cache ttl in seconds
+    fingerprint_ttl = 86400  # evaluation fingerprints cache ttl in seconds
 
     def __init__(self):
         self._source_platform_checks = {}
         self._checks = {}
+        self._subexpression_keys = {}
         self._last_fetched_time = None
+        self._notifier_callback_registered = False
         self._lock = threading.Lock()
 
+    def _reset(self, *args, **kwargs):
+        logger.info("Reset JMESPath checks")
+        self._last_fetched_time = None
+
     def _load(self):
         if self._last_fetched_time is not None and (time.monotonic() - self._last_fetched_time) < self.ttl:
             return
+        if not self._notifier_callback_registered:
+            # first time
+            notifier.add_callback("inventory.jmespath_checks", self._reset)
+            self._notifier_callback_registered = True
         self._source_platform_checks = {}
         self._checks = {}
+        self._subexpression_keys = {}
         for jmespath_check in (JMESPathCheck.objects.select_related("compliance_check")
                                                     .prefetch_related("tags")
                                                     .all()):
             source_name = jmespath_check.source_name.lower()
             tags_set = frozenset(tag.id for tag in jmespath_check.tags.all())
             compiled_jmespath_expression = jmespath.compile(jmespath_check.jmespath_expression)
+            self._subexpression_keys.update(
+                SharedSubexpressionsInterpreter.iter_subexpression_keys(compiled_jmespath_expression.parsed)
+            )
             for platform in jmespath_check.platforms:
                 self._source_platform_checks.setdefault((source_name, platform), []).append(
                     (tags_set, compiled_jmespath_expression, jmespath_check)
@@ -80,9 +134,33 @@ class JMESPathChecksCache:
     def _get_source_platform_checks(self, source_name, platform):
         with self._lock:
             self._load()
-            return self._source_platform_checks.get((source_name.lower(), platform), [])
-
-    def process_tree(self, tree, last_seen):
+            return (self._source_platform_checks.get((source_name.lower(), platform), []),
+                    self._subexpression_keys)
+
+    @staticmethod
+    def _get_fingerprint_cache_key(serial_number, source_name, platform):
+        h = hashlib.sha1()
+        for v in (serial_number, source_name.lower(), platform):
+            h.update(v.encode("utf-8"))
+            h.update(b"\0")
+        return "inventory-jmespath-checks-fp_{}".format(h.hexdigest())
+
+    @staticmethod
+    def _get_fingerprint(checks, machine_tag_set):
+        h = hashlib.sha1()
+        for compliance_check in sorted((jmespath_check.compliance_check for _, _, jmespath_check in checks),
+                                       key=lambda cc: cc.pk):
+            h.update(f"{compliance_check.pk}:{compliance_check.version};".encode("utf-8"))
+        if machine_tag_set is not None:
+            h.update("|{}".format(",".join(str(tag_id) for tag_id in sorted(machine_tag_set))).encode("utf-8"))
+        return h.hexdigest()
+
+    def process_tree(self, tree, last_seen, skip_if_unchanged=False):
+        """Evaluate the JMESPath checks for a tree and yield the status updated events
+
+        With skip_if_unchanged, the evaluation is skipped if the checks and the machine tags
+        are the same as for the last evaluation. To use only if the tree is unchanged.
+        """
         machine_tag_set = None
         compliance_check_statuses = []
         serial_number = tree["serial_number"]
@@ -91,23 +169,25 @@ class JMESPathChecksCache:
         if not platform:
             logger.warning("Cannot process %s %s tree: missing platform", source_name, serial_number)
             return
-        for check_tag_set, jmespath_parsed_expr, jmespath_check in self._get_source_platform_checks(
-            source_name,
-            platform
-        ):
+        checks, subexpression_keys = self._get_source_platform_checks(source_name, platform)
+        if not checks:
+            return
+        if any(check_tag_set for check_tag_set, _, _ in checks):
+            machine_tag_set = MetaMachine(serial_number).cached_machine_tag_ids
+        fingerprint_cache_key = self._get_fingerprint_cache_key(serial_number, source_name, platform)
+        fingerprint = self._get_fingerprint(checks, machine_tag_set)
+        if skip_if_unchanged and cache.get(fingerprint_cache_key) == fingerprint:
+            return
+        interpreter = SharedSubexpressionsInterpreter(tree, subexpression_keys)
+        for check_tag_set, jmespath_parsed_expr, jmespath_check in checks:
             if check_tag_set:
-                if machine_tag_set is None:
-                    # TODO cache?
-                    machine_tag_set = set(
-                        MachineTag.objects.filter(serial_number=serial_number).values_list("tag_id", flat=True)
-                    )
                 if not check_tag_set.intersection(machine_tag_set):
                     # tags mismatch
                     continue
             # default to unknown status
             status = Status.UNKNOWN
             try:
-                result = jmespath_parsed_expr.search(tree)
+                result = interpreter.visit(jmespath_parsed_expr.parsed, tree)
             except Exception:
                 logger.exception("Could not evaluate JMESPath check %s source name %s serial number %s",
                                  jmespath_check.pk, source_name, serial_number)
@@ -121,8 +201,10 @@ class JMESPathChecksCache:
             compliance_check_statuses.append((jmespath_check.compliance_check, status, last_seen))
         if not compliance_check_statuses:
             # nothing to update, no events
+            cache.set(fingerprint_cache_key, fingerprint, self.fingerprint_ttl)
             return
         status_updates = update_machine_statuses(serial_number, compliance_check_statuses)
+        cache.set(fingerprint_cache_key, fingerprint, self.fingerprint_ttl)
         for compliance_check_pk, status_value, previous_status_value in status_updates:
             if status_value == previous_status_value:
                 # status not updated, no event
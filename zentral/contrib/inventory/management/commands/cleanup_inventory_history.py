@@ -1,7 +1,7 @@
 import logging
 from django.core.management.base import BaseCommand
 from django.db import connection
-from zentral.contrib.inventory.utils import (cleanup_inventory,
+from zentral.contrib.inventory.utils import (cleanup_inventory, cleanup_inventory_in_chunks,
                                              get_default_snapshot_retention_days,
                                              get_cleanup_max_date)
 
@@ -20,6 +20,16 @@ class Command(BaseCommand):
             default=default_snapshot_retention_days,
             help=f'number of days to keep, default {default_snapshot_retention_days}'
         )
+        parser.add_argument("--chunked", action="store_true",
+                            help="delete the rows in batches, by id range")
+        parser.add_argument("--chunk-size", type=int, default=10000,
+                            help="chunked cleanup id range size, 10000 by default")
+        parser.add_argument("--time-budget", type=int,
+                            help="chunked cleanup max duration in seconds. No limit by default")
+        parser.add_argument("--sleep", type=float, default=0,
+                            help="chunked cleanup pause between the batches, in seconds")
+        parser.add_argument("--resume", action="store_true",
+                            help="restart the chunked cleanup where the last one was interrupted")
 
     def set_options(self, **options):
         self.quiet = options["quiet"] or options["verbosity"] == 0
@@ -30,12 +40,26 @@ class Command(BaseCommand):
     def handle(self, *args, **kwargs):
         self.set_options(**kwargs)
         with connection.cursor() as cursor:
-            cleanup_inventory(cursor, self.result_callback, self.max_date)
+            if kwargs["chunked"]:
+                _, complete = cleanup_inventory_in_chunks(
+                    cursor, self.result_callback, self.max_date,
+                    chunk_size=kwargs["chunk_size"],
+                    time_budget=kwargs["time_budget"],
+                    sleep=kwargs["sleep"],
+                    resume=kwargs["resume"],
+                )
+                if not complete and not self.quiet:
+                    self.stdout.write("time budget exceeded, cleanup incomplete")
+            else:
+                cleanup_inventory(cursor, self.result_callback, self.max_date)
 
     def result_callback(self, table, result):
         if self.quiet:
             return
         if result["status"] == 0:
-            self.stdout.write("{}: {} - {:.2f}ms".format(table, result["rowcount"], result["duration"] * 1000))
+            line = "{}: {} - {:.2f}ms".format(table, result["rowcount"], result["duration"] * 1000)
+            if result.get("rows_per_second") is not None:
+                line += " - {} chunk(s) - {:.0f} rows/s".format(result["chunks"], result["rows_per_second"])
+            self.stdout.write(line)
         else:
             self.stderr.write(f"Could not cleanup table {table}")
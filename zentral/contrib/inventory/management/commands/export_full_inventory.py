@@ -1,7 +1,8 @@
 import logging
 from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand
-from zentral.contrib.inventory.utils import do_full_export
+from zentral.contrib.inventory.utils import (FULL_EXPORT_STREAMING_FORMATS, do_full_export,
+                                             do_incremental_export, do_streaming_full_export)
 from zentral.utils.storage import file_storage_has_signed_urls
 
 
@@ -11,8 +12,27 @@ logger = logging.getLogger("zentral.contrib.inventory.management.commands.export
 class Command(BaseCommand):
     help = "Export full inventory as a ZIP archive of .ndjson files"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--streaming", action="store_true",
+                            help="export the tables concurrently, one file per table, "
+                                 "directly to the storage, with a manifest")
+        parser.add_argument("--incremental", action="store_true",
+                            help="only export the changes since the last incremental export. "
+                                 "Same layout as the streaming export")
+        parser.add_argument("--name", default="default",
+                            help="incremental export name. Each name has its own watermark")
+        parser.add_argument("--format", choices=sorted(FULL_EXPORT_STREAMING_FORMATS.keys()), default="jsonl",
+                            help="streaming & incremental export format. jsonl (gzipped) by default")
+        parser.add_argument("--max-workers", type=int, default=4,
+                            help="streaming & incremental export concurrent table queries. 4 by default")
+
     def handle(self, *args, **kwargs):
-        result = do_full_export()
+        if kwargs["incremental"]:
+            result = do_incremental_export(kwargs["name"], kwargs["format"], kwargs["max_workers"])
+        elif kwargs["streaming"]:
+            result = do_streaming_full_export(kwargs["format"], kwargs["max_workers"])
+        else:
+            result = do_full_export()
         filepath = result["filepath"]
         if file_storage_has_signed_urls(default_storage):
             url = default_storage.url(filepath)
@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from zentral.contrib.inventory.models import MachineSearchIndex
+
+
+class Command(BaseCommand):
+    help = "Rebuild the machine search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-q", "--quiet", action="store_true", help="no output if no errors")
+
+    def handle(self, *args, **kwargs):
+        start_t = time.monotonic()
+        MachineSearchIndex.objects.refresh(force=True)
+        if not kwargs["quiet"] and kwargs["verbosity"] > 0:
+            self.stdout.write("machine search index rebuilt - {:.2f}ms - {} machine(s)".format(
+                (time.monotonic() - start_t) * 1000,
+                MachineSearchIndex.objects.count()
+            ))
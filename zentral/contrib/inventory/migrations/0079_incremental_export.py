@@ -0,0 +1,41 @@
+# Generated by Django 4.2.20 on 2026-10-19 00:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0078_file_cdhash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryExportWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256, unique=True)),
+                ('machine_snapshot_commit_created_at', models.DateTimeField(null=True)),
+                ('machine_snapshot_commit_id', models.IntegerField(null=True)),
+                ('tombstone_created_at', models.DateTimeField(null=True)),
+                ('tombstone_id', models.IntegerField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='machinesnapshotcommit',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='MachineSnapshotTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial_number', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inventory.source')),
+            ],
+        ),
+    ]
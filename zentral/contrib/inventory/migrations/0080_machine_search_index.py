@@ -0,0 +1,32 @@
+# Generated by Django 4.2.20 on 2026-10-19 00:44
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0079_incremental_export'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MachineSearchIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial_number', models.TextField()),
+                ('tag_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('max_compliance_check_status', models.IntegerField(null=True)),
+                ('compliance_check_statuses', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inventory.source')),
+            ],
+            options={
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['tag_ids'], name='inventory_m_tag_ids_39dfad_gin'), django.contrib.postgres.indexes.GinIndex(fields=['compliance_check_statuses'], name='inventory_m_complia_cf88d7_gin')],
+                'unique_together': {('serial_number', 'source')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.20 on 2026-10-19 02:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0080_machine_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inventoryexportwatermark',
+            name='current_machine_snapshot_last_seen',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='currentmachinesnapshot',
+            name='last_seen',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
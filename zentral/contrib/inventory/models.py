@@ -4,26 +4,33 @@ from datetime import datetime, timedelta
 import json
 import logging
 import re
+import time
 import urllib.parse
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.urls import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import connection, IntegrityError, models, transaction
 from django.db.models import Count, F, Q, Max
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.crypto import get_random_string
-from django.utils.functional import cached_property
+from django.utils.functional import cached_property, SimpleLazyObject
 from django.utils.text import slugify
 from django.utils.timesince import timesince
 from django.utils.translation import gettext_lazy as _
+from base.notifier import notifier
 from realms.models import RealmUser
 from zentral.conf import settings
+from zentral.core.compliance_checks.models import ComplianceCheck
 from zentral.core.compliance_checks.utils import get_machine_compliance_check_statuses
 from zentral.core.incidents.models import MachineIncident, Status
+from zentral.utils.local_cache import LocalCache
 from zentral.utils.model_extras import find_all_related_objects
 from zentral.utils.mt_models import (prepare_commit_tree,
                                      AbstractMTObject, MTObjectManager, MTOError)
@@ -234,8 +241,14 @@ class BusinessUnit(AbstractMachineGroup):
         super(BusinessUnit, self).save(*args, **kwargs)
 
     def set_meta_business_unit(self, mbu):
+        old_mbu_pk = self.meta_business_unit_id
         self.meta_business_unit = mbu
         super(BusinessUnit, self).save()
+        # the machines of the business unit inherit the tags of the new meta business unit
+        bump_inventory_search_generation()
+        for mbu_pk in (old_mbu_pk, mbu.pk):
+            if mbu_pk is not None:
+                MachineSearchIndex.objects.refresh(meta_business_unit_pk=mbu_pk)
 
     def is_api_enrollment_business_unit(self):
         return self.source.module == "zentral.contrib.inventory"
@@ -677,7 +690,7 @@ class MachineSnapshot(AbstractMTObject):
 
 
 class MachineSnapshotCommitManager(models.Manager):
-    def commit_machine_snapshot_tree(self, tree):
+    def prepare_machine_snapshot_tree(self, tree):
         last_seen = tree.pop('last_seen', None)
         if not last_seen:
             last_seen = datetime.utcnow()
@@ -686,7 +699,69 @@ class MachineSnapshotCommitManager(models.Manager):
         system_uptime = tree.pop('system_uptime', None)
         update_ms_tree_platform(tree)
         update_ms_tree_type(tree)
-        machine_snapshot, _ = MachineSnapshot.objects.commit(tree)
+        return last_seen, system_uptime
+
+    def update_unchanged_machine_snapshots(self, prepared_trees):
+        """Fast path for the machine snapshot trees already committed
+
+        prepared_trees is a list of (tree, last_seen, system_uptime) tuples. For the trees matching the
+        current machine snapshot of their serial number and source, only the last seen and system uptime
+        of the current machine snapshot and of the last commit are updated, with a single UPDATE.
+        Returns a {tree mt_hash: (machine snapshot, last seen updated)} dict.
+        The machine snapshots are loaded with deferred fields.
+        """
+        if not prepared_trees:
+            return {}
+        values = []
+        args = []
+        for tree, last_seen, system_uptime in prepared_trees:
+            prepare_commit_tree(tree)
+            values.append("(%s, %s, %s::timestamp, %s::integer)")
+            args.extend([tree.get("serial_number"), tree["mt_hash"], last_seen, system_uptime])
+        query = (
+            "with trees(serial_number, mt_hash, last_seen, system_uptime) as (values {}), "
+            "cms as ("
+            " update inventory_currentmachinesnapshot as cms set last_seen = t.last_seen"
+            " from trees as t, inventory_machinesnapshot as ms"
+            " where cms.serial_number = t.serial_number"
+            " and cms.machine_snapshot_id = ms.id and cms.source_id = ms.source_id and ms.mt_hash = t.mt_hash"
+            " returning cms.serial_number, cms.source_id, cms.machine_snapshot_id, t.last_seen, t.system_uptime"
+            "), msc as ("
+            " update inventory_machinesnapshotcommit as msc"
+            " set last_seen = cms.last_seen, system_uptime = cms.system_uptime"
+            " from cms"
+            " where msc.id = ("
+            "  select lmsc.id from inventory_machinesnapshotcommit as lmsc"
+            "  where lmsc.serial_number = cms.serial_number and lmsc.source_id = cms.source_id"
+            "  order by lmsc.version desc limit 1"
+            " ) and msc.machine_snapshot_id = cms.machine_snapshot_id"
+            " returning msc.id, msc.machine_snapshot_id, cms.last_seen"
+            ") "
+            # the select sees the previous version of the last commit
+            "select {}, "
+            "pmsc.last_seen is distinct from msc.last_seen "
+            "from inventory_machinesnapshot as ms "
+            "join msc on (msc.machine_snapshot_id = ms.id) "
+            "join inventory_machinesnapshotcommit as pmsc on (pmsc.id = msc.id)"
+        )
+        # in the model fields order, for from_db
+        field_names = [f.attname for f in MachineSnapshot._meta.concrete_fields
+                       if f.attname in ("id", "mt_hash", "serial_number", "source_id")]
+        query = query.format(", ".join(values), ", ".join(f"ms.{field_name}" for field_name in field_names))
+        machine_snapshots = {}
+        with connection.cursor() as cursor:
+            cursor.execute(query, args)
+            for *ms_values, last_seen_updated in cursor.fetchall():
+                machine_snapshot = MachineSnapshot.from_db(self.db, field_names, ms_values)
+                machine_snapshots[machine_snapshot.mt_hash] = (machine_snapshot, last_seen_updated)
+        return machine_snapshots
+
+    def commit_machine_snapshot_tree(self, tree):
+        last_seen, system_uptime = self.prepare_machine_snapshot_tree(tree)
+        machine_snapshot, _ = MachineSnapshot.objects.bulk_commit([tree])[0]
+        return self.commit_machine_snapshot(machine_snapshot, last_seen, system_uptime)
+
+    def commit_machine_snapshot(self, machine_snapshot, last_seen, system_uptime):
         serial_number = machine_snapshot.serial_number
         source = machine_snapshot.source
         new_version = new_parent = None
@@ -712,10 +787,15 @@ class MachineSnapshotCommitManager(models.Manager):
                                                                    parent=new_parent,
                                                                    last_seen=last_seen,
                                                                    system_uptime=system_uptime)
-                CurrentMachineSnapshot.objects.update_or_create(serial_number=serial_number,
-                                                                source=source,
-                                                                defaults={'machine_snapshot': machine_snapshot,
-                                                                          'last_seen': last_seen})
+                _, cms_created = CurrentMachineSnapshot.objects.update_or_create(
+                    serial_number=serial_number,
+                    source=source,
+                    defaults={'machine_snapshot': machine_snapshot,
+                              'last_seen': last_seen}
+                )
+                if cms_created or (new_parent and new_parent.machine_snapshot_id != machine_snapshot.pk):
+                    bump_inventory_search_generation()
+                    MachineSearchIndex.objects.refresh(serial_numbers=[serial_number])
                 return new_msc, machine_snapshot, last_seen
         except IntegrityError:
             msc = MachineSnapshotCommit.objects.get(serial_number=serial_number,
@@ -738,7 +818,7 @@ class MachineSnapshotCommit(models.Model):
     parent = models.ForeignKey('self', on_delete=models.SET_NULL, blank=True, null=True)
     last_seen = models.DateTimeField(blank=True, null=True)
     system_uptime = models.PositiveIntegerField(blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     objects = MachineSnapshotCommitManager()
 
@@ -762,16 +842,76 @@ class MachineSnapshotCommit(models.Model):
             return timesince(now - timedelta(seconds=self.system_uptime), now=now)
 
 
+class CurrentMachineSnapshotManager(models.Manager):
+    def archive(self, serial_numbers):
+        """Delete the current machine snapshots of the serial numbers, and record their tombstones
+
+        A single statement, without the per-row post_delete signals of a queryset delete.
+        Returns the number of archived current machine snapshots.
+        """
+        query = (
+            "with deleted_cms as ("
+            " delete from inventory_currentmachinesnapshot where serial_number = any(%s)"
+            " returning serial_number, source_id"
+            ") insert into inventory_machinesnapshottombstone (serial_number, source_id, created_at) "
+            "select serial_number, source_id, %s from deleted_cms"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(query, [list(serial_numbers), datetime.utcnow()])
+            count = cursor.rowcount
+        if count:
+            bump_inventory_search_generation()
+        return count
+
+
 class CurrentMachineSnapshot(models.Model):
     serial_number = models.TextField(db_index=True)
     source = models.ForeignKey(Source, on_delete=models.CASCADE)
     machine_snapshot = models.ForeignKey(MachineSnapshot, on_delete=models.CASCADE)
-    last_seen = models.DateTimeField()
+    last_seen = models.DateTimeField(db_index=True)
+
+    objects = CurrentMachineSnapshotManager()
 
     class Meta:
         unique_together = ('serial_number', 'source')
 
 
+class MachineSnapshotTombstone(models.Model):
+    """Records the archived current machine snapshots, for the incremental exports"""
+    serial_number = models.TextField()
+    source = models.ForeignKey(Source, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+@receiver(post_delete, sender=CurrentMachineSnapshot)
+def post_delete_current_machine_snapshot(sender, instance, *args, **kwargs):
+    # one tombstone per deleted row. The archives use CurrentMachineSnapshotManager.archive instead.
+    bump_inventory_search_generation()
+    MachineSnapshotTombstone.objects.create(serial_number=instance.serial_number, source_id=instance.source_id)
+
+
+class InventoryExportWatermark(models.Model):
+    """Position of an incremental inventory export
+
+    The machine snapshot commits and tombstones are exported in (created_at, id) order.
+    The created_at and id of the last exported ones are persisted.
+    The current machine snapshots seen again without new commits are exported in last_seen order.
+    The last_seen upper bound of the last export is persisted.
+    """
+    name = models.CharField(max_length=256, unique=True)
+    machine_snapshot_commit_created_at = models.DateTimeField(null=True)
+    machine_snapshot_commit_id = models.IntegerField(null=True)
+    current_machine_snapshot_last_seen = models.DateTimeField(null=True)
+    tombstone_created_at = models.DateTimeField(null=True)
+    tombstone_id = models.IntegerField(null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
 class Taxonomy(models.Model):
     """A bag of tags, can be restricted to a MBU"""
     meta_business_unit = models.ForeignKey(MetaBusinessUnit, on_delete=models.CASCADE, blank=True, null=True)
@@ -921,19 +1061,247 @@ class Tag(models.Model):
         return d
 
 
+def refresh_machine_tags(serial_numbers):
+    """Invalidate the cached information and refresh the search index of the machines with updated tags"""
+    serial_numbers = set(serial_numbers)
+    if not serial_numbers:
+        return
+    for serial_number in serial_numbers:
+        MetaMachine(serial_number).clear_cached_info()
+    bump_inventory_search_generation()
+    MachineSearchIndex.objects.refresh(serial_numbers=serial_numbers)
+
+
+class MachineTagQuerySet(models.QuerySet):
+    def delete(self):
+        # no post_delete signal receivers, to keep the fast deletes of the Tag cascades.
+        # See refresh_tag_machine_tags.
+        serial_numbers = set(self.values_list("serial_number", flat=True))
+        deleted = super().delete()
+        refresh_machine_tags(serial_numbers)
+        return deleted
+
+
+class MachineTagManager(models.Manager):
+    def get_queryset(self):
+        return MachineTagQuerySet(self.model, using=self._db)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        created_objs = super().bulk_create(objs, *args, **kwargs)
+        # no post_save signals
+        refresh_machine_tags(obj.serial_number for obj in objs)
+        return created_objs
+
+
 class MachineTag(models.Model):
     serial_number = models.TextField()
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
 
+    objects = MachineTagManager()
+
     class Meta:
         unique_together = (('serial_number', 'tag'),)
 
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        refresh_machine_tags([self.serial_number])
+        return deleted
+
 
 class MetaBusinessUnitTag(models.Model):
     meta_business_unit = models.ForeignKey(MetaBusinessUnit, on_delete=models.CASCADE)
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
 
 
+# inventory search generation
+# bumped when the machines or their tags change, to invalidate the cached search results
+
+
+INVENTORY_SEARCH_GENERATION_CACHE_KEY = "inventory_search_generation"
+
+
+def get_inventory_search_generation():
+    generation = cache.get(INVENTORY_SEARCH_GENERATION_CACHE_KEY)
+    if generation is None:
+        # time based initial value, to never reuse the generation of an evicted counter
+        cache.add(INVENTORY_SEARCH_GENERATION_CACHE_KEY, time.time_ns(), None)
+        generation = cache.get(INVENTORY_SEARCH_GENERATION_CACHE_KEY)
+    return generation
+
+
+def _incr_inventory_search_generation():
+    try:
+        cache.incr(INVENTORY_SEARCH_GENERATION_CACHE_KEY)
+    except ValueError:
+        # missing key
+        cache.set(INVENTORY_SEARCH_GENERATION_CACHE_KEY, time.time_ns(), None)
+
+
+def bump_inventory_search_generation():
+    _incr_inventory_search_generation()
+    # again after the commit, in case the search results were cached with the previous state in the meantime
+    transaction.on_commit(_incr_inventory_search_generation)
+
+
+# machine search index
+
+
+def machine_search_index_enabled():
+    return bool(settings["apps"]["zentral.contrib.inventory"].get("machine_search_index", False))
+
+
+class MachineSearchIndexManager(models.Manager):
+    refresh_query = (
+        "insert into inventory_machinesearchindex"
+        " (serial_number, source_id, tag_ids, max_compliance_check_status, compliance_check_statuses, updated_at) "
+        "select cms.serial_number, cms.source_id,"
+        " array("
+        "  select mt.tag_id from inventory_machinetag as mt"
+        "  where mt.serial_number = cms.serial_number"
+        "  union"
+        "  select mbut.tag_id from inventory_metabusinessunittag as mbut"
+        "  join inventory_businessunit as bu on (bu.meta_business_unit_id = mbut.meta_business_unit_id)"
+        "  where bu.id = ms.business_unit_id"
+        "  order by 1"
+        " ),"
+        " cs.max_status, coalesce(cs.statuses, '{{}}'::jsonb), now() "
+        "from inventory_currentmachinesnapshot as cms "
+        "join inventory_machinesnapshot as ms on (ms.id = cms.machine_snapshot_id) "
+        "left join lateral ("
+        " select max(mcs.status) as max_status, jsonb_object_agg(mcs.compliance_check_id, mcs.status) as statuses"
+        " from compliance_checks_machinestatus as mcs"
+        " join compliance_checks_compliancecheck as cc on (cc.id = mcs.compliance_check_id)"
+        " where mcs.serial_number = cms.serial_number and mcs.compliance_check_version = cc.version"
+        ") as cs on TRUE "
+        "{where} "
+        "on conflict (serial_number, source_id) do update "
+        "set tag_ids = excluded.tag_ids,"
+        "max_compliance_check_status = excluded.max_compliance_check_status,"
+        "compliance_check_statuses = excluded.compliance_check_statuses,"
+        "updated_at = excluded.updated_at"
+    )
+    delete_query = (
+        "delete from inventory_machinesearchindex as msi "
+        "where {where} not exists ("
+        " select 1 from inventory_currentmachinesnapshot as cms"
+        " where cms.serial_number = msi.serial_number and cms.source_id = msi.source_id"
+        ")"
+    )
+
+    def refresh(self, serial_numbers=None, meta_business_unit_pk=None, compliance_check_pk=None, force=False):
+        """Refresh the index rows of the current machine snapshots
+
+        Without arguments, the whole index is rebuilt. Noop if the index is not enabled, unless force is True.
+        """
+        if not force and not machine_search_index_enabled():
+            return
+        args = []
+        delete_where = ""
+        delete_args = []
+        if serial_numbers is not None:
+            serial_numbers = list(serial_numbers)
+            if not serial_numbers:
+                return
+            where = "where cms.serial_number = any(%s)"
+            args.append(serial_numbers)
+            delete_where = "msi.serial_number = any(%s) and"
+            delete_args.append(serial_numbers)
+        elif meta_business_unit_pk is not None:
+            where = ("where ms.business_unit_id in ("
+                     "select id from inventory_businessunit where meta_business_unit_id = %s)")
+            args.append(meta_business_unit_pk)
+        elif compliance_check_pk is not None:
+            # the machines with an indexed status for this compliance check
+            where = ("where cms.serial_number in ("
+                     "select serial_number from inventory_machinesearchindex "
+                     "where compliance_check_statuses ? %s)")
+            args.append(str(compliance_check_pk))
+        else:
+            where = ""
+        with connection.cursor() as cursor:
+            cursor.execute(self.refresh_query.format(where=where), args)
+            if delete_where or where == "":
+                cursor.execute(self.delete_query.format(where=delete_where), delete_args)
+
+
+class MachineSearchIndex(models.Model):
+    """Denormalized attributes of the current machine snapshots, for the machine searches"""
+    serial_number = models.TextField()
+    source = models.ForeignKey(Source, on_delete=models.CASCADE)
+    tag_ids = ArrayField(models.IntegerField(), default=list)
+    max_compliance_check_status = models.IntegerField(null=True)
+    compliance_check_statuses = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = MachineSearchIndexManager()
+
+    class Meta:
+        unique_together = (("serial_number", "source"),)
+        indexes = [GinIndex(fields=["tag_ids"]),
+                   GinIndex(fields=["compliance_check_statuses"])]
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def bump_tag_search_generation(sender, instance, *args, **kwargs):
+    # names & colors in the search results
+    bump_inventory_search_generation()
+
+
+@receiver(pre_delete, sender=Tag)
+def collect_tag_machine_tag_serial_numbers(sender, instance, *args, **kwargs):
+    # the machine tags are deleted in cascade, without signals
+    instance._machine_tag_serial_numbers = set(
+        MachineTag.objects.filter(tag=instance).values_list("serial_number", flat=True)
+    )
+
+
+@receiver(post_delete, sender=Tag)
+def refresh_tag_machine_tags(sender, instance, *args, **kwargs):
+    refresh_machine_tags(getattr(instance, "_machine_tag_serial_numbers", []))
+
+
+@receiver(post_save, sender=MachineTag)
+def refresh_machine_tag_search_index(sender, instance, *args, **kwargs):
+    # no post_delete receiver. See MachineTagQuerySet.delete.
+    refresh_machine_tags([instance.serial_number])
+
+
+@receiver(post_save, sender=MetaBusinessUnitTag)
+@receiver(post_delete, sender=MetaBusinessUnitTag)
+def refresh_meta_business_unit_tag_search_index(sender, instance, *args, **kwargs):
+    bump_inventory_search_generation()
+    MachineSearchIndex.objects.refresh(meta_business_unit_pk=instance.meta_business_unit_id)
+
+
+@receiver(post_save, sender=ComplianceCheck)
+@receiver(post_delete, sender=ComplianceCheck)
+def refresh_compliance_check_search_index(sender, instance, *args, **kwargs):
+    # version updates & deletions
+    MachineSearchIndex.objects.refresh(compliance_check_pk=instance.pk)
+
+
+def refresh_machine_statuses_search_index(sender, serial_number, *args, **kwargs):
+    MachineSearchIndex.objects.refresh(serial_numbers=[serial_number])
+
+
+def _get_machine_info_cache_config():
+    return settings["apps"]["zentral.contrib.inventory"].get("machine_info_cache", {})
+
+
+def build_machine_info_local_cache():
+    config = _get_machine_info_cache_config()
+    return LocalCache("machine_info",
+                      max_size=int(config.get("local_max_size", 1024)),
+                      ttl=int(config.get("local_ttl", 30)))
+
+
+# process local cache in front of the django cache,
+# for the machine information used in the events pipeline
+machine_info_local_cache = SimpleLazyObject(build_machine_info_local_cache)
+
+
 class MetaMachine:
     """Simplified access to the ms."""
     def __init__(self, serial_number, snapshots=None):
@@ -1150,7 +1518,7 @@ class MetaMachine:
         return get_machine_compliance_check_statuses(self.serial_number, self.tags)
 
     def archive(self):
-        CurrentMachineSnapshot.objects.filter(serial_number=self.serial_number).delete()
+        CurrentMachineSnapshot.objects.archive([self.serial_number])
 
     def has_recent_source_snapshot(self, source_module, max_age=3600):
         query = (
@@ -1291,15 +1659,51 @@ class MetaMachine:
                 tag_ids.add(agg["id"])
         return (platform_fv, type_fv, mbu_ids, tag_ids)
 
+    def get_machine_tag_ids(self):
+        """Returns the IDs of the tags directly attached to the machine, without the meta business unit tags."""
+        return sorted(MachineTag.objects.filter(serial_number=self.serial_number).values_list("tag_id", flat=True))
+
+    _probe_filtering_values_cache_key_prefix = "mm-probe-fvs_"
+    _serialized_info_for_event_cache_key_prefix = "mm-si_"
+    _machine_tag_ids_cache_key_prefix = "mm-mt-ids_"
+
+    def _get_info_cache_keys(self):
+        urlsafe_serial_number = self.get_urlsafe_serial_number()
+        return [f"{prefix}{urlsafe_serial_number}"
+                for prefix in (self._probe_filtering_values_cache_key_prefix,
+                               self._serialized_info_for_event_cache_key_prefix,
+                               self._machine_tag_ids_cache_key_prefix)]
+
+    def _get_cached_info(self, cache_key_prefix, getter):
+        cache_key = f"{cache_key_prefix}{self.get_urlsafe_serial_number()}"
+        # process local cache
+        value = machine_info_local_cache.get(cache_key)
+        if value is None:
+            # shared cache
+            value = cache.get(cache_key)
+            if value is None:
+                value = getter()
+                cache.set(cache_key, value, int(_get_machine_info_cache_config().get("ttl", 60)))
+            machine_info_local_cache.set(cache_key, value)
+        return value
+
+    def clear_cached_info(self):
+        """Invalidate the cached machine information used in the events pipeline"""
+        cache_keys = self._get_info_cache_keys()
+        machine_info_local_cache.delete_many(cache_keys)
+        cache.delete_many(cache_keys)
+
     @cached_property
     def cached_probe_filtering_values(self):
         """Cached version of get_probe_filtering_values"""
-        cache_key = "mm-probe-fvs_{}".format(self.get_urlsafe_serial_number())
-        filtering_values = cache.get(cache_key)
-        if filtering_values is None:
-            filtering_values = self.get_probe_filtering_values()
-            cache.set(cache_key, filtering_values, 60)  # TODO: Hard coded timeout value
-        return filtering_values
+        return self._get_cached_info(self._probe_filtering_values_cache_key_prefix,
+                                     self.get_probe_filtering_values)
+
+    @cached_property
+    def cached_machine_tag_ids(self):
+        """Cached version of get_machine_tag_ids, as a set"""
+        return set(self._get_cached_info(self._machine_tag_ids_cache_key_prefix,
+                                         self.get_machine_tag_ids))
 
     def get_legacy_serialized_info_for_event(self):
         """Serialize the machine information to be included in the events.
@@ -1373,12 +1777,8 @@ class MetaMachine:
     @cached_property
     def cached_serialized_info_for_event(self):
         """Cached version of get_serialized_info_for_event"""
-        cache_key = "mm-si_{}".format(self.get_urlsafe_serial_number())
-        serialized_info = cache.get(cache_key)
-        if serialized_info is None:
-            serialized_info = self.get_serialized_info_for_event()
-            cache.set(cache_key, serialized_info, 60)  # TODO: Hard coded timeout value
-        return serialized_info
+        return self._get_cached_info(self._serialized_info_for_event_cache_key_prefix,
+                                     self.get_serialized_info_for_event)
 
 
 class MACAddressBlockAssignmentOrganization(models.Model):
@@ -1685,3 +2085,22 @@ class JMESPathCheck(models.Model):
             "tags": sorted(str(tag) for tag in self.tags.select_related("taxonomy", "meta_business_unit").all()),
             "jmespath_expression": self.jmespath_expression,
         }
+
+
+# to reload the JMESPath checks in all the processes
+def signal_jmespath_checks_change():
+    transaction.on_commit(lambda: notifier.send_notification("inventory.jmespath_checks"))
+
+
+@receiver(post_save, sender=JMESPathCheck)
+@receiver(post_delete, sender=JMESPathCheck)
+@receiver(m2m_changed, sender=JMESPathCheck.tags.through)
+def post_jmespath_check_change(sender, *args, **kwargs):
+    signal_jmespath_checks_change()
+
+
+@receiver(post_save, sender=ComplianceCheck)
+def post_jmespath_check_compliance_check_change(sender, instance, *args, **kwargs):
+    # name & version updates
+    if instance.model == "InventoryJMESPathCheck":
+        signal_jmespath_checks_change()
@@ -10,8 +10,8 @@ import xlsxwriter
 from .events import post_cleanup_finished_event, post_cleanup_started_event
 from .forms import AndroidAppSearchForm, DebPackageSearchForm, IOSAppSearchForm, MacOSAppSearchForm, ProgramsSearchForm
 from .utils import (MSQuery,
-                    cleanup_inventory as do_cleanup_inventory, get_cleanup_max_date,
-                    do_full_export,
+                    cleanup_inventory as do_cleanup_inventory, cleanup_inventory_in_chunks, get_cleanup_max_date,
+                    do_full_export, do_incremental_export, do_streaming_full_export,
                     export_machine_macos_app_instances as do_export_machine_macos_app_instances,
                     export_machine_android_apps as do_export_machine_android_apps,
                     export_machine_deb_packages as do_export_machine_deb_packages,
@@ -21,7 +21,7 @@ from .utils import (MSQuery,
 
 
 @shared_task
-def cleanup_inventory(days, serialized_event_request):
+def cleanup_inventory(days, serialized_event_request, chunked=False, time_budget=None, sleep=0):
     max_date = get_cleanup_max_date(days)
     payload = {"days": days, "max_date": max_date}
     post_cleanup_started_event(payload.copy(), serialized_event_request)
@@ -32,17 +32,30 @@ def cleanup_inventory(days, serialized_event_request):
         payload["tables"][key] = val
 
     with connection.cursor() as cursor:
-        payload["duration"] = do_cleanup_inventory(cursor, result_callback, max_date)
+        if chunked:
+            payload["duration"], payload["complete"] = cleanup_inventory_in_chunks(
+                cursor, result_callback, max_date,
+                time_budget=time_budget, sleep=sleep, resume=True
+            )
+        else:
+            payload["duration"] = do_cleanup_inventory(cursor, result_callback, max_date)
 
     post_cleanup_finished_event(payload, serialized_event_request)
     return payload
 
 
 @shared_task
-def export_full_inventory():
+def export_full_inventory(streaming=False, output_format="jsonl"):
+    if streaming:
+        return do_streaming_full_export(output_format)
     return do_full_export()
 
 
+@shared_task
+def export_incremental_inventory(name="default", output_format="jsonl"):
+    return do_incremental_export(name, output_format)
+
+
 @shared_task
 def export_inventory(urlencoded_query_dict, filename):
     msquery = MSQuery(QueryDict(urlencoded_query_dict))
@@ -67,6 +80,11 @@ def export_inventory(urlencoded_query_dict, filename):
     }
 
 
+@shared_task(ignore_result=True)
+def refresh_msquery_grouping_results(urlencoded_query_dict):
+    MSQuery(QueryDict(urlencoded_query_dict)).refresh_grouping_results()
+
+
 def export_apps(form_class, form_data, filename):
     form = form_class(form_data or {}, export=True)
     assert form.is_valid()
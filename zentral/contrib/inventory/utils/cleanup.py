@@ -1,6 +1,7 @@
 from datetime import timedelta
 import logging
 import time
+from django.core.cache import cache
 from django.db import IntegrityError
 from django.utils import timezone
 from zentral.conf import settings
@@ -10,6 +11,7 @@ __all__ = [
     "get_default_snapshot_retention_days",
     "get_cleanup_max_date",
     "cleanup_inventory",
+    "cleanup_inventory_in_chunks",
 ]
 
 
@@ -31,6 +33,11 @@ WHERE
 """
 
 
+DELETE_MACHINE_SNAPSHOT_TOMBSTONE_QUERY = (
+    "DELETE FROM inventory_machinesnapshottombstone WHERE created_at < %s"
+)
+
+
 ORPHANS = (
     # MachineSnapshot of archived machines
     ("inventory_machinesnapshot", "id",
@@ -111,6 +118,17 @@ ORPHANS = (
 )
 
 
+def get_orphans_wheres(table, attr, links):
+    wheres = []
+    for idx, (fk_attr, fk_table) in enumerate(links):
+        # we use an alias for the fk_table to avoid collision with the table
+        # inventory_certificate references inventory_certificate for example
+        wheres.append(
+            f"NOT EXISTS (SELECT 1 FROM {fk_table} fkt{idx} WHERE {table}.{attr} = fkt{idx}.{fk_attr})"
+        )
+    return " AND ".join(wheres)
+
+
 def get_default_snapshot_retention_days():
     default_snapshot_retention_days = 30  # 30 days if absent
     try:
@@ -141,17 +159,16 @@ def cleanup_inventory(cursor, result_callback, max_date):
                                                 "duration": time.time() - start_t,
                                                 "status": 0})
 
+    # delete older machine snapshot tombstones
+    tombstone_start_t = time.time()
+    cursor.execute(DELETE_MACHINE_SNAPSHOT_TOMBSTONE_QUERY, [max_date])
+    result_callback("machine_snapshot_tombstone", {"rowcount": cursor.rowcount,
+                                                   "duration": time.time() - tombstone_start_t,
+                                                   "status": 0})
+
     # orphans
     for table, attr, links in ORPHANS:
-        wheres = []
-        for idx, (fk_attr, fk_table) in enumerate(links):
-            # we use an alias for the fk_table to avoid collision with the table
-            # inventory_certificate references inventory_certificate for example
-            wheres.append(
-                f"NOT EXISTS (SELECT 1 FROM {fk_table} fkt{idx} WHERE {table}.{attr} = fkt{idx}.{fk_attr})"
-            )
-        wheres = " AND ".join(wheres)
-        query = f"DELETE FROM {table} WHERE {wheres}"
+        query = f"DELETE FROM {table} WHERE {get_orphans_wheres(table, attr, links)}"
 
         # 3 attempts. Things could be added in the linked table while we are deleting.
         # TODO: better?
@@ -174,3 +191,112 @@ def cleanup_inventory(cursor, result_callback, max_date):
             result_callback(table, {"attempts": i + 1,
                                     "status": 1})
     return time.time() - start_t
+
+
+# chunked cleanup
+
+
+CHUNKED_CLEANUP_STATE_CACHE_KEY = "inventory_cleanup_chunked_state"
+CHUNKED_CLEANUP_STATE_TTL = 7 * 86400  # 7 days
+
+
+# same result as DELETE_MACHINE_SNAPSHOT_COMMIT_QUERY, without the aggregation over the whole table
+CHUNKED_DELETE_MACHINE_SNAPSHOT_COMMIT_QUERY = (
+    "DELETE FROM inventory_machinesnapshotcommit AS msc "
+    "WHERE msc.id >= %s AND msc.id < %s "
+    "AND msc.created_at < %s "
+    "AND EXISTS ("
+    " SELECT 1 FROM inventory_machinesnapshotcommit AS nmsc"
+    " WHERE nmsc.serial_number = msc.serial_number"
+    " AND nmsc.source_id = msc.source_id"
+    " AND nmsc.created_at > msc.created_at"
+    ")"
+)
+
+
+CHUNKED_DELETE_MACHINE_SNAPSHOT_TOMBSTONE_QUERY = (
+    "DELETE FROM inventory_machinesnapshottombstone "
+    "WHERE id >= %s AND id < %s AND created_at < %s"
+)
+
+
+def iter_chunked_cleanup_steps(max_date):
+    # key, table, id column, delete query, extra query args
+    yield ("machine_snapshot_commit", "inventory_machinesnapshotcommit", "id",
+           CHUNKED_DELETE_MACHINE_SNAPSHOT_COMMIT_QUERY, [max_date])
+    yield ("machine_snapshot_tombstone", "inventory_machinesnapshottombstone", "id",
+           CHUNKED_DELETE_MACHINE_SNAPSHOT_TOMBSTONE_QUERY, [max_date])
+    for table, attr, links in ORPHANS:
+        yield (table, table, attr,
+               f"DELETE FROM {table} WHERE {attr} >= %s AND {attr} < %s AND {get_orphans_wheres(table, attr, links)}",
+               [])
+
+
+def cleanup_inventory_in_chunks(cursor, result_callback, max_date,
+                                chunk_size=10000, time_budget=None, sleep=0, resume=False):
+    """Cleanup the inventory in bounded batches, by id range
+
+    Each chunk is deleted with its own statement, to keep the locks and transactions short.
+    The cleanup stops after the first chunk exceeding the time_budget (in seconds),
+    and waits sleep seconds between the chunks.
+    With resume, the position is saved in the cache after each chunk, and cleared only when the cleanup
+    is complete. The next cleanup restarts from it, even after a crash or a kill.
+    Returns the duration, and whether the cleanup is complete.
+    """
+    start_t = time.monotonic()
+    state = cache.get(CHUNKED_CLEANUP_STATE_CACHE_KEY) if resume else None
+    for key, table, attr, query, extra_args in iter_chunked_cleanup_steps(max_date):
+        min_id = None
+        if state:
+            if state["key"] != key:
+                # already done before the interruption
+                continue
+            min_id = state["min_id"]
+            state = None
+        table_start_t = time.monotonic()
+        cursor.execute(f"SELECT MIN({attr}), MAX({attr}) FROM {table}")
+        first_id, last_id = cursor.fetchone()
+        if first_id is not None and (min_id is None or min_id < first_id):
+            min_id = first_id
+        rowcount = chunk_count = failed_chunk_count = 0
+        complete = True
+        while first_id is not None and min_id <= last_id:
+            if chunk_count and sleep:
+                time.sleep(sleep)
+            max_id = min_id + chunk_size
+            # 3 attempts. Things could be added in the linked tables while we are deleting.
+            for i in range(3):
+                if i:
+                    time.sleep(i)
+                try:
+                    cursor.execute(query, [min_id, max_id] + extra_args)
+                except IntegrityError:
+                    logger.warning("Could not purge table %s chunk %s-%s because of an integrity error",
+                                   table, min_id, max_id)
+                else:
+                    rowcount += cursor.rowcount
+                    break
+            else:
+                failed_chunk_count += 1
+            chunk_count += 1
+            min_id = max_id
+            if resume:
+                # checkpoint, the chunk is committed
+                cache.set(CHUNKED_CLEANUP_STATE_CACHE_KEY, {"key": key, "min_id": min_id},
+                          CHUNKED_CLEANUP_STATE_TTL)
+            if time_budget is not None and time.monotonic() - start_t > time_budget and min_id <= last_id:
+                complete = False
+                break
+        duration = time.monotonic() - table_start_t
+        result_callback(key, {"rowcount": rowcount,
+                              "duration": duration,
+                              "chunks": chunk_count,
+                              "failed_chunks": failed_chunk_count,
+                              "rows_per_second": rowcount / duration if duration else None,
+                              "complete": complete,
+                              "status": 1 if failed_chunk_count else 0})
+        if not complete:
+            return time.monotonic() - start_t, False
+    if resume:
+        cache.delete(CHUNKED_CLEANUP_STATE_CACHE_KEY)
+    return time.monotonic() - start_t, True
@@ -1,13 +1,24 @@
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import copy
+from itertools import chain, islice
 import logging
+import time
+from django.db import connections
+from zentral.core.events.base import post_events
 from zentral.utils.json import save_dead_letter
+from zentral.utils.mt_models import cleanup_commit_tree, prepare_commit_tree
 from zentral.contrib.inventory.compliance_checks import jmespath_checks_cache
 from zentral.contrib.inventory.events import (iter_inventory_events)
-from zentral.contrib.inventory.models import MachineSnapshotCommit
+from zentral.contrib.inventory.models import (BusinessUnit, MachineSnapshot, MachineSnapshotCommit, MetaMachine,
+                                              OSVersion, Source)
 
 
 __all__ = [
+    "add_commit_machine_snapshot_trees_counters",
     "commit_machine_snapshot_and_trigger_events",
     "commit_machine_snapshot_and_yield_events",
+    "commit_machine_snapshot_trees",
 ]
 
 
@@ -78,31 +89,252 @@ def inventory_events_from_machine_snapshot_commit(machine_snapshot_commit):
         yield ("inventory_heartbeat", added_last_seen, {'source': source})
 
 
+def _iter_unchanged_machine_snapshot_events(tree, last_seen, last_seen_updated):
+    if last_seen_updated:
+        source = copy.deepcopy(tree["source"])
+        cleanup_commit_tree(source)
+        yield from iter_inventory_events(tree["serial_number"],
+                                         [("inventory_heartbeat", last_seen, {"source": source})])
+    # compliance checks, only if they have changed
+    yield from jmespath_checks_cache.process_tree(tree, last_seen, skip_if_unchanged=True)
+
+
+def _iter_machine_snapshot_events(tree, msc, last_seen):
+    # inventory events
+    if msc:
+        MetaMachine(msc.serial_number).clear_cached_info()
+        yield from iter_inventory_events(msc.serial_number, inventory_events_from_machine_snapshot_commit(msc))
+    # compliance checks
+    yield from jmespath_checks_cache.process_tree(tree, last_seen)
+
+
+def _commit_machine_snapshot_tree(tree):
+    """Commit a machine snapshot tree, or only update its last seen if it is unchanged
+
+    Returns the machine snapshot and the iterator of the events.
+    """
+    last_seen, system_uptime = MachineSnapshotCommit.objects.prepare_machine_snapshot_tree(tree)
+    try:
+        machine_snapshot, last_seen_updated = MachineSnapshotCommit.objects.update_unchanged_machine_snapshots(
+            [(tree, last_seen, system_uptime)]
+        )[tree["mt_hash"]]
+    except KeyError:
+        machine_snapshot, _ = MachineSnapshot.objects.bulk_commit([tree])[0]
+        msc, machine_snapshot, last_seen = MachineSnapshotCommit.objects.commit_machine_snapshot(
+            machine_snapshot, last_seen, system_uptime
+        )
+        return machine_snapshot, _iter_machine_snapshot_events(tree, msc, last_seen)
+    else:
+        return machine_snapshot, _iter_unchanged_machine_snapshot_events(tree, last_seen, last_seen_updated)
+
+
 def commit_machine_snapshot_and_trigger_events(tree):
     try:
-        msc, machine_snapshot, last_seen = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        machine_snapshot, events = _commit_machine_snapshot_tree(tree)
     except Exception:
         logger.exception("Could not commit machine snapshot")
         save_dead_letter(tree, "machine snapshot commit error")
     else:
-        # inventory events
-        if msc:
-            for event in iter_inventory_events(msc.serial_number, inventory_events_from_machine_snapshot_commit(msc)):
-                event.post()
-        # compliance checks
-        for event in jmespath_checks_cache.process_tree(tree, last_seen):
+        for event in events:
             event.post()
         return machine_snapshot
 
 
 def commit_machine_snapshot_and_yield_events(tree):
     try:
-        msc, _, last_seen = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        _, events = _commit_machine_snapshot_tree(tree)
     except Exception:
         logger.exception("Could not commit machine snapshot")
     else:
-        # inventory events
-        if msc:
-            yield from iter_inventory_events(msc.serial_number, inventory_events_from_machine_snapshot_commit(msc))
-        # compliance checks
-        yield from jmespath_checks_cache.process_tree(tree, last_seen)
+        yield from events
+
+
+# batches
+
+
+TREES_COUNTER = "inventory_machine_snapshot_trees"
+TREES_SECONDS_COUNTER = "inventory_machine_snapshot_trees_seconds"
+
+
+def add_commit_machine_snapshot_trees_counters(metrics_exporter):
+    metrics_exporter.add_counter(TREES_COUNTER, ["source", "status"])
+    metrics_exporter.add_counter(TREES_SECONDS_COUNTER, ["source"])
+
+
+def _get_tree_source_name(tree):
+    try:
+        return tree["source"]["name"]
+    except (KeyError, TypeError):
+        return "UNKNOWN"
+
+
+def _commit_machine_snapshot_tree_batch(trees, pk_cache):
+    """Commit a batch of machine snapshot trees
+
+    Returns the machine snapshots, the iterators of the events to post, and the (source name, status) of the trees.
+    The event iterators are not consumed, because they evaluate the compliance checks,
+    and this must happen in the calling thread.
+    """
+    machine_snapshots = []
+    events = []
+    statuses = []
+    prepared_trees = []
+    for tree in trees:
+        try:
+            last_seen, system_uptime = MachineSnapshotCommit.objects.prepare_machine_snapshot_tree(tree)
+            prepare_commit_tree(tree)
+        except Exception:
+            logger.exception("Could not prepare machine snapshot")
+            save_dead_letter(tree, "machine snapshot commit error")
+            statuses.append((_get_tree_source_name(tree), "error"))
+        else:
+            prepared_trees.append((tree, last_seen, system_uptime))
+    # fast path for the unchanged trees
+    try:
+        unchanged_machine_snapshots = MachineSnapshotCommit.objects.update_unchanged_machine_snapshots(prepared_trees)
+    except Exception:
+        logger.exception("Could not update the unchanged machine snapshots")
+        unchanged_machine_snapshots = {}
+    changed_trees = []
+    for tree, last_seen, system_uptime in prepared_trees:
+        try:
+            machine_snapshot, last_seen_updated = unchanged_machine_snapshots[tree["mt_hash"]]
+        except KeyError:
+            changed_trees.append((tree, last_seen, system_uptime))
+        else:
+            machine_snapshots.append(machine_snapshot)
+            events.append(_iter_unchanged_machine_snapshot_events(tree, last_seen, last_seen_updated))
+            statuses.append((_get_tree_source_name(tree), "unchanged"))
+    try:
+        bulk_committed_machine_snapshots = [
+            ms for ms, _ in MachineSnapshot.objects.bulk_commit([t for t, _, _ in changed_trees], pk_cache)
+        ]
+    except Exception:
+        logger.exception("Could not bulk commit machine snapshots")
+        # one by one, to isolate the bad trees
+        bulk_committed_machine_snapshots = []
+        for tree, _, _ in changed_trees:
+            try:
+                machine_snapshot, _ = MachineSnapshot.objects.bulk_commit([tree], pk_cache)[0]
+            except Exception:
+                logger.exception("Could not commit machine snapshot")
+                save_dead_letter(tree, "machine snapshot commit error")
+                statuses.append((_get_tree_source_name(tree), "error"))
+                machine_snapshot = None
+            bulk_committed_machine_snapshots.append(machine_snapshot)
+    for (tree, last_seen, system_uptime), machine_snapshot in zip(changed_trees, bulk_committed_machine_snapshots):
+        if machine_snapshot is None:
+            continue
+        source_name = _get_tree_source_name(tree)
+        try:
+            msc, machine_snapshot, last_seen = MachineSnapshotCommit.objects.commit_machine_snapshot(
+                machine_snapshot, last_seen, system_uptime
+            )
+        except Exception:
+            logger.exception("Could not commit machine snapshot")
+            save_dead_letter(tree, "machine snapshot commit error")
+            statuses.append((source_name, "error"))
+            continue
+        machine_snapshots.append(machine_snapshot)
+        events.append(_iter_machine_snapshot_events(tree, msc, last_seen))
+        statuses.append((source_name, "updated" if msc else "unchanged"))
+    return machine_snapshots, events, statuses
+
+
+def _threaded_commit_machine_snapshot_tree_batch(trees, pk_cache):
+    try:
+        return _commit_machine_snapshot_tree_batch(trees, pk_cache)
+    finally:
+        # the DB connections are per thread
+        connections.close_all()
+
+
+def _get_tree_partition(tree, partition_count):
+    try:
+        serial_number = tree["serial_number"]
+    except (KeyError, TypeError):
+        serial_number = None
+    return hash(serial_number) % partition_count
+
+
+def _new_pk_cache():
+    return {Source: {}, BusinessUnit: {}, OSVersion: {}}
+
+
+def commit_machine_snapshot_trees(trees, max_workers=4, batch_size=100, metrics_exporter=None):
+    """Commit machine snapshot trees in batches, using a bounded pool of workers
+
+    The sources, business units and OS versions are only resolved once per worker.
+    The trees are partitioned by serial number across the workers,
+    and the batches of a worker are committed one after the other,
+    so that the trees of a machine are never committed concurrently.
+    The inventory and compliance checks events are posted in bulk, per batch, from the calling thread.
+    Returns the list of the committed machine snapshots.
+    """
+    machine_snapshots = []
+    tree_count = 0
+
+    def process_batch_result(trees, result, duration):
+        nonlocal tree_count
+        batch_machine_snapshots, event_iterators, statuses = result
+        machine_snapshots.extend(batch_machine_snapshots)
+        post_events(chain.from_iterable(event_iterators))
+        tree_count += len(trees)
+        logger.info("%s machine snapshot tree(s) processed. Batch %s in %.3fs",
+                    tree_count, len(trees), duration)
+        if metrics_exporter:
+            source_counts = Counter()
+            for source_name, status in statuses:
+                metrics_exporter.inc(TREES_COUNTER, source_name, status)
+                source_counts[source_name] += 1
+            # once per batch, usually a single source
+            for source_name, count in source_counts.items():
+                metrics_exporter.inc(TREES_SECONDS_COUNTER, source_name, value=duration * count / len(statuses))
+
+    trees = iter(trees)
+    if max_workers < 2:
+        pk_cache = _new_pk_cache()
+        for batch in iter(lambda: list(islice(trees, batch_size)), []):
+            start = time.monotonic()
+            result = _commit_machine_snapshot_tree_batch(batch, pk_cache)
+            process_batch_result(batch, result, time.monotonic() - start)
+        return machine_snapshots
+
+    def timed_batch(batch, pk_cache):
+        start = time.monotonic()
+        return _threaded_commit_machine_snapshot_tree_batch(batch, pk_cache), time.monotonic() - start
+
+    def process_futures(futures):
+        for future in futures:
+            result, duration = future.result()
+            process_batch_result(future_batches.pop(future), result, duration)
+
+    # one single thread executor and one primary key cache per partition
+    executors = [ThreadPoolExecutor(max_workers=1) for _ in range(max_workers)]
+    pk_caches = [_new_pk_cache() for _ in range(max_workers)]
+    partition_batches = [[] for _ in range(max_workers)]
+    future_batches = {}
+
+    def submit_batch(partition):
+        batch = partition_batches[partition]
+        partition_batches[partition] = []
+        if len(future_batches) >= 2 * max_workers:
+            # bound the number of trees in memory
+            done, _ = wait(future_batches, return_when=FIRST_COMPLETED)
+            process_futures(done)
+        future_batches[executors[partition].submit(timed_batch, batch, pk_caches[partition])] = batch
+
+    try:
+        for tree in trees:
+            partition = _get_tree_partition(tree, max_workers)
+            partition_batches[partition].append(tree)
+            if len(partition_batches[partition]) >= batch_size:
+                submit_batch(partition)
+        for partition, batch in enumerate(partition_batches):
+            if batch:
+                submit_batch(partition)
+        process_futures(list(future_batches))
+    finally:
+        for executor in executors:
+            executor.shutdown()
+    return machine_snapshots
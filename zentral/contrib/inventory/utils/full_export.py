@@ -1,23 +1,37 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import gzip
 import json
 import logging
 import os.path
 import tempfile
 import zipfile
+from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connections, transaction
+from django.utils.text import slugify
+from zentral.contrib.inventory.models import InventoryExportWatermark
 from zentral.utils.db import get_read_only_database
+from zentral.utils.storage import open_storage_file_for_writing
 
 
 __all__ = [
-    "do_full_export"
+    "ConcurrentIncrementalExportError",
+    "FULL_EXPORT_STREAMING_FORMATS",
+    "do_full_export",
+    "do_incremental_export",
+    "do_streaming_full_export",
 ]
 
 
 logger = logging.getLogger("zentral.contrib.inventory.utils.full_export")
 
 
+class ConcurrentIncrementalExportError(Exception):
+    pass
+
+
 FULL_EXPORT_QUERIES = [
     # first the current snapshots
     ("machine",
@@ -146,3 +160,439 @@ def do_full_export(max_temp_file_size=2**30, window_size=5000):
             "Content-Disposition": f'attachment; filename="{filename}"',
         }
     }
+
+
+# streaming export
+
+
+class StreamingWriter:
+    """Write-only, non-seekable wrapper of a storage file"""
+
+    def __init__(self, f):
+        self._f = f
+        self._position = 0
+        self._closed = False
+
+    def write(self, data):
+        self._f.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        # the storage file is closed by its owner
+        self._closed = True
+
+
+class JSONLGzipTableWriter:
+    extension = "jsonl.gz"
+
+    def __init__(self, fileobj, columns):
+        self.columns = columns
+        self._gzip_f = gzip.GzipFile(fileobj=fileobj, mode="wb")
+
+    def write_rows(self, rows):
+        for row in rows:
+            self._gzip_f.write(json.dumps(dict(zip(self.columns, row)), cls=DjangoJSONEncoder).encode("utf-8"))
+            self._gzip_f.write(b"\n")
+
+    def close(self):
+        self._gzip_f.close()
+
+
+class ParquetTableWriter:
+    extension = "parquet"
+    # PostgreSQL type OIDs
+    bool_oids = (16,)
+    int_oids = (20, 21, 23)
+    float_oids = (700, 701)
+    timestamp_oids = (1114, 1184)
+    json_oids = (114, 3802)
+
+    def __init__(self, fileobj, columns, type_codes):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self.columns = columns
+        fields = []
+        self.converters = []
+        for column, type_code in zip(columns, type_codes):
+            converter = None
+            if type_code in self.bool_oids:
+                pa_type = pa.bool_()
+            elif type_code in self.int_oids:
+                pa_type = pa.int64()
+            elif type_code in self.float_oids:
+                pa_type = pa.float64()
+            elif type_code in self.timestamp_oids:
+                pa_type = pa.timestamp("us")
+            else:
+                # JSON, arrays, text, …
+                pa_type = pa.string()
+                if type_code in self.json_oids:
+                    converter = self._dump_json
+                else:
+                    converter = self._to_string
+            fields.append(pa.field(column, pa_type))
+            self.converters.append(converter)
+        self.schema = pa.schema(fields)
+        self._writer = pq.ParquetWriter(pa.PythonFile(fileobj, mode="w"), self.schema, compression="snappy")
+
+    @staticmethod
+    def _dump_json(value):
+        if value is None or isinstance(value, str):
+            # not decoded by the DB driver
+            return value
+        return json.dumps(value, cls=DjangoJSONEncoder)
+
+    @staticmethod
+    def _to_string(value):
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, (list, dict)):
+            return json.dumps(value, cls=DjangoJSONEncoder)
+        return str(value)
+
+    def write_rows(self, rows):
+        arrays = []
+        for index, (field, converter) in enumerate(zip(self.schema, self.converters)):
+            values = [row[index] for row in rows]
+            if converter:
+                values = [converter(value) for value in values]
+            arrays.append(self._pa.array(values, type=field.type))
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+FULL_EXPORT_STREAMING_FORMATS = {
+    "jsonl": JSONLGzipTableWriter,
+    "parquet": ParquetTableWriter,
+}
+
+
+def stream_model_export(export_dir, output_format, model_name, query, window_size, query_args, snapshot_id=None):
+    # execute the query, and stream the results to the default storage
+    writer_cls = FULL_EXPORT_STREAMING_FORMATS[output_format]
+    filepath = os.path.join(export_dir, f"zentral_{model_name}.{writer_cls.extension}")
+    database = get_read_only_database()
+    row_count = 0
+    with transaction.atomic(using=database), connections[database].chunked_cursor() as cursor:
+        if snapshot_id:
+            # same snapshot as the other table exports
+            with connections[database].cursor() as snapshot_cursor:
+                snapshot_cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                snapshot_cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot_id])
+        cursor.itersize = window_size
+        cursor.execute(query, query_args)
+        rows = cursor.fetchmany(window_size)
+        # server side cursor → description only available after the first fetch
+        writer_args = [[c.name for c in cursor.description]]
+        if writer_cls is ParquetTableWriter:
+            writer_args.append([c.type_code for c in cursor.description])
+        with open_storage_file_for_writing(default_storage, filepath) as f:
+            writer = writer_cls(StreamingWriter(f), *writer_args)
+            while rows:
+                writer.write_rows(rows)
+                row_count += len(rows)
+                rows = cursor.fetchmany(window_size)
+            writer.close()
+    return {"model": model_name, "filepath": filepath, "rows": row_count}
+
+
+def _threaded_stream_model_export(*args):
+    try:
+        return stream_model_export(*args)
+    finally:
+        # the DB connections are per thread
+        connections.close_all()
+
+
+def stream_model_exports(export_dir, output_format, queries, query_args, max_workers, window_size):
+    """Export the tables, with a consistent view of the database
+
+    The queries run in a REPEATABLE READ transaction. With multiple workers, its snapshot is exported,
+    and imported by the transactions of the workers. Within an existing transaction, the snapshot
+    cannot be exported, and the queries run one after the other in this transaction.
+    """
+    if output_format not in FULL_EXPORT_STREAMING_FORMATS:
+        raise ValueError(f"Unknown full export format: {output_format}")
+    args_list = [(export_dir, output_format, model_name, query, window_size, query_args)
+                 for model_name, query in queries]
+    database = get_read_only_database()
+    connection = connections[database]
+    if connection.in_atomic_block:
+        return [stream_model_export(*args) for args in args_list]
+    with transaction.atomic(using=database), connection.cursor() as cursor:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        if max_workers < 2:
+            return [stream_model_export(*args) for args in args_list]
+        # kept open until all the workers are done
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot_id = cursor.fetchone()[0]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda args: _threaded_stream_model_export(*args, snapshot_id), args_list))
+
+
+def save_export_manifest(export_dir, manifest):
+    filename = "manifest.json"
+    filepath = default_storage.save(
+        os.path.join(export_dir, filename),
+        ContentFile(json.dumps(manifest, cls=DjangoJSONEncoder, indent=2).encode("utf-8"))
+    )
+
+    # return info for task
+    return {
+        "filepath": filepath,
+        "headers": {
+            "Content-Type": "application/json",
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        }
+    }
+
+
+def do_streaming_full_export(output_format="jsonl", max_workers=4, window_size=5000):
+    """Export the full inventory, one file per table, directly to the default storage
+
+    The table queries run concurrently on the read-only database.
+    The export manifest is returned for download.
+    """
+    export_dt = datetime.utcnow()
+    export_dir = os.path.join("exports", f"full_inventory_export-{export_dt:%Y-%m-%d_%H-%M-%S}")
+    files = stream_model_exports(export_dir, output_format, FULL_EXPORT_QUERIES, [export_dt],
+                                 max_workers, window_size)
+    return save_export_manifest(export_dir, {
+        "exported_at": export_dt,
+        "format": output_format,
+        "files": files,
+    })
+
+
+# incremental export
+
+
+INCREMENTAL_EXPORT_CTES = (
+    "with recursive "
+    # current snapshots of the machines with commits in the export window…
+    "changed_cms as ("
+    " select cms.id, cms.serial_number, cms.last_seen, cms.machine_snapshot_id"
+    " from inventory_machinesnapshotcommit msc"
+    " join inventory_currentmachinesnapshot cms"
+    " on (cms.serial_number = msc.serial_number and cms.source_id = msc.source_id)"
+    " where (msc.created_at, msc.id) > (%(commit_created_at_gt)s, %(commit_id_gt)s)"
+    " and (msc.created_at, msc.id) <= (%(commit_created_at_lte)s, %(commit_id_lte)s)"
+    # … or seen in the export window, without new commits
+    " union"
+    " select cms.id, cms.serial_number, cms.last_seen, cms.machine_snapshot_id"
+    " from inventory_currentmachinesnapshot cms"
+    " where cms.last_seen > %(last_seen_gt)s and cms.last_seen <= %(last_seen_lte)s"
+    "), changed_ms as ("
+    " select ms.* from inventory_machinesnapshot ms"
+    " where ms.id in (select machine_snapshot_id from changed_cms)"
+    "), changed_osxappinstance as ("
+    " select * from inventory_osxappinstance"
+    " where id in (select osxappinstance_id from inventory_machinesnapshot_osx_app_instances"
+    "              where machinesnapshot_id in (select id from changed_ms))"
+    "), changed_profile as ("
+    " select * from inventory_profile"
+    " where id in (select profile_id from inventory_machinesnapshot_profiles"
+    "              where machinesnapshot_id in (select id from changed_ms))"
+    "), changed_certificate(id) as ("
+    " select certificate_id from inventory_machinesnapshot_certificates"
+    " where machinesnapshot_id in (select id from changed_ms)"
+    " union select signed_by_id from changed_osxappinstance where signed_by_id is not null"
+    " union select signed_by_id from changed_profile where signed_by_id is not null"
+    # signing chains
+    " union select c.signed_by_id from inventory_certificate c"
+    " join changed_certificate cc on (cc.id = c.id) where c.signed_by_id is not null"
+    ") "
+)
+
+
+def _changed_ms_m2m_query(table, column, alias):
+    return (f"select machinesnapshot_id ms_id, {column} {alias} "
+            f"from inventory_machinesnapshot_{table} "
+            "where machinesnapshot_id in (select id from changed_ms)")
+
+
+def _changed_ms_m2m_objects_query(model_table, table, column):
+    return (f"select * from inventory_{model_table} "
+            f"where id in (select {column} from inventory_machinesnapshot_{table} "
+            "where machinesnapshot_id in (select id from changed_ms))")
+
+
+INCREMENTAL_EXPORT_QUERIES = [
+    (model_name, INCREMENTAL_EXPORT_CTES + query)
+    for model_name, query in (
+        # first the changed current snapshots
+        ("machine",
+         "select cms.serial_number, cms.last_seen,"
+         "ms.id ms_id, ms.mt_hash, ms.mt_created_at,"
+         "ms.business_unit_id, ms.ec2_instance_metadata_id, ms.os_version_id,"
+         "ms.principal_user_id, ms.source_id, ms.system_info_id,"
+         "ms.reference, ms.public_ip_address, ms.platform, ms.type, ms.imei, ms.meid, ms.extra_facts "
+         "from changed_cms cms "
+         "join changed_ms ms on (cms.machine_snapshot_id = ms.id)"),
+        # meta/business units
+        ("business_unit",
+         "select * from inventory_businessunit "
+         "where id in (select business_unit_id from changed_ms)"),
+        ("meta_business_unit",
+         "select * from inventory_metabusinessunit "
+         "where id in (select bu.meta_business_unit_id from inventory_businessunit bu "
+         "join changed_ms ms on (ms.business_unit_id = bu.id))"),
+        # extra many to one tables
+        ("os_version",
+         "select * from inventory_osversion where id in (select os_version_id from changed_ms)"),
+        ("principal_user",
+         "select * from inventory_principaluser where id in (select principal_user_id from changed_ms)"),
+        ("source",
+         "select id, mt_hash, mt_created_at, module, name from inventory_source "
+         "where id in (select source_id from changed_ms)"),
+        ("system_info",
+         "select * from inventory_systeminfo where id in (select system_info_id from changed_ms)"),
+        # certificates
+        ("certificate",
+         "select * from inventory_certificate where id in (select id from changed_certificate)"),
+        ("machine_certificate", _changed_ms_m2m_query("certificates", "certificate_id", "certificate_id")),
+        # profiles
+        ("profile", "select * from changed_profile"),
+        ("machine_profile", _changed_ms_m2m_query("profiles", "profile_id", "profile_id")),
+        # macOS apps
+        ("macos_app",
+         "select * from inventory_osxapp where id in (select app_id from changed_osxappinstance)"),
+        ("macos_app_instance",
+         "select id, mt_hash, mt_created_at,"
+         "bundle_path, path, sha_1, sha_256, type, app_id macos_app_id, signed_by_id "
+         "from changed_osxappinstance"),
+        ("machine_macos_app_instance",
+         _changed_ms_m2m_query("osx_app_instances", "osxappinstance_id", "macos_app_instance_id")),
+        # Android apps
+        ("android_app", _changed_ms_m2m_objects_query("androidapp", "android_apps", "androidapp_id")),
+        ("machine_android_app", _changed_ms_m2m_query("android_apps", "androidapp_id", "android_app_id")),
+        # Debian packages
+        ("deb_package", _changed_ms_m2m_objects_query("debpackage", "deb_packages", "debpackage_id")),
+        ("machine_deb_package", _changed_ms_m2m_query("deb_packages", "debpackage_id", "deb_package_id")),
+        # EC2
+        ("ec2_instance_metadata",
+         "select * from inventory_ec2instancemetadata "
+         "where id in (select ec2_instance_metadata_id from changed_ms)"),
+        ("ec2_instance_tag",
+         _changed_ms_m2m_objects_query("ec2instancetag", "ec2_instance_tags", "ec2instancetag_id")),
+        ("machine_ec2_instance_tag",
+         _changed_ms_m2m_query("ec2_instance_tags", "ec2instancetag_id", "ec2_instance_tag_id")),
+        # iOS apps
+        ("ios_app", _changed_ms_m2m_objects_query("iosapp", "ios_apps", "iosapp_id")),
+        ("machine_ios_app", _changed_ms_m2m_query("ios_apps", "iosapp_id", "ios_app_id")),
+        # Programs
+        ("program",
+         "select * from inventory_program "
+         "where id in (select program_id from inventory_programinstance "
+         "where id in (select programinstance_id from inventory_machinesnapshot_program_instances "
+         "where machinesnapshot_id in (select id from changed_ms)))"),
+        ("program_instance",
+         _changed_ms_m2m_objects_query("programinstance", "program_instances", "programinstance_id")),
+        ("machine_program_instance",
+         _changed_ms_m2m_query("program_instances", "programinstance_id", "program_instance_id")),
+    )
+] + [
+    # archived machines, not seen again
+    ("machine_tombstone",
+     "select t.serial_number, t.source_id, t.created_at archived_at "
+     "from inventory_machinesnapshottombstone t "
+     "where (t.created_at, t.id) > (%(tombstone_created_at_gt)s, %(tombstone_id_gt)s) "
+     "and (t.created_at, t.id) <= (%(tombstone_created_at_lte)s, %(tombstone_id_lte)s) "
+     "and not exists (select 1 from inventory_currentmachinesnapshot cms "
+     "where cms.serial_number = t.serial_number and cms.source_id = t.source_id)"),
+]
+
+
+def _get_incremental_export_upper_bound(table, max_created_at):
+    database = get_read_only_database()
+    with connections[database].cursor() as cursor:
+        cursor.execute(f"select created_at, id from {table} where created_at <= %s "
+                       "order by created_at desc, id desc limit 1", [max_created_at])
+        return cursor.fetchone()
+
+
+def do_incremental_export(name="default", output_format="jsonl", max_workers=4, window_size=5000,
+                          settle_delay=60):
+    """Export the inventory changes since the last export with the same name
+
+    Only the machines with machine snapshot commits or seen since the last export are exported,
+    with their dependent rows, and the tombstones of the archived machines.
+    The first export contains all the current machines.
+    The rows created in the last settle_delay seconds are left for the next export,
+    to give the transactions that created them the time to be committed.
+    ConcurrentIncrementalExportError is raised, and the watermark is not updated,
+    if another export with the same name has been done in the meantime.
+    """
+    export_dt = datetime.utcnow()
+    export_dir = os.path.join("exports",
+                              f"incremental_inventory_export-{slugify(name)}-{export_dt:%Y-%m-%d_%H-%M-%S}")
+    max_created_at = export_dt - timedelta(seconds=settle_delay)
+    # read without lock. The export runs outside of any transaction, to use an exported snapshot.
+    # The concurrent exports with the same name are detected when the new watermark is saved.
+    watermark = InventoryExportWatermark.objects.filter(name=name).first()
+    # (created_at, id) bounds. None → nothing exported yet.
+    commit_gt = tombstone_gt = last_seen_gt = None
+    if watermark and watermark.machine_snapshot_commit_id is not None:
+        commit_gt = (watermark.machine_snapshot_commit_created_at, watermark.machine_snapshot_commit_id)
+    commit_lte = _get_incremental_export_upper_bound("inventory_machinesnapshotcommit",
+                                                     max_created_at) or commit_gt
+    tombstone_lte = _get_incremental_export_upper_bound("inventory_machinesnapshottombstone",
+                                                        max_created_at)
+    if watermark is None:
+        # the first export only contains the current machines
+        tombstone_gt = tombstone_lte
+    else:
+        if watermark.tombstone_id is not None:
+            tombstone_gt = (watermark.tombstone_created_at, watermark.tombstone_id)
+        # the last seen values are only updated when the machines are seen again without changes
+        last_seen_gt = watermark.current_machine_snapshot_last_seen
+    tombstone_lte = tombstone_lte or tombstone_gt
+    last_seen_lte = max_created_at
+    query_args = {"last_seen_gt": last_seen_gt or datetime.min,
+                  "last_seen_lte": last_seen_lte}
+    for prefix, bound_suffix, bound in (("commit", "gt", commit_gt),
+                                        ("commit", "lte", commit_lte),
+                                        ("tombstone", "gt", tombstone_gt),
+                                        ("tombstone", "lte", tombstone_lte)):
+        created_at, pk = bound or (datetime.min, 0)
+        query_args[f"{prefix}_created_at_{bound_suffix}"] = created_at
+        query_args[f"{prefix}_id_{bound_suffix}"] = pk
+    files = stream_model_exports(export_dir, output_format, INCREMENTAL_EXPORT_QUERIES, query_args,
+                                 max_workers, window_size)
+    result = save_export_manifest(export_dir, {
+        "exported_at": export_dt,
+        "format": output_format,
+        "name": name,
+        "watermark": {
+            "machine_snapshot_commit": {"from": commit_gt, "to": commit_lte},
+            "current_machine_snapshot_last_seen": {"from": last_seen_gt, "to": last_seen_lte},
+            "tombstone": {"from": tombstone_gt, "to": tombstone_lte},
+        },
+        "files": files,
+    })
+    # persist the new watermark, if it has not been moved by a concurrent export
+    with transaction.atomic():
+        new_watermark, created = InventoryExportWatermark.objects.select_for_update().get_or_create(name=name)
+        if created != (watermark is None) or (watermark and new_watermark.updated_at != watermark.updated_at):
+            raise ConcurrentIncrementalExportError(f"Concurrent incremental inventory export '{name}'")
+        if commit_lte:
+            new_watermark.machine_snapshot_commit_created_at, new_watermark.machine_snapshot_commit_id = commit_lte
+        new_watermark.current_machine_snapshot_last_seen = last_seen_lte
+        if tombstone_lte:
+            new_watermark.tombstone_created_at, new_watermark.tombstone_id = tombstone_lte
+        new_watermark.save()
+    return result
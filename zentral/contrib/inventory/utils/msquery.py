@@ -1,16 +1,19 @@
 from collections import OrderedDict
 import csv
 from datetime import datetime, timedelta
+import hashlib
 from itertools import chain
 import json
 import logging
 import os
 import re
 import tempfile
+import time
 import urllib.parse
 import zipfile
 from dateutil import parser
 from django import forms
+from django.core.cache import cache
 from django.db import connection
 from django.http import QueryDict
 from django.urls import reverse
@@ -18,7 +21,9 @@ from django.utils.text import slugify
 import weakref
 import xlsxwriter
 from zentral.contrib.inventory.conf import EC2, os_version_display, os_version_version_display
-from zentral.contrib.inventory.models import MetaMachine
+from zentral.conf import settings
+from zentral.contrib.inventory.models import (MetaMachine, get_inventory_search_generation,
+                                              machine_search_index_enabled)
 from zentral.core.compliance_checks.models import ComplianceCheck, Status as ComplianceCheckStatus
 from zentral.core.incidents.models import Severity, Status
 from zentral.utils.text import decode_args, encode_args
@@ -51,6 +56,20 @@ __all__ = [
 logger = logging.getLogger("zentral.contrib.inventory.utils.msquery")
 
 
+GROUPING_RESULTS_CACHE_KEY_PREFIX = "inventory_msquery_grouping_"
+
+
+def get_search_facets_cache_config():
+    return settings["apps"]["zentral.contrib.inventory"].get("search_facets_cache", {})
+
+
+# see MachineSearchIndex. Same join for all the filters, to be deduplicated.
+MACHINE_SEARCH_INDEX_JOIN = (
+    "left join inventory_machinesearchindex as msi "
+    "on (msi.serial_number = ms.serial_number and msi.source_id = ms.source_id)"
+)
+
+
 class MSQueryValueError(Exception):
     def __init__(self, query_kwarg):
         super().__init__(f"Invalid MSQuery value for '{query_kwarg}'")
@@ -416,6 +435,10 @@ class TagFilter(BaseMSFilter):
     grouping_set = ("t.id", "tag_j")
 
     def joins(self):
+        if self.msquery.use_search_index():
+            return [MACHINE_SEARCH_INDEX_JOIN,
+                    "left join inventory_tag as t on (t.id = any(msi.tag_ids))",
+                    "left join inventory_metabusinessunit as tmbu on (tmbu.id = t.meta_business_unit_id)"]
         return [("left join lateral ("
                  "select distinct * "
                  "from inventory_tag "
@@ -435,12 +458,17 @@ class TagFilter(BaseMSFilter):
     def wheres(self):
         if self.value:
             if self.value != self.none_value:
+                if self.msquery.use_search_index():
+                    # to use the GIN index
+                    yield "msi.tag_ids @> array[%s]::integer[]"
                 yield "t.id = %s"
             else:
                 yield "t.id is null"
 
     def where_args(self):
         if self.value and self.value != self.none_value:
+            if self.msquery.use_search_index():
+                yield self.value
             yield self.value
 
     def grouping_value_from_grouping_result(self, grouping_result):
@@ -1297,11 +1325,24 @@ class ComplianceStatusFilter(BaseMSFilter):
     title = "Compliance status"
     optional = True
     query_kwarg = "cs"
-    expression = "cs.max_compliance_check_status"
-    grouping_set = ("cs.max_compliance_check_status",)
     statuses_dict = dict(ComplianceCheckStatus.choices())
 
+    @property
+    def alias(self):
+        return "msi" if self.msquery.use_search_index() else "cs"
+
+    @property
+    def expression(self):
+        return f"{self.alias}.max_compliance_check_status"
+
+    @property
+    def grouping_set(self):
+        return (f"{self.alias}.max_compliance_check_status",)
+
     def joins(self):
+        if self.msquery.use_search_index():
+            yield MACHINE_SEARCH_INDEX_JOIN
+            return
         yield (
             "left join ("
             "select serial_number as serial_number, max(status) as max_compliance_check_status "
@@ -1315,9 +1356,9 @@ class ComplianceStatusFilter(BaseMSFilter):
     def wheres(self):
         if self.value is not None:
             if self.value != self.none_value:
-                yield "cs.max_compliance_check_status = %s"
+                yield f"{self.alias}.max_compliance_check_status = %s"
             else:
-                yield "cs.max_compliance_check_status is null"
+                yield f"{self.alias}.max_compliance_check_status is null"
 
     def where_args(self):
         if self.value is not None and self.value != self.none_value:
@@ -1350,13 +1391,25 @@ class ComplianceCheckStatusFilter(BaseMSFilter):
             raise MSQueryValueError("ccs")
         self.title = self.compliance_check.name
         super().__init__(*args, **kwargs)
-        self.expression = f"ccs{self.idx}.max_compliance_check_status as ccs{self.idx}_max_compliance_check_status"
-        self.grouping_set = (
-            f"ccs{self.idx}.max_compliance_check_status",
-            f"ccs{self.idx}_max_compliance_check_status"
-        )
+
+    @property
+    def status_expression(self):
+        if self.msquery.use_search_index():
+            return f"(msi.compliance_check_statuses->>'{self.compliance_check.pk:d}')::integer"
+        return f"ccs{self.idx}.max_compliance_check_status"
+
+    @property
+    def expression(self):
+        return f"{self.status_expression} as ccs{self.idx}_max_compliance_check_status"
+
+    @property
+    def grouping_set(self):
+        return (self.status_expression, f"ccs{self.idx}_max_compliance_check_status")
 
     def joins(self):
+        if self.msquery.use_search_index():
+            yield MACHINE_SEARCH_INDEX_JOIN
+            return
         yield (
             "left join ("
             "select serial_number as serial_number, max(status) as max_compliance_check_status "
@@ -1371,9 +1424,9 @@ class ComplianceCheckStatusFilter(BaseMSFilter):
     def wheres(self):
         if self.value is not None:
             if self.value != self.none_value:
-                yield f"ccs{self.idx}.max_compliance_check_status = %s"
+                yield f"{self.status_expression} = %s"
             else:
-                yield f"ccs{self.idx}.max_compliance_check_status is null"
+                yield f"{self.status_expression} is null"
 
     def where_args(self):
         if self.value is not None and self.value != self.none_value:
@@ -1516,6 +1569,15 @@ class MSQuery:
             if not self.is_search and not isinstance(f, LastSeenFilter) and not f.hidden and f.value:
                 self.is_search = True
 
+    def use_search_index(self):
+        """Whether the filters can read from the machine search index
+
+        The index only covers the current machine snapshots.
+        """
+        return machine_search_index_enabled() and not any(
+            isinstance(f, DateTimeFilter) and f.value for f in self.filters
+        )
+
     def force_filter(self, filter_class, **filter_kwargs):
         """replace an existing filter from the same class or add it"""
         found_f = None
@@ -1693,9 +1755,51 @@ class MSQuery:
             results.append(dict(zip(columns, row)))
         return results
 
+    def _get_grouping_cache_key(self):
+        return GROUPING_RESULTS_CACHE_KEY_PREFIX + hashlib.sha256(
+            self.get_urlencoded_canonical_query_dict().encode("utf-8")
+        ).hexdigest()
+
+    def refresh_grouping_results(self):
+        """Run the grouping query, and cache its results if the facets cache is enabled"""
+        config = get_search_facets_cache_config()
+        ttl = int(config.get("ttl", 0))
+        if ttl <= 0:
+            self._grouping_results = self._make_grouping_query()
+            return self._grouping_results
+        cache_key = self._get_grouping_cache_key()
+        # before the query, to never cache results older than their generation
+        generation = get_inventory_search_generation()
+        self._grouping_results = self._make_grouping_query()
+        cache.set(cache_key, (generation, time.time(), self._grouping_results), ttl)
+        cache.delete(f"{cache_key}_refresh")
+        return self._grouping_results
+
+    def _get_cached_grouping_results(self):
+        config = get_search_facets_cache_config()
+        if int(config.get("ttl", 0)) <= 0:
+            return
+        cache_key = self._get_grouping_cache_key()
+        cached_value = cache.get(cache_key)
+        if not cached_value:
+            return
+        generation, cached_at, grouping_results = cached_value
+        if generation == get_inventory_search_generation():
+            return grouping_results
+        max_stale_age = int(config.get("max_stale_age", 60))
+        if time.time() - cached_at > max_stale_age:
+            return
+        # slightly stale results, refreshed in the background
+        if cache.add(f"{cache_key}_refresh", 1, max(max_stale_age, 1)):
+            from zentral.contrib.inventory.tasks import refresh_msquery_grouping_results  # circular dep
+            refresh_msquery_grouping_results.apply_async((self.get_urlencoded_canonical_query_dict(),))
+        return grouping_results
+
     def _get_grouping_results(self):
         if self._grouping_results is None:
-            self._grouping_results = self._make_grouping_query()
+            self._grouping_results = self._get_cached_grouping_results()
+            if self._grouping_results is None:
+                self.refresh_grouping_results()
         return self._grouping_results
 
     def count(self):
@@ -1,6 +1,7 @@
 import logging
 import time
 from .clients import clients, InventoryError
+from .utils import add_commit_machine_snapshot_trees_counters
 
 
 logger = logging.getLogger("zentral.contrib.inventory.workers")
@@ -20,12 +21,16 @@ class InventoryWorker:
         self.log_info("run")
         self.metrics_exporter = metrics_exporter
         if self.metrics_exporter:
+            add_commit_machine_snapshot_trees_counters(self.metrics_exporter)
             self.metrics_exporter.start()
         while True:
+            start = time.monotonic()
             try:
-                self.client.sync()
+                self.client.sync(metrics_exporter=self.metrics_exporter)
             except InventoryError:
                 logger.exception("Inventory client %s", self.client.name)
+            else:
+                self.log_info("sync done in %.3f seconds" % (time.monotonic() - start))
             self.log_info("sleep %s seconds" % self.sleep)
             time.sleep(self.sleep)
             self.log_info("resuming")
@@ -1,6 +1,7 @@
 import logging
 from django.db import connection
-from zentral.contrib.inventory.models import MachineTag, PrincipalUserSource
+from zentral.contrib.inventory.models import (MachineSearchIndex, MachineTag, MetaMachine, PrincipalUserSource,
+                                              bump_inventory_search_generation)
 from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
 from zentral.contrib.mdm.models import Blueprint, Command, DeviceCommand, Platform, RealmGroupTagMapping
 
@@ -217,8 +218,14 @@ def update_realm_tags(realm):
     cursor = connection.cursor()
     cursor.execute(query, {"realm_pk": realm.pk})
     columns = [col[0] for col in cursor.description]
-    for result in cursor.fetchall():
-        yield dict(zip(columns, result))
+    results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    serial_numbers = {result["serial_number"] for result in results}
+    for serial_number in serial_numbers:
+        MetaMachine(serial_number).clear_cached_info()
+    if serial_numbers:
+        bump_inventory_search_generation()
+    MachineSearchIndex.objects.refresh(serial_numbers=serial_numbers)
+    yield from results
 
 
 def realm_group_members_updated_receiver(sender, **kwargs):
@@ -1,5 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
+import threading
 from django.db import connection
 import psycopg2.extras
 from zentral.utils.leaky_bucket import LeakyBucket
@@ -65,6 +67,22 @@ class BaseAPNSWorker:
             raise ImproperlyConfigured("APNS workers capacity and rate must be floats")
         self.notification_leaky_bucket = LeakyBucket(lb_capacity, lb_rate)
 
+        # the notifications of a batch are sent concurrently,
+        # multiplexed over the HTTP/2 connection of each push certificate topic client.
+        try:
+            # default concurrency: 10 (min 1, max 100)
+            self.concurrency = min(max(1, int(workers_conf.get("concurrency", 10))), 100)
+            # default concurrency per topic: the concurrency (min 1, max concurrency)
+            self.topic_concurrency = min(
+                max(1, int(workers_conf.get("topic_concurrency", self.concurrency))),
+                self.concurrency
+            )
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("APNS workers concurrency and topic concurrency must be integers")
+        self._executor = None
+        self._topic_semaphores = {}
+        self._topic_semaphores_lock = threading.Lock()
+
         # we also need to rate limit the DB queries, to avoid querying the DB
         # in a closed short loop if no targets are acquired and the notification
         # rate limit is not used.
@@ -110,27 +128,63 @@ class BaseAPNSWorker:
                 a_id if self.target_type == "user" else None,
             )
 
+    def get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="apns_worker")
+        return self._executor
+
+    def shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def get_topic_semaphore(self, topic):
+        with self._topic_semaphores_lock:
+            semaphore = self._topic_semaphores.get(topic)
+            if semaphore is None:
+                semaphore = self._topic_semaphores[topic] = threading.BoundedSemaphore(self.topic_concurrency)
+            return semaphore
+
+    def notify_target(self, client, topic, pk, a_id, serial_number, udid, token, push_magic):
+        with self.get_topic_semaphore(topic):
+            # rate limit the notifications
+            self.notification_leaky_bucket.consume()
+            success = client.send_notification(
+                token, push_magic,
+                priority=self.apns_priority,
+                expiration_seconds=self.apns_expiration_seconds
+            )
+        if success:
+            self.inc_counter("success")
+            return pk, a_id, serial_number, udid, datetime.utcnow()
+        else:
+            self.inc_counter("failure")
+            return pk, a_id, serial_number, udid, None
+
     def run_once(self):
         updates = []
+        futures = []
         for pk, a_id, serial_number, udid, token, push_magic, topic, not_after in self.acquire_next_targets():
+            # the clients are fetched or created in the main thread, because of the DB queries
             client = apns_client_cache.get_or_create(topic, not_after)
             if not client:
                 self.inc_counter("no_client")
                 updates.append((pk, a_id, serial_number, udid, None))
             else:
-                # rate limit the notifications
-                self.notification_leaky_bucket.consume()
-                success = client.send_notification(
-                    token, push_magic,
-                    priority=self.apns_priority,
-                    expiration_seconds=self.apns_expiration_seconds
-                )
-                if success:
-                    self.inc_counter("success")
-                    updates.append((pk, a_id, serial_number, udid, datetime.utcnow()))
-                else:
-                    self.inc_counter("failure")
-                    updates.append((pk, a_id, serial_number, udid, None))
+                futures.append((
+                    (pk, a_id, serial_number, udid),
+                    self.get_executor().submit(
+                        self.notify_target,
+                        client, topic, pk, a_id, serial_number, udid, token, push_magic
+                    )
+                ))
+        for target, future in futures:
+            try:
+                updates.append(future.result())
+            except Exception:
+                logger.exception("Could not notify %s %s", self.target_type, target[1])
+                self.inc_counter("failure")
+                updates.append(target + (None,))
         self.process_target_updates(updates)
 
     def run(self, metrics_exporter=None, only_once=False):
@@ -149,6 +203,7 @@ class BaseAPNSWorker:
                 exit_code = 1
             if exit_code or only_once:
                 break
+        self.shutdown_executor()
         queues.stop()
         return exit_code
 
@@ -1,6 +1,9 @@
+import hashlib
 import logging
 from zentral.contrib.inventory.conf import LINUX, MACOS, WINDOWS
-from django.db.models import Q
+from django.core.cache import cache
+from django.db.models import Prefetch, Q
+from .models import get_osquery_conf_generation, PackQuery
 
 
 logger = logging.getLogger('zentral.contrib.osquery.conf')
@@ -168,7 +171,7 @@ def build_osquery_conf(machine, enrollment):
         }
 
     # File categories
-    for file_category in configuration.file_categories.all():
+    for file_category in configuration.file_categories.order_by("pk"):
         key = file_category.slug
         if file_category.file_paths:
             conf.setdefault("file_paths", {})[key] = file_category.file_paths
@@ -180,7 +183,7 @@ def build_osquery_conf(machine, enrollment):
             conf.setdefault("file_accesses", []).append(key)
 
     # ATCs
-    for atc in configuration.automatic_table_constructions.all():
+    for atc in configuration.automatic_table_constructions.order_by("pk"):
         conf.setdefault("auto_table_construction", {})[atc.table_name] = {
             "query": atc.query,
             "path": atc.path,
@@ -189,13 +192,54 @@ def build_osquery_conf(machine, enrollment):
         }
 
     # Packs
+    # ordered, for a stable output across the builds
+    pack_query_qs = PackQuery.objects.select_related("query__compliance_check", "query__tag").order_by("pk")
     for configuration_pack in (configuration.configurationpack_set
                                             .distinct()
-                                            .filter(Q(tags__isnull=True) | Q(tags__in=machine.tags))
+                                            .filter(Q(tags__isnull=True) | Q(tags__in=get_machine_tag_ids(machine)))
                                             .select_related("pack")
-                                            .prefetch_related("pack__packquery_set__query__compliance_check",
-                                                              "pack__packquery_set__query__tag")):
+                                            .prefetch_related(Prefetch("pack__packquery_set", queryset=pack_query_qs))
+                                            .order_by("pk")):
         pack = configuration_pack.pack
         conf.setdefault("packs", {})[pack.configuration_key()] = pack.serialize()
 
     return conf
+
+
+OSQUERY_CONF_CACHE_KEY_PREFIX = "osquery_conf_"
+OSQUERY_CONF_TTL = 3600  # safety net, the cached confs are invalidated on change
+
+
+def get_machine_tag_ids(machine):
+    return sorted(pk for pk, _ in machine.tag_pks_and_names)
+
+
+def get_osquery_conf_cache_key(machine, enrollment):
+    """Return the cache key of the machine osquery conf
+
+    The conf only depends on the configuration, the machine tags, and for the inventory, the machine platform.
+    """
+    configuration = enrollment.configuration
+    items = [str(get_osquery_conf_generation()),
+             configuration.updated_at.isoformat(),
+             ",".join(str(pk) for pk in get_machine_tag_ids(machine))]
+    if configuration.inventory:
+        items.append(str(machine.platform))
+        if configuration.inventory_apps and machine.platform not in (MACOS, WINDOWS):
+            items.append(str(machine.has_deb_packages))
+    digest = hashlib.sha1("|".join(items).encode("utf-8")).hexdigest()
+    return f"{OSQUERY_CONF_CACHE_KEY_PREFIX}{configuration.pk}_{digest}"
+
+
+def get_osquery_conf(machine, enrollment):
+    """Cached version of build_osquery_conf
+
+    The machines sharing the same configuration, tags and platform get the same conf,
+    and osquery skips the reload of an unchanged conf.
+    """
+    cache_key = get_osquery_conf_cache_key(machine, enrollment)
+    conf = cache.get(cache_key)
+    if conf is None:
+        conf = build_osquery_conf(machine, enrollment)
+        cache.set(cache_key, conf, OSQUERY_CONF_TTL)
+    return conf
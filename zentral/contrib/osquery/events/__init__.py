@@ -1,8 +1,11 @@
 from datetime import datetime
+import json
 import logging
 import uuid
-from zentral.core.events.base import BaseEvent, EventMetadata, EventRequest, register_event_type
+from zentral.core.events.base import BaseEvent, EventMetadata, EventRequest, post_events, register_event_type
+from zentral.core.queues import queues
 from zentral.contrib.osquery.compliance_checks import ComplianceCheckStatusAggregator
+from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME
 from zentral.contrib.osquery.models import parse_result_name, EnrolledMachine, PackQuery, QueryType
 from zentral.contrib.osquery.tags import TagUpdateAggregator
 
@@ -198,6 +201,10 @@ def post_request_event(msn, user_agent, ip, request_type, enrollment):
     OsqueryRequestEvent.post_machine_request_payloads(msn, user_agent, ip, [data])
 
 
+def iter_file_carve_events(msn, user_agent, ip, payloads):
+    yield from OsqueryFileCarvingEvent.build_from_machine_request_payloads(msn, user_agent, ip, payloads)
+
+
 def post_file_carve_events(msn, user_agent, ip, payloads):
     OsqueryFileCarvingEvent.post_machine_request_payloads(msn, user_agent, ip, payloads)
 
@@ -222,22 +229,25 @@ def _post_events(msn, user_agent, ip, event_cls, records):
     )
 
 
-def post_status_logs(msn, user_agent, ip, logs):
-    OsqueryStatusEvent.post_machine_request_payloads(
+def iter_status_log_events(msn, user_agent, ip, logs):
+    yield from OsqueryStatusEvent.build_from_machine_request_payloads(
         msn, user_agent, ip,
         _iter_cleaned_up_records(logs),
         _get_record_created_at
     )
 
 
-def post_results(msn, user_agent, ip, results):
+def post_status_logs(msn, user_agent, ip, logs):
+    post_events(iter_status_log_events(msn, user_agent, ip, logs))
+
+
+def _build_result_events(msn, user_agent, ip, results, cc_status_agg, tag_update_agg):
     event_uuid = uuid.uuid4()
     if user_agent or ip:
         request = EventRequest(user_agent, ip)
     else:
         request = None
-    cc_status_agg = ComplianceCheckStatusAggregator(msn)
-    tag_update_agg = TagUpdateAggregator(msn)
+    events = []
     for index, result in enumerate(_iter_cleaned_up_records(results)):
         try:
             event_time = _get_record_created_at(result)
@@ -256,17 +266,90 @@ def post_results(msn, user_agent, ip, results):
             query_pk = query_version = event_routing_key = None
         if event_routing_key:
             event.metadata.routing_key = event_routing_key
-        event.post()
+        events.append(event)
         snapshot = event.payload.get("snapshot")
         if snapshot is not None and query_pk is not None and query_version is not None:
             if query_type == QueryType.COMPLIANCE_CHECK:
                 cc_status_agg.add_result(query_pk, query_version, event_time, snapshot)
             elif query_type == QueryType.TAG:
                 tag_update_agg.add_result(query_pk, query_version, event_time, snapshot)
+    return events
+
+
+def iter_result_events(msn, user_agent, ip, results):
+    """Yield the result events and the compliance check status events, and commit the tag updates"""
+    cc_status_agg = ComplianceCheckStatusAggregator(msn)
+    tag_update_agg = TagUpdateAggregator(msn)
+    yield from _build_result_events(msn, user_agent, ip, results, cc_status_agg, tag_update_agg)
+    yield from cc_status_agg.commit()
+    tag_update_agg.commit()
+
+
+def post_results(msn, user_agent, ip, results):
+    cc_status_agg = ComplianceCheckStatusAggregator(msn)
+    tag_update_agg = TagUpdateAggregator(msn)
+    post_events(_build_result_events(msn, user_agent, ip, results, cc_status_agg, tag_update_agg))
     cc_status_agg.commit_and_post_events()
     tag_update_agg.commit()
 
 
+# below the 256KiB SQS message size limit, with some room for the envelope
+RAW_EVENT_MAX_BYTES = 192 * 1024
+
+
+def _iter_size_bounded_batches(items):
+    """Yield the items in batches of at most RAW_EVENT_MAX_BYTES, once JSON serialized
+
+    An item bigger than the limit is yielded in its own batch.
+    """
+    batch = []
+    batch_size = 0
+    for item in items:
+        # JSON serialized size estimate
+        item_size = len(json.dumps(item).encode("utf-8")) + 16
+        if batch and batch_size + item_size > RAW_EVENT_MAX_BYTES:
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(item)
+        batch_size += item_size
+    if batch:
+        yield batch
+
+
+LOGS_ROUTING_KEY = "osquery_logs"
+
+
+def post_logs(enrolled_machine, user_agent, ip, log_type, records):
+    """Post the osquery logs as raw events, to be processed by the preprocess workers"""
+    records.sort(key=lambda r: r.get("unixTime", 0))
+    if log_type == "result":
+        # only the last inventory snapshot is used.
+        # the older ones are dropped, to not commit them if the raw events are processed out of order.
+        inventory_snapshot_indexes = [idx for idx, r in enumerate(records) if r.get("name") == INVENTORY_QUERY_NAME]
+        for idx in reversed(inventory_snapshot_indexes[:-1]):
+            del records[idx]
+    for batch in _iter_size_bounded_batches(records):
+        queues.post_raw_event(LOGS_ROUTING_KEY,
+                              {"request": {"user_agent": user_agent,
+                                           "ip": ip},
+                               "enrolled_machine": {"pk": enrolled_machine.pk,
+                                                    "serial_number": enrolled_machine.serial_number},
+                               "log_type": log_type,
+                               "records": batch})
+
+
+DISTRIBUTED_QUERY_RESULTS_ROUTING_KEY = "osquery_distributed_query_results"
+
+
+def post_distributed_query_results(msn, results):
+    """Post the (distributed query pk, row) results as raw events, to be persisted by the preprocess workers"""
+    for batch in _iter_size_bounded_batches(results):
+        queues.post_raw_event(DISTRIBUTED_QUERY_RESULTS_ROUTING_KEY,
+                              {"serial_number": msn,
+                               "results": batch})
+
+
 # Utility function for the audit trail
 
 
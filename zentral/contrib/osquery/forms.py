@@ -116,9 +116,18 @@ class DistributedQueryForm(forms.ModelForm):
             self.instance.minimum_osquery_version = self.query.minimum_osquery_version
 
     def save(self, *args, **kwargs):
-        if not self.instance.pk and self.cleaned_data.get("halt_current_runs"):
-            self.query.distributedquery_set.active().update(valid_until=datetime.utcnow())
-        return super().save(*args, **kwargs)
+        if not self.instance.pk:
+            if self.cleaned_data.get("halt_current_runs"):
+                self.query.distributedquery_set.active().update(valid_until=datetime.utcnow())
+            return super().save(*args, **kwargs)
+        # only the form fields are updated, to not overwrite the result column names
+        # recorded concurrently when the results are saved
+        distributed_query = super().save(commit=False)
+        update_fields = [f.name for f in distributed_query._meta.concrete_fields if f.name in self.cleaned_data]
+        update_fields.append("updated_at")
+        distributed_query.save(update_fields=update_fields)
+        self.save_m2m()
+        return distributed_query
 
 
 class DistributedQueryMachineSearchForm(forms.Form):
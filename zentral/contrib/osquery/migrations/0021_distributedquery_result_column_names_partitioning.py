@@ -0,0 +1,57 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Preparation of the partitioning of the distributed query results, done in 0022.
+    # Not atomic, to build the index concurrently, and to validate the constraint
+    # without holding the lock taken to add it.
+    atomic = False
+
+    dependencies = [
+        ('osquery', '0020_alter_configuration_inventory_interval'),
+    ]
+
+    operations = [
+        # null for the existing distributed queries, [] for the new ones
+        migrations.AddField(
+            model_name='distributedquery',
+            name='result_column_names',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), editable=False,
+                                                            null=True, size=None),
+        ),
+        migrations.AlterField(
+            model_name='distributedquery',
+            name='result_column_names',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), default=list,
+                                                            editable=False, null=True, size=None),
+        ),
+        # the primary key of the future default partition must include the partition key.
+        # the index is promoted to a primary key in 0022.
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS osquery_distributedqueryresult_default_pkey "
+            "ON osquery_distributedqueryresult (id, distributed_query_id);",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS osquery_distributedqueryresult_default_pkey;"
+        ),
+        # the future default partition only contains the results of the existing distributed queries.
+        # with this constraint, it is not scanned when the partitions of the new distributed queries are created.
+        # added without validation, to only hold the ACCESS EXCLUSIVE lock for a short time…
+        migrations.RunSQL(
+            "DO $$ "
+            "DECLARE max_dq_id integer; "
+            "BEGIN "
+            "SELECT COALESCE(MAX(id), 0) INTO max_dq_id FROM osquery_distributedquery; "
+            "EXECUTE format('ALTER TABLE osquery_distributedqueryresult "
+            "ADD CONSTRAINT osquery_distributedqueryresult_default_dq_check "
+            "CHECK (distributed_query_id <= %s) NOT VALID', max_dq_id); "
+            "END $$;",
+            reverse_sql="ALTER TABLE osquery_distributedqueryresult "
+                        "DROP CONSTRAINT IF EXISTS osquery_distributedqueryresult_default_dq_check;"
+        ),
+        # … and validated with a SHARE UPDATE EXCLUSIVE lock, that does not block the reads and writes.
+        migrations.RunSQL(
+            "ALTER TABLE osquery_distributedqueryresult "
+            "VALIDATE CONSTRAINT osquery_distributedqueryresult_default_dq_check;",
+            reverse_sql=migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,104 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # The existing table becomes the default partition of a table partitioned by distributed query.
+    # The index and the constraint prepared in 0021 are reused, the foreign key is kept on the default
+    # partition, and no other partitions exist when it is attached: no index is built and no row is scanned
+    # while the ACCESS EXCLUSIVE lock is held.
+
+    dependencies = [
+        ('osquery', '0021_distributedquery_result_column_names_partitioning'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "ALTER TABLE osquery_distributedqueryresult RENAME TO osquery_distributedqueryresult_default;"
+            "ALTER TABLE osquery_distributedqueryresult_default "
+            "DROP CONSTRAINT osquery_distributedqueryresult_pkey;"
+            "ALTER TABLE osquery_distributedqueryresult_default "
+            "ADD CONSTRAINT osquery_distributedqueryresult_default_pkey "
+            "PRIMARY KEY USING INDEX osquery_distributedqueryresult_default_pkey;"
+            "ALTER INDEX osquery_dis_distrib_fac7c0_idx "
+            "RENAME TO osquery_distributedqueryresult_default_dq_sn_idx;"
+            "ALTER INDEX osquery_distributedqueryresult_distributed_query_id_daf8973a "
+            "RENAME TO osquery_distributedqueryresult_default_dq_idx;"
+            "ALTER TABLE osquery_distributedqueryresult_default ALTER COLUMN id DROP IDENTITY IF EXISTS;"
+            "ALTER TABLE osquery_distributedqueryresult_default ALTER COLUMN id DROP DEFAULT;",
+            reverse_sql="ALTER INDEX osquery_distributedqueryresult_default_dq_idx "
+                        "RENAME TO osquery_distributedqueryresult_distributed_query_id_daf8973a;"
+                        "ALTER INDEX osquery_distributedqueryresult_default_dq_sn_idx "
+                        "RENAME TO osquery_dis_distrib_fac7c0_idx;"
+                        "ALTER TABLE osquery_distributedqueryresult_default "
+                        "DROP CONSTRAINT osquery_distributedqueryresult_default_pkey;"
+                        "ALTER TABLE osquery_distributedqueryresult_default "
+                        "ADD CONSTRAINT osquery_distributedqueryresult_pkey PRIMARY KEY (id);"
+                        "ALTER TABLE osquery_distributedqueryresult_default "
+                        "RENAME TO osquery_distributedqueryresult;"
+                        "ALTER TABLE osquery_distributedqueryresult "
+                        "ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;"
+                        "SELECT setval(pg_get_serial_sequence('osquery_distributedqueryresult', 'id'),"
+                        "COALESCE((SELECT MAX(id) FROM osquery_distributedqueryresult), 0) + 1, false);"
+                        # re-created by the reverse of 0021
+                        "CREATE UNIQUE INDEX osquery_distributedqueryresult_default_pkey "
+                        "ON osquery_distributedqueryresult (id, distributed_query_id);"
+        ),
+        # the foreign key is created before the default partition is attached,
+        # to reuse the equivalent foreign key of the default partition.
+        migrations.RunSQL(
+            "CREATE TABLE osquery_distributedqueryresult ("
+            "id integer NOT NULL GENERATED BY DEFAULT AS IDENTITY,"
+            "serial_number text NOT NULL,"
+            '"row" jsonb NOT NULL,'
+            "distributed_query_id integer NOT NULL,"
+            "CONSTRAINT osquery_distributedqueryresult_pkey PRIMARY KEY (id, distributed_query_id),"
+            "CONSTRAINT osquery_distributedq_distributed_query_id_daf8973a_fk_osquery_d "
+            "FOREIGN KEY (distributed_query_id) REFERENCES osquery_distributedquery (id) "
+            "DEFERRABLE INITIALLY DEFERRED"
+            ") PARTITION BY LIST (distributed_query_id);"
+            "SELECT setval(pg_get_serial_sequence('osquery_distributedqueryresult', 'id'),"
+            "COALESCE((SELECT MAX(id) FROM osquery_distributedqueryresult_default), 0) + 1, false);"
+            "CREATE INDEX osquery_dis_distrib_fac7c0_idx "
+            "ON osquery_distributedqueryresult (distributed_query_id, serial_number);"
+            "CREATE INDEX osquery_distributedqueryresult_distributed_query_id_daf8973a "
+            "ON osquery_distributedqueryresult (distributed_query_id);",
+            reverse_sql="DROP TABLE osquery_distributedqueryresult;"
+        ),
+        # The partitions of the distributed queries created after the constraint was added in 0021 are
+        # created here, because they were not created by the post_save signal receiver.
+        # In reverse, the results of the partitions are moved back to the default partition,
+        # and the constraint is added again, with the new maximum distributed query id.
+        migrations.RunSQL(
+            "ALTER TABLE osquery_distributedqueryresult "
+            "ATTACH PARTITION osquery_distributedqueryresult_default DEFAULT;"
+            "DO $$ "
+            "DECLARE max_dq_id integer; dq_id integer; "
+            "BEGIN "
+            "SELECT substring(pg_get_constraintdef(oid) from '<= (\\d+)')::integer INTO max_dq_id "
+            "FROM pg_constraint WHERE conname = 'osquery_distributedqueryresult_default_dq_check' "
+            "AND conrelid = 'osquery_distributedqueryresult_default'::regclass; "
+            "FOR dq_id IN SELECT id FROM osquery_distributedquery WHERE id > max_dq_id LOOP "
+            "EXECUTE format('CREATE TABLE IF NOT EXISTS osquery_distributedqueryresult_%s "
+            "PARTITION OF osquery_distributedqueryresult FOR VALUES IN (%s)', dq_id, dq_id); "
+            "END LOOP; "
+            "END $$;",
+            reverse_sql="ALTER TABLE osquery_distributedqueryresult "
+                        "DETACH PARTITION osquery_distributedqueryresult_default;"
+                        "ALTER TABLE osquery_distributedqueryresult_default "
+                        "DROP CONSTRAINT IF EXISTS osquery_distributedqueryresult_default_dq_check;"
+                        # no pending foreign key checks, for the next ALTER TABLE statements
+                        "SET CONSTRAINTS ALL IMMEDIATE;"
+                        "INSERT INTO osquery_distributedqueryresult_default "
+                        '(id, serial_number, "row", distributed_query_id) '
+                        'SELECT id, serial_number, "row", distributed_query_id '
+                        "FROM osquery_distributedqueryresult;"
+                        "DO $$ "
+                        "DECLARE max_dq_id integer; "
+                        "BEGIN "
+                        "SELECT COALESCE(MAX(id), 0) INTO max_dq_id FROM osquery_distributedquery; "
+                        "EXECUTE format('ALTER TABLE osquery_distributedqueryresult_default "
+                        "ADD CONSTRAINT osquery_distributedqueryresult_default_dq_check "
+                        "CHECK (distributed_query_id <= %s)', max_dq_id); "
+                        "END $$;"
+        ),
+    ]
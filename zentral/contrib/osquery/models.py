@@ -1,15 +1,24 @@
+import csv
 import enum
+import io
+import json
 import logging
 import os.path
+import time
 from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
 from django.core.validators import MinValueValidator, MaxValueValidator, RegexValidator
-from django.db import models, connection
+from django.db import models, connection, transaction, OperationalError
 from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.functional import cached_property
 from zentral.conf import settings
 from zentral.contrib.inventory.models import BaseEnrollment, Tag
+from zentral.core.compliance_checks.models import ComplianceCheck
+from zentral.utils.json import remove_null_character
 from zentral.utils.sql import tables_in_query, format_sql
 from zentral.utils.text import shard
 from .specs import cli_only_flags
@@ -198,7 +207,7 @@ class Pack(models.Model):
 
     def serialize(self):
         d = {"queries": {pq.pack_key(): pq.serialize()
-                         for pq in self.packquery_set.select_related("query").all()}}
+                         for pq in self.packquery_set.all()}}
         if self.discovery_queries:
             d["discovery"] = self.discovery_queries
         if self.shard and self.shard != 100:
@@ -497,6 +506,57 @@ class ConfigurationPack(models.Model):
         return "{}#cp{}".format(self.configuration.get_absolute_url(), self.pk)
 
 
+# osquery conf generation
+# bumped when anything included in the osquery conf changes, to invalidate the cached confs
+
+
+OSQUERY_CONF_GENERATION_CACHE_KEY = "osquery_conf_generation"
+
+
+def get_osquery_conf_generation():
+    generation = cache.get(OSQUERY_CONF_GENERATION_CACHE_KEY)
+    if generation is None:
+        # time based initial value, to never reuse the generation of an evicted counter
+        cache.add(OSQUERY_CONF_GENERATION_CACHE_KEY, time.time_ns(), None)
+        generation = cache.get(OSQUERY_CONF_GENERATION_CACHE_KEY)
+    return generation
+
+
+def bump_osquery_conf_generation():
+    try:
+        cache.incr(OSQUERY_CONF_GENERATION_CACHE_KEY)
+    except ValueError:
+        # missing key
+        cache.set(OSQUERY_CONF_GENERATION_CACHE_KEY, time.time_ns(), None)
+
+
+@receiver(post_save, sender=Query)
+@receiver(post_delete, sender=Query)
+@receiver(post_save, sender=Pack)
+@receiver(post_delete, sender=Pack)
+@receiver(post_save, sender=PackQuery)
+@receiver(post_delete, sender=PackQuery)
+@receiver(post_save, sender=FileCategory)
+@receiver(post_delete, sender=FileCategory)
+@receiver(post_save, sender=AutomaticTableConstruction)
+@receiver(post_delete, sender=AutomaticTableConstruction)
+@receiver(post_save, sender=Configuration)
+@receiver(post_delete, sender=Configuration)
+@receiver(m2m_changed, sender=Configuration.file_categories.through)
+@receiver(m2m_changed, sender=Configuration.automatic_table_constructions.through)
+@receiver(post_save, sender=ConfigurationPack)
+@receiver(post_delete, sender=ConfigurationPack)
+@receiver(m2m_changed, sender=ConfigurationPack.tags.through)
+# cascades to the configuration pack tags and the query tags
+@receiver(post_delete, sender=Tag)
+# cascades to the query compliance checks, and their query types
+@receiver(post_delete, sender=ComplianceCheck)
+def osquery_conf_changed(sender, **kwargs):
+    bump_osquery_conf_generation()
+    # again after the commit, in case a conf was cached with the previous state in the meantime
+    transaction.on_commit(bump_osquery_conf_generation)
+
+
 # Enrollment
 
 
@@ -559,6 +619,12 @@ class EnrolledMachine(models.Model):
 # Distributed queries
 
 
+DISTRIBUTED_QUERY_INDEX_CACHE_KEY = "osquery_distributed_query_index"
+DISTRIBUTED_QUERY_INDEX_TTL = 300  # safety net, the index is invalidated on change
+DISTRIBUTED_QUERY_MACHINE_DONE_CACHE_KEY_PREFIX = "osquery_dq_done_"
+DISTRIBUTED_QUERY_MACHINE_DONE_TTL = 86400
+
+
 class DistributedQueryManager(models.Manager):
     def active(self):
         now = timezone.now()
@@ -567,24 +633,78 @@ class DistributedQueryManager(models.Manager):
                 .filter(valid_from__lte=now)
         )
 
-    def iter_queries_for_enrolled_machine(self, enrolled_machine, tags):
+    def get_index(self):
+        """Return the targeting attributes of the current and future distributed queries
+
+        The index is kept in the shared cache, and invalidated when a distributed query changes.
+        """
+        index = cache.get(DISTRIBUTED_QUERY_INDEX_CACHE_KEY)
+        if index is None:
+            index = [
+                {"pk": dq.pk,
+                 "valid_from": dq.valid_from,
+                 "valid_until": dq.valid_until,
+                 "platforms": frozenset(dq.platforms),
+                 "serial_numbers": frozenset(dq.serial_numbers),
+                 "tag_ids": frozenset(t.pk for t in dq.tags.all()),
+                 "minimum_osquery_version_tuple": dq.minimum_osquery_version_tuple,
+                 "shard": dq.shard}
+                for dq in (self.filter(Q(valid_until__isnull=True) | Q(valid_until__gte=timezone.now()))
+                               .prefetch_related("tags")
+                               .order_by("pk"))
+            ]
+            cache.set(DISTRIBUTED_QUERY_INDEX_CACHE_KEY, index, DISTRIBUTED_QUERY_INDEX_TTL)
+        return index
+
+    def iter_candidate_pks(self, enrolled_machine, tags):
+        now = timezone.now()
         serial_number = enrolled_machine.serial_number
-        qs = (
-            self.active()
-                .distinct()
-                .filter(Q(platforms__len=0) | Q(platforms__overlap=enrolled_machine.platforms))
-                .filter(Q(serial_numbers__len=0) | Q(serial_numbers__contains=[serial_number]))
-                .filter(Q(tags__isnull=True) | Q(tags__in=tags))
-                .exclude(distributedquerymachine__serial_number=serial_number)
-                .order_by("pk")
-        )
-        for dq in qs:
+        platforms = set(enrolled_machine.platforms)
+        tag_ids = set(t.pk for t in tags)
+        for dq_d in self.get_index():
+            if dq_d["valid_from"] > now or (dq_d["valid_until"] and dq_d["valid_until"] < now):
+                continue
+            if dq_d["platforms"] and not dq_d["platforms"] & platforms:
+                continue
+            if dq_d["serial_numbers"] and serial_number not in dq_d["serial_numbers"]:
+                continue
+            if dq_d["tag_ids"] and not dq_d["tag_ids"] & tag_ids:
+                continue
             # min osquery version verification
-            if dq.minimum_osquery_version_tuple > enrolled_machine.osquery_version_tuple:
+            if dq_d["minimum_osquery_version_tuple"] > enrolled_machine.osquery_version_tuple:
                 continue
             # consistant sharding per dq and serial number
-            if dq.shard == 100 or shard(serial_number, dq.pk) <= dq.shard:
-                yield dq
+            if dq_d["shard"] == 100 or shard(serial_number, dq_d["pk"]) <= dq_d["shard"]:
+                yield dq_d["pk"]
+
+    def iter_queries_for_enrolled_machine(self, enrolled_machine, tags):
+        serial_number = enrolled_machine.serial_number
+        candidate_pks = list(self.iter_candidate_pks(enrolled_machine, tags))
+        if not candidate_pks:
+            return
+        # distributed queries already run by the machine
+        done_cache_key = f"{DISTRIBUTED_QUERY_MACHINE_DONE_CACHE_KEY_PREFIX}{serial_number}"
+        done_pks = cache.get(done_cache_key) or frozenset()
+        pending_pks = [pk for pk in candidate_pks if pk not in done_pks]
+        if not pending_pks:
+            # nothing new for this machine
+            return
+        dq_list = list(self.filter(pk__in=pending_pks)
+                           .exclude(distributedquerymachine__serial_number=serial_number)
+                           .order_by("pk"))
+        # missing → already run by the machine (or deleted)
+        new_done_pks = set(pending_pks) - set(dq.pk for dq in dq_list)
+        if new_done_pks:
+            cache.set(done_cache_key, done_pks | new_done_pks, DISTRIBUTED_QUERY_MACHINE_DONE_TTL)
+        yield from dq_list
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # the post_save signal is not sent, the partitions of the results must be created here
+        objs = super().bulk_create(objs, *args, **kwargs)
+        for obj in objs:
+            if obj.pk:
+                DistributedQueryResult.objects.create_partition(obj.pk)
+        return objs
 
 
 class DistributedQuery(models.Model):
@@ -613,6 +733,8 @@ class DistributedQuery(models.Model):
         default=100,
         help_text="Restrict this query to a percentage (1-100) of target hosts"
     )
+    # recorded when the results are saved. null for the legacy distributed queries.
+    result_column_names = ArrayField(models.TextField(), editable=False, null=True, default=list)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -648,6 +770,9 @@ class DistributedQuery(models.Model):
             return (0, 0, 0)
 
     def result_columns(self):
+        if self.result_column_names is not None:
+            return self.result_column_names
+        # legacy distributed query, the column names were not recorded
         query = (
             "select distinct jsonb_object_keys(row) as col "
             "from osquery_distributedqueryresult where distributed_query_id = %s "
@@ -677,11 +802,126 @@ class DistributedQueryMachine(models.Model):
         unique_together = (("distributed_query", "serial_number"),)
 
 
+# short, to avoid queuing the reads and writes of the results behind the partition drops
+DROP_PARTITION_LOCK_TIMEOUT = "2s"
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+class DistributedQueryResultManager(models.Manager):
+    # The results are stored in a table partitioned by distributed query.
+    # The results of the distributed queries created before the partitioning are in the default partition.
+
+    def _get_partition_name(self, distributed_query_pk):
+        return f"{self.model._meta.db_table}_{int(distributed_query_pk)}"
+
+    def create_partition(self, distributed_query_pk):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._get_partition_name(distributed_query_pk)} "
+                f"PARTITION OF {self.model._meta.db_table} FOR VALUES IN ({int(distributed_query_pk)})"
+            )
+
+    def _get_orphan_partition_names(self, cursor):
+        # partitions of the deleted distributed queries, left behind when they could not be dropped
+        table = self.model._meta.db_table
+        cursor.execute(
+            "select c.relname from pg_inherits i "
+            "join pg_class c on (c.oid = i.inhrelid) "
+            "where i.inhparent = %s::regclass "
+            "and c.relname ~ %s "
+            "and not exists ("
+            f"  select 1 from {DistributedQuery._meta.db_table} dq "
+            "  where dq.id = substring(c.relname from %s)::integer"
+            ")",
+            [table, rf"^{table}_\d+$", r"_(\d+)$"]
+        )
+        return set(t[0] for t in cursor.fetchall())
+
+    def drop_partition(self, distributed_query_pk):
+        """Drop the partition of a distributed query, and the partitions left behind
+
+        The ACCESS EXCLUSIVE lock on the parent table is not awaited for more than DROP_PARTITION_LOCK_TIMEOUT,
+        to avoid queuing all the reads and writes of the results behind it while the running exports finish.
+        If the lock cannot be acquired, the results are deleted with the distributed query (on delete cascade),
+        and the empty partition is dropped later.
+        """
+        # the partition cannot be dropped with pending deferred foreign key checks
+        connection.check_constraints()
+        with connection.cursor() as cursor:
+            partition_names = self._get_orphan_partition_names(cursor)
+            partition_names.add(self._get_partition_name(distributed_query_pk))
+            try:
+                with transaction.atomic():
+                    cursor.execute("SELECT current_setting('lock_timeout'), "
+                                   "set_config('lock_timeout', %s, true)",
+                                   [DROP_PARTITION_LOCK_TIMEOUT])
+                    lock_timeout, _ = cursor.fetchone()
+                    cursor.execute(f"DROP TABLE IF EXISTS {', '.join(sorted(partition_names))}")
+                    # restore the lock timeout for the rest of the transaction
+                    cursor.execute("SELECT set_config('lock_timeout', %s, true)", [lock_timeout])
+            except OperationalError as e:
+                if getattr(e.__cause__, "pgcode", None) != LOCK_NOT_AVAILABLE:
+                    raise
+                logger.warning("Could not drop distributed query %s result partition: lock timeout",
+                               distributed_query_pk)
+
+    def bulk_insert(self, serial_number, results):
+        """Insert the (distributed query pk, row) results of a machine with a single COPY statement
+
+        The column names of the rows are recorded on the distributed queries.
+        The results of the distributed queries that do not exist anymore are skipped.
+        Returns the number of inserted rows.
+        """
+        results = list(results)
+        distributed_query_pks = set(
+            DistributedQuery.objects.filter(pk__in={pk for pk, _ in results}).values_list("pk", flat=True)
+        )
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        count = 0
+        skipped = 0
+        column_names = {}
+        for distributed_query_pk, row in results:
+            if distributed_query_pk not in distributed_query_pks:
+                skipped += 1
+                continue
+            row = remove_null_character(row)
+            if isinstance(row, dict):
+                column_names.setdefault(distributed_query_pk, set()).update(row.keys())
+            writer.writerow((distributed_query_pk, serial_number, json.dumps(row)))
+            count += 1
+        if count:
+            buf.seek(0)
+            with connection.cursor() as cursor:
+                cursor.copy_expert(
+                    f'COPY {self.model._meta.db_table} (distributed_query_id, serial_number, "row") '
+                    'FROM STDIN WITH (FORMAT csv)',
+                    buf
+                )
+                for distributed_query_pk, dq_column_names in column_names.items():
+                    dq_column_names = sorted(dq_column_names)
+                    # only update the distributed query if necessary, to avoid the row locks
+                    cursor.execute(
+                        "update osquery_distributedquery "
+                        "set result_column_names = array("
+                        "  select distinct c from unnest(result_column_names || %s::text[]) c order by c"
+                        ") "
+                        "where id = %s and result_column_names is not null "
+                        "and not result_column_names @> %s::text[]",
+                        [dq_column_names, distributed_query_pk, dq_column_names]
+                    )
+        if skipped:
+            logger.warning("Machine %s: %s result(s) of unknown distributed queries skipped", serial_number, skipped)
+        return count
+
+
 class DistributedQueryResult(models.Model):
     distributed_query = models.ForeignKey(DistributedQuery, on_delete=models.CASCADE)
     serial_number = models.TextField()
     row = models.JSONField()
 
+    objects = DistributedQueryResultManager()
+
     class Meta:
         indexes = [
             models.Index(fields=["distributed_query", "serial_number"])
@@ -694,6 +934,31 @@ class DistributedQueryResult(models.Model):
             yield k, self.row.get(k)
 
 
+def invalidate_distributed_query_index():
+    cache.delete(DISTRIBUTED_QUERY_INDEX_CACHE_KEY)
+
+
+@receiver(post_save, sender=DistributedQuery)
+@receiver(post_delete, sender=DistributedQuery)
+@receiver(m2m_changed, sender=DistributedQuery.tags.through)
+def distributed_query_changed(sender, **kwargs):
+    invalidate_distributed_query_index()
+    # again after the commit, in case the index was rebuilt with the previous state in the meantime
+    transaction.on_commit(invalidate_distributed_query_index)
+
+
+@receiver(post_save, sender=DistributedQuery)
+def create_distributed_query_result_partition(sender, instance, created, **kwargs):
+    if created:
+        DistributedQueryResult.objects.create_partition(instance.pk)
+
+
+@receiver(pre_delete, sender=DistributedQuery)
+def drop_distributed_query_result_partition(sender, instance, **kwargs):
+    # faster than deleting the rows
+    DistributedQueryResult.objects.drop_partition(instance.pk)
+
+
 # File carving
 
 
@@ -0,0 +1,91 @@
+import logging
+from zentral.contrib.inventory.utils import commit_machine_snapshot_and_yield_events
+from .events import (DISTRIBUTED_QUERY_RESULTS_ROUTING_KEY, LOGS_ROUTING_KEY,
+                     iter_file_carve_events, iter_result_events, iter_status_log_events)
+from .models import DistributedQueryResult, EnrolledMachine
+from .views.utils import (build_inventory_query_snapshot_tree,
+                          iter_result_logs_file_carving_sessions,
+                          split_result_logs,
+                          update_enrolled_machine_osquery_version)
+
+
+logger = logging.getLogger("zentral.contrib.osquery.preprocessors")
+
+
+class DistributedQueryResultsPreprocessor(object):
+    routing_key = DISTRIBUTED_QUERY_RESULTS_ROUTING_KEY
+
+    def process_raw_event(self, raw_event):
+        try:
+            serial_number = raw_event["serial_number"]
+            results = raw_event["results"]
+        except (KeyError, TypeError):
+            logger.error("Invalid distributed query results raw event")
+        else:
+            try:
+                count = DistributedQueryResult.objects.bulk_insert(serial_number, results)
+            except Exception:
+                # distributed query deleted during the insert, bad rows, …
+                # logged and dropped, to not block the preprocess worker
+                logger.exception("Machine %s: could not save the distributed query results", serial_number)
+            else:
+                logger.debug("Machine %s: %s distributed query result(s) saved", serial_number, count)
+        # no events
+        return []
+
+
+class LogsPreprocessor(object):
+    routing_key = LOGS_ROUTING_KEY
+
+    def get_enrolled_machine(self, pk, serial_number):
+        try:
+            return EnrolledMachine.objects.select_related(
+                "enrollment__secret__meta_business_unit"
+            ).get(pk=pk, serial_number=serial_number)
+        except EnrolledMachine.DoesNotExist:
+            logger.warning("Machine %s: enrolled machine %s not found", serial_number, pk)
+
+    def process_raw_event(self, raw_event):
+        try:
+            enrolled_machine_pk = raw_event["enrolled_machine"]["pk"]
+            serial_number = raw_event["enrolled_machine"]["serial_number"]
+            log_type = raw_event["log_type"]
+            records = raw_event["records"]
+            user_agent = raw_event["request"]["user_agent"]
+            ip = raw_event["request"]["ip"]
+        except (KeyError, TypeError):
+            logger.error("Invalid osquery logs raw event")
+            return
+        if not records:
+            return
+
+        records.sort(key=lambda r: r.get("unixTime", 0))
+
+        # the enrolled machine can be gone, after a re-enrollment for example.
+        # the events are still posted, but the machine cannot be updated.
+        enrolled_machine = self.get_enrolled_machine(enrolled_machine_pk, serial_number)
+        if enrolled_machine:
+            update_enrolled_machine_osquery_version(enrolled_machine, records[-1].get("decorations", {}))
+
+        if log_type == "result":
+            last_inventory_snapshot, results = split_result_logs(records)
+            yield from iter_file_carve_events(
+                serial_number, user_agent, ip,
+                [{"action": "schedule",
+                  "session_id": str(file_carving_session.pk)}
+                 for file_carving_session in iter_result_logs_file_carving_sessions(serial_number, results)]
+            )
+            if last_inventory_snapshot and enrolled_machine:
+                yield from commit_machine_snapshot_and_yield_events(
+                    build_inventory_query_snapshot_tree(enrolled_machine, ip, last_inventory_snapshot)
+                )
+            yield from iter_result_events(serial_number, user_agent, ip, results)
+        elif log_type == "status":
+            yield from iter_status_log_events(serial_number, user_agent, ip, records)
+        else:
+            logger.error("Unknown log type %s", log_type)
+
+
+def get_preprocessors():
+    yield DistributedQueryResultsPreprocessor()
+    yield LogsPreprocessor()
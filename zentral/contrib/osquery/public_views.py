@@ -8,28 +8,33 @@ from django.core.exceptions import SuspiciousOperation, PermissionDenied
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import transaction
 from django.http import Http404, JsonResponse
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.views.generic import View
+from zentral.conf import settings
 from zentral.contrib.inventory.exceptions import EnrollmentSecretVerificationFailed
 from zentral.contrib.inventory.models import MachineSnapshot, MetaMachine, MachineTag
 from zentral.contrib.inventory.utils import (commit_machine_snapshot_and_trigger_events,
                                              verify_enrollment_secret)
 from zentral.contrib.osquery.compliance_checks import ComplianceCheckStatusAggregator
-from zentral.contrib.osquery.conf import build_osquery_conf, INVENTORY_QUERY_NAME
-from zentral.contrib.osquery.events import (post_enrollment_event,
-                                            post_file_carve_events,
+from zentral.contrib.osquery.conf import get_osquery_conf
+from zentral.contrib.osquery.events import (post_distributed_query_results,
+                                            post_enrollment_event,
+                                            post_file_carve_events, post_logs,
                                             post_request_event, post_results, post_status_logs)
 from zentral.contrib.osquery.models import (DistributedQuery, DistributedQueryMachine, DistributedQueryResult,
                                             EnrolledMachine,
-                                            FileCarvingBlock, FileCarvingSession,
-                                            PackQuery, parse_result_name)
+                                            FileCarvingBlock, FileCarvingSession)
 from zentral.contrib.osquery.tags import TagUpdateAggregator
 from zentral.contrib.osquery.tasks import build_file_carving_session_archive
 from zentral.core.events.base import post_machine_conflict_event
 from zentral.utils.http import user_agent_and_ip_address_from_request
-from zentral.utils.json import remove_null_character
-from .views.utils import (prepare_file_carving_session_if_necessary,
-                          update_tree_with_enrollment_host_details, update_tree_with_inventory_query_snapshot)
+from .views.utils import (build_inventory_query_snapshot_tree,
+                          iter_result_logs_file_carving_sessions,
+                          prepare_file_carving_session_if_necessary,
+                          split_result_logs,
+                          update_enrolled_machine_osquery_version,
+                          update_tree_with_enrollment_host_details)
 
 
 logger = logging.getLogger('zentral.contrib.osquery.views.api')
@@ -186,7 +191,7 @@ class ConfigView(BaseNodeView):
     request_type = "config"
 
     def do_node_post(self):
-        return build_osquery_conf(self.machine, self.enrollment)
+        return get_osquery_conf(self.machine, self.enrollment)
 
 
 class StartFileCarvingView(BaseNodeView):
@@ -304,7 +309,7 @@ class DistributedReadView(BaseNodeView):
 
 class DistributedWriteView(BaseNodeView):
     request_type = "distributed_write"
-    batch_size = 100  # TODO hard coded
+    dqm_stat_attrs = ("memory", "system_time", "user_time", "wall_time_ms")
 
     def do_node_post(self):
         results = self.data.get("queries", {})
@@ -321,6 +326,7 @@ class DistributedWriteView(BaseNodeView):
                                                        .filter(pk__in=dqm_pk_set)}
 
         # update distributed query machines
+        updated_at = timezone.now()
         for dqm_pk, dqm in dqm_cache.items():
             # status
             dqm_status = statuses.get(dqm_pk)
@@ -333,7 +339,7 @@ class DistributedWriteView(BaseNodeView):
             # stats
             dqm_stats = stats.get(dqm_pk)
             if dqm_stats:
-                for stat_attr in ("memory", "system_time", "user_time", "wall_time_ms"):
+                for stat_attr in self.dqm_stat_attrs:
                     val = dqm_stats.get(stat_attr)
                     if val is not None:
                         try:
@@ -342,23 +348,22 @@ class DistributedWriteView(BaseNodeView):
                             pass
                         else:
                             setattr(dqm, stat_attr, val)
-            dqm.save()
+            dqm.updated_at = updated_at
+        DistributedQueryMachine.objects.bulk_update(
+            dqm_cache.values(),
+            ("status", "error_message") + self.dqm_stat_attrs + ("updated_at",)
+        )
 
         # save_results
         dq_results = (
-            DistributedQueryResult(
-                distributed_query=dqm.distributed_query,
-                serial_number=self.machine.serial_number,
-                row=remove_null_character(row)
-            )
+            (dqm.distributed_query_id, row)
             for dqm_pk, dqm in dqm_cache.items()
             for row in results.get(dqm_pk, [])
         )
-        while True:
-            batch = list(islice(dq_results, self.batch_size))
-            if not batch:
-                break
-            DistributedQueryResult.objects.bulk_create(batch, self.batch_size)
+        if settings["apps"]["zentral.contrib.osquery"].get("async_distributed_query_results", False):
+            post_distributed_query_results(self.machine.serial_number, dq_results)
+        else:
+            DistributedQueryResult.objects.bulk_insert(self.machine.serial_number, dq_results)
 
         # process file carving
         for dqm_pk, dqm_results in results.items():
@@ -408,12 +413,7 @@ class DistributedWriteView(BaseNodeView):
 class LogView(BaseNodeView):
     request_type = "log"
 
-    def process_decorations(self, records):
-        if not records:
-            return
-        decorations = records[-1].get("decorations", {})
-
-        # verify serial number
+    def verify_decorations(self, decorations):
         serial_number = decorations.get("serial_number")
         if serial_number and serial_number != self.machine.serial_number:
             logger.warning(
@@ -425,11 +425,16 @@ class LogView(BaseNodeView):
                                         decorations)
             raise NodeInvalidError
 
+    def process_decorations(self, records):
+        if not records:
+            return
+        decorations = records[-1].get("decorations", {})
+
+        # verify serial number
+        self.verify_decorations(decorations)
+
         # update osquery version if necessary
-        osquery_version = decorations.get("version")
-        if osquery_version and self.enrolled_machine.osquery_version != osquery_version:
-            self.enrolled_machine.osquery_version = osquery_version
-            self.enrolled_machine.save()
+        update_enrolled_machine_osquery_version(self.enrolled_machine, decorations)
 
     @transaction.non_atomic_requests
     def do_node_post(self):
@@ -438,53 +443,30 @@ class LogView(BaseNodeView):
             logger.warning("No records found")
             return {}
 
+        log_type = self.data.get("log_type")
+        if settings["apps"]["zentral.contrib.osquery"].get("async_logs", False):
+            # only the serial number verification, to be able to answer with node_invalid.
+            # the logs are processed by the preprocess workers.
+            self.verify_decorations(records[-1].get("decorations", {}))
+            if log_type in ("result", "status"):
+                post_logs(self.enrolled_machine, self.user_agent, self.ip, log_type, records)
+            else:
+                logger.error("Unknown log type %s", log_type)
+            return {}
+
         records.sort(key=lambda r: r.get("unixTime", 0))
         self.process_decorations(records)
 
-        log_type = self.data.get("log_type")
         if log_type == "result":
-            results = []
-            last_inventory_snapshot = None
-            for record in records:
-                if record.get("name") == INVENTORY_QUERY_NAME:
-                    last_inventory_snapshot = record.get("snapshot")
-                else:
-                    results.append(record)
-                    # file carving ?
-                    columns = None
-                    if "columns" in record:
-                        columns = record["columns"]
-                    elif "snapshot" in record:
-                        try:
-                            columns = record["snapshot"][0]
-                        except IndexError:
-                            pass
-                    if columns:
-                        file_carving_session = prepare_file_carving_session_if_necessary(columns)
-                        if file_carving_session:
-                            try:
-                                pack_pk, _, query_pk, _, _ = parse_result_name(record["name"])
-                                pack_query = PackQuery.objects.get(pack__pk=pack_pk, query__pk=query_pk)
-                            except Exception:
-                                logger.exception("could not find file carving result pack query")
-                            else:
-                                file_carving_session.serial_number = self.machine.serial_number
-                                file_carving_session.pack_query = pack_query
-                                file_carving_session.save()
-                                post_file_carve_events(self.machine.serial_number, self.user_agent, self.ip,
-                                                       [{"action": "schedule",
-                                                         "session_id": str(file_carving_session.pk)}])
+            last_inventory_snapshot, results = split_result_logs(records)
+            for file_carving_session in iter_result_logs_file_carving_sessions(self.machine.serial_number, results):
+                post_file_carve_events(self.machine.serial_number, self.user_agent, self.ip,
+                                       [{"action": "schedule",
+                                         "session_id": str(file_carving_session.pk)}])
             if last_inventory_snapshot:
-                tree = {"source": {"module": "zentral.contrib.osquery",
-                                   "name": "osquery"},
-                        "serial_number": self.machine.serial_number,
-                        "reference": self.enrolled_machine.node_key,
-                        "public_ip_address": self.ip}
-                business_unit = self.enrollment.secret.get_api_enrollment_business_unit()
-                if business_unit:
-                    tree["business_unit"] = business_unit.serialize()
-                update_tree_with_inventory_query_snapshot(tree, last_inventory_snapshot)
-                commit_machine_snapshot_and_trigger_events(tree)
+                commit_machine_snapshot_and_trigger_events(
+                    build_inventory_query_snapshot_tree(self.enrolled_machine, self.ip, last_inventory_snapshot)
+                )
             post_results(self.machine.serial_number, self.user_agent, self.ip, results)
         elif log_type == "status":
             # TODO: configuration option to filter some of those (severity) or maybe simply ignore them
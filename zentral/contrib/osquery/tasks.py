@@ -53,58 +53,75 @@ def build_file_carving_session_archive(session_id):
 # distributed query result exports
 
 
+DQR_EXPORT_CHUNK_SIZE = 5000
+
+
+def _iter_dqr_chunks(distributed_query):
+    # server side cursor, without model instances
+    chunk = []
+    for serial_number, row in (distributed_query.distributedqueryresult_set
+                                                .values_list("serial_number", "row")
+                                                .iterator(chunk_size=DQR_EXPORT_CHUNK_SIZE)):
+        chunk.append((serial_number, row))
+        if len(chunk) >= DQR_EXPORT_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def _export_dqr_to_tmp_csv_file(distributed_query):
     tmp_fh, tmp_fp = tempfile.mkstemp()
     with os.fdopen(tmp_fh, "w", newline='') as tmp_f:
         csv_w = csv.writer(tmp_f)
         columns = distributed_query.result_columns()
         csv_w.writerow(["serial number"] + columns)
-        for dqr in distributed_query.distributedqueryresult_set.iterator():
-            row = [dqr.serial_number]
-            for column in columns:
-                row.append(dqr.row.get(column) or "")
-            csv_w.writerow(row)
+        for chunk in _iter_dqr_chunks(distributed_query):
+            csv_w.writerows(
+                [serial_number] + [row.get(column) or "" for column in columns]
+                for serial_number, row in chunk
+            )
     return tmp_fp
 
 
 def _export_dqr_to_tmp_ndjson_file(distributed_query):
     tmp_fh, tmp_fp = tempfile.mkstemp()
     with os.fdopen(tmp_fh, "w") as tmp_f:
-        for dqr in distributed_query.distributedqueryresult_set.iterator():
-            json.dump({"serial_number": dqr.serial_number, "row": dqr.row}, tmp_f)
-            tmp_f.write("\n")
+        for chunk in _iter_dqr_chunks(distributed_query):
+            tmp_f.write("".join(
+                json.dumps({"serial_number": serial_number, "row": row}) + "\n"
+                for serial_number, row in chunk
+            ))
     return tmp_fp
 
 
+def _get_xlsx_cell_value(val):
+    if not val:
+        return None
+    elif isinstance(val, (bool, int, float, str)):
+        return val
+    else:
+        return str(val)
+
+
 def _export_dqr_to_tmp_xlsx_file(distributed_query):
     tmp_fh, tmp_fp = tempfile.mkstemp()
     with os.fdopen(tmp_fh, "wb") as tmp_f:
-        workbook = xlsxwriter.Workbook(tmp_f)
+        # constant memory → the rows are flushed to disk as they are written
+        # no string conversions → the strings are always written as strings
+        workbook = xlsxwriter.Workbook(tmp_f, {"constant_memory": True,
+                                               "strings_to_formulas": False,
+                                               "strings_to_urls": False})
         worksheet = workbook.add_worksheet("Results")
         columns = distributed_query.result_columns()
-        row_idx = col_idx = 0
-        worksheet.write_string(row_idx, col_idx, "serial number")
-        for column in columns:
-            col_idx += 1
-            worksheet.write_string(row_idx, col_idx, column)
+        worksheet.write_row(0, 0, ["serial number"] + columns)
         worksheet.freeze_panes(1, 0)
-        for dqr in distributed_query.distributedqueryresult_set.iterator():
-            row_idx += 1
-            col_idx = 0
-            worksheet.write_string(row_idx, col_idx, dqr.serial_number)
-            for column in columns:
-                col_idx += 1
-                val = dqr.row.get(column)
-                if not val:
-                    worksheet.write_blank(row_idx, col_idx, "")
-                elif isinstance(val, (int, float)):
-                    worksheet.write_number(row_idx, col_idx, val)
-                elif isinstance(val, bool):
-                    worksheet.write_boolean(row_idx, col_idx, val)
-                else:
-                    if not isinstance(val, str):
-                        val = str(val)
-                    worksheet.write_string(row_idx, col_idx, val)
+        row_idx = 0
+        for chunk in _iter_dqr_chunks(distributed_query):
+            for serial_number, row in chunk:
+                row_idx += 1
+                worksheet.write_string(row_idx, 0, serial_number)
+                worksheet.write_row(row_idx, 1, [_get_xlsx_cell_value(row.get(column)) for column in columns])
         workbook.close()
     return tmp_fp
 
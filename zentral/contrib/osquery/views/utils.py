@@ -5,7 +5,8 @@ from zentral.contrib.inventory.conf import (cleanup_windows_os_version,
                                             macos_version_from_build,
                                             windows_version_from_build)
 from zentral.contrib.inventory.models import PrincipalUserSource
-from zentral.contrib.osquery.models import FileCarvingSession
+from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME
+from zentral.contrib.osquery.models import FileCarvingSession, PackQuery, parse_result_name
 from zentral.utils.certificates import parse_text_dn
 
 
@@ -333,3 +334,77 @@ def prepare_file_carving_session_if_necessary(columns):
         block_size=-1,
         block_count=-1
     )
+
+
+def build_inventory_query_snapshot_tree(enrolled_machine, ip, snapshot):
+    """
+    build the machine snapshot tree from the inventory query snapshot
+    """
+    tree = {"source": {"module": "zentral.contrib.osquery",
+                       "name": "osquery"},
+            "serial_number": enrolled_machine.serial_number,
+            "reference": enrolled_machine.node_key,
+            "public_ip_address": ip}
+    business_unit = enrolled_machine.enrollment.secret.get_api_enrollment_business_unit()
+    if business_unit:
+        tree["business_unit"] = business_unit.serialize()
+    update_tree_with_inventory_query_snapshot(tree, snapshot)
+    return tree
+
+
+def split_result_logs(records):
+    """
+    return the last inventory query snapshot and the other result logs
+    """
+    last_inventory_snapshot = None
+    results = []
+    for record in records:
+        if record.get("name") == INVENTORY_QUERY_NAME:
+            last_inventory_snapshot = record.get("snapshot")
+        else:
+            results.append(record)
+    return last_inventory_snapshot, results
+
+
+def iter_result_logs_file_carving_sessions(serial_number, results):
+    """
+    save and yield the file carving sessions scheduled by the result logs
+    """
+    pack_queries = {}
+    for result in results:
+        columns = None
+        if "columns" in result:
+            columns = result["columns"]
+        elif "snapshot" in result:
+            try:
+                columns = result["snapshot"][0]
+            except IndexError:
+                pass
+        if not columns:
+            continue
+        file_carving_session = prepare_file_carving_session_if_necessary(columns)
+        if not file_carving_session:
+            continue
+        try:
+            pack_pk, _, query_pk, _, _ = parse_result_name(result["name"])
+            pack_query = pack_queries.get((pack_pk, query_pk))
+            if pack_query is None:
+                pack_query = pack_queries[(pack_pk, query_pk)] = PackQuery.objects.get(pack__pk=pack_pk,
+                                                                                       query__pk=query_pk)
+        except Exception:
+            logger.exception("could not find file carving result pack query")
+        else:
+            file_carving_session.serial_number = serial_number
+            file_carving_session.pack_query = pack_query
+            file_carving_session.save()
+            yield file_carving_session
+
+
+def update_enrolled_machine_osquery_version(enrolled_machine, decorations):
+    """
+    update the enrolled machine osquery version with the one found in the decorations
+    """
+    osquery_version = decorations.get("version")
+    if osquery_version and enrolled_machine.osquery_version != osquery_version:
+        enrolled_machine.osquery_version = osquery_version
+        enrolled_machine.save()
@@ -6,6 +6,7 @@ from zentral.contrib.santa.models import Bundle, EnrolledMachine, Target
 from zentral.contrib.santa.utils import add_bundle_binary_targets, update_metabundles, update_or_create_targets
 from zentral.core.events.base import BaseEvent, EventMetadata, EventRequest, register_event_type
 from zentral.utils.certificates import APPLE_DEV_ID_ISSUER_CN, parse_apple_dev_id
+from zentral.utils.mt_models import prepare_commit_tree
 from zentral.utils.text import shard
 
 
@@ -402,6 +403,7 @@ def _create_missing_bundles(events, targets):
         ).values_list("target__identifier", flat=True)
     )
     unknown_file_bundle_hashes = list(set(bundle_events.keys()) - existing_sha256_set)
+    missing_bundles = []
     for sha256 in unknown_file_bundle_hashes:
         target, _ = targets.get((Target.Type.BUNDLE, sha256), (None, None))
         if not target:
@@ -423,7 +425,10 @@ def _create_missing_bundles(events, targets):
                 else:
                     val = ""
             defaults[bundle_attr] = val
-        Bundle.objects.get_or_create(target=target, defaults=defaults)
+        missing_bundles.append(Bundle(target=target, **defaults))
+    if missing_bundles:
+        # the bundles with a blocked upload already exist
+        Bundle.objects.bulk_create(missing_bundles, ignore_conflicts=True)
     return unknown_file_bundle_hashes
 
 
@@ -435,10 +440,18 @@ def _create_bundle_binaries(events):
             if bundle_sha256:
                 bundle_binary_events.setdefault(bundle_sha256, []).append(event_d)
     uploaded_bundles = set()
+    if not bundle_binary_events:
+        return uploaded_bundles
+    bundles = {
+        bundle.target.identifier: bundle
+        for bundle in Bundle.objects.select_related("target").filter(
+            target__type=Target.Type.BUNDLE,
+            target__identifier__in=bundle_binary_events.keys()
+        )
+    }
     for bundle_sha256, events in bundle_binary_events.items():
-        try:
-            bundle = Bundle.objects.get(target__type=Target.Type.BUNDLE, target__identifier=bundle_sha256)
-        except Bundle.DoesNotExist:
+        bundle = bundles.get(bundle_sha256)
+        if not bundle:
             logger.error("Unknown bundle: %s", bundle_sha256)
             continue
         if bundle.uploaded_at:
@@ -472,12 +485,28 @@ def _create_bundle_binaries(events):
 
 
 def _commit_files(events):
+    # deduplicate the files across the upload
+    file_trees = {}
     for event_d in events:
         try:
             file_d = _build_file_tree_from_santa_event(event_d)
+            prepare_commit_tree(file_d)
         except Exception:
             logger.exception("Could not build app tree from santa event")
         else:
+            file_trees.setdefault(file_d["mt_hash"], file_d)
+    if not file_trees:
+        return
+    # only commit the missing files
+    for mt_hash in File.objects.filter(mt_hash__in=file_trees.keys()).values_list("mt_hash", flat=True):
+        file_trees.pop(mt_hash)
+    if not file_trees:
+        return
+    try:
+        File.objects.bulk_commit(list(file_trees.values()))
+    except Exception:
+        logger.exception("Could not bulk commit files")
+        for file_d in file_trees.values():
             try:
                 File.objects.commit(file_d)
             except Exception:
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.20 on 2026-10-18 23:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('santa', '0038_rule_is_voting_rule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuration',
+            name='rules_version',
+            field=models.PositiveBigIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='enrolledmachine',
+            name='rules_sync_fingerprint',
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+    ]
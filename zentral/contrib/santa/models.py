@@ -1,10 +1,13 @@
 from collections import namedtuple
+import hashlib
 import logging
 import uuid
 from django.core.validators import MaxValueValidator, MinLengthValidator, MinValueValidator
 from django.contrib.postgres.fields import ArrayField
 from django.db import connection, models
-from django.db.models import Count, Q
+from django.db.models import Count, F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.urls import reverse
 from django.utils.crypto import get_random_string
 from django.utils.functional import cached_property
@@ -638,6 +641,9 @@ class Configuration(models.Model):
                   "rules are out of sync."
     )
 
+    # bumped each time a rule of the configuration changes. See bump_rules_version.
+    rules_version = models.PositiveBigIntegerField(default=1, editable=False)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -649,6 +655,11 @@ class Configuration(models.Model):
     def get_absolute_url(self):
         return reverse("santa:configuration", args=(self.pk,))
 
+    @staticmethod
+    def bump_rules_version(configuration_pk):
+        # atomic update, because the configuration instances can be stale
+        Configuration.objects.filter(pk=configuration_pk).update(rules_version=F("rules_version") + 1)
+
     def get_sync_incident_severity(self):
         try:
             return Severity(self.sync_incident_severity)
@@ -847,6 +858,8 @@ class EnrolledMachine(models.Model):
     transitive_rule_count = models.IntegerField(null=True)
     teamid_rule_count = models.IntegerField(null=True)
     last_sync_ok = models.BooleanField(null=True)
+    # fingerprint of the rule sync inputs when the machine rules were last found in sync
+    rules_sync_fingerprint = models.CharField(max_length=64, null=True, editable=False)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -1035,6 +1048,29 @@ class Rule(models.Model):
         return d
 
 
+@receiver(post_save, sender=Rule)
+@receiver(post_delete, sender=Rule)
+def bump_rule_configuration_rules_version(sender, instance, **kwargs):
+    Configuration.bump_rules_version(instance.configuration_id)
+
+
+@receiver(m2m_changed, sender=Rule.tags.through)
+@receiver(m2m_changed, sender=Rule.excluded_tags.through)
+def bump_rule_tags_configuration_rules_version(sender, instance, action, reverse, **kwargs):
+    # no reverse relationships from the tags
+    if not reverse and action in ("post_add", "post_remove", "post_clear"):
+        Configuration.bump_rules_version(instance.configuration_id)
+
+
+@receiver(pre_delete, sender=Tag)
+def bump_tag_configurations_rules_version(sender, instance, **kwargs):
+    # the rule tags are deleted in cascade, without m2m_changed signals
+    for configuration_pk in (Rule.objects.filter(Q(tags=instance) | Q(excluded_tags=instance))
+                                         .values_list("configuration_id", flat=True)
+                                         .distinct()):
+        Configuration.bump_rules_version(configuration_pk)
+
+
 class MachineRuleManager(models.Manager):
     def _iter_new_rules(self, enrolled_machine, tags):
         query = (
@@ -1118,7 +1154,26 @@ class MachineRuleManager(models.Manager):
                     rule_info_d[key] = val
             yield rule_info_d
 
+    def _get_rules_sync_fingerprint(self, enrolled_machine, tags, configuration_rules_version):
+        rules_version, updated_at = configuration_rules_version
+        machine_rule_count = self.filter(enrolled_machine=enrolled_machine).count()
+        # the configuration updated_at is included, in case a stale configuration
+        # instance was saved, with an older rules version.
+        h = hashlib.sha256()
+        for val in (enrolled_machine.enrollment.configuration_id, rules_version, updated_at.isoformat(),
+                    enrolled_machine.serial_number, enrolled_machine.primary_user or "",
+                    ",".join(str(t) for t in sorted(tags or [])), machine_rule_count):
+            h.update(f"{val}\n".encode("utf-8"))
+        return h.hexdigest()
+
     def get_next_rule_batch(self, enrolled_machine, tags, cursor=None):
+        # fetch the configuration rules version before the rule diff,
+        # to be able to detect the rule changes made during the diff.
+        configuration_rules_version = (
+            Configuration.objects.values_list("rules_version", "updated_at")
+                                 .get(pk=enrolled_machine.enrollment.configuration_id)
+        )
+
         qs = self.filter(enrolled_machine=enrolled_machine).select_for_update()
 
         # fresh start from last known OK state
@@ -1138,11 +1193,21 @@ class MachineRuleManager(models.Manager):
             # acknowlege the other machine rules from the last batch
             qs.update(cursor=None)
 
+        # short-circuit if nothing has changed since the machine rules were last found in sync
+        rules_sync_fingerprint = None
+        if not self.filter(enrolled_machine=enrolled_machine, cursor__isnull=False).exists():
+            rules_sync_fingerprint = self._get_rules_sync_fingerprint(
+                enrolled_machine, tags, configuration_rules_version
+            )
+            if rules_sync_fingerprint == enrolled_machine.rules_sync_fingerprint:
+                return [], None
+
         # translate attributes for older santa agents
         # TODO remove eventually
 
         # return next batch
         rules = []
+        machine_rules = []
         new_cursor = None
         use_sha256_attr = enrolled_machine.get_comparable_santa_version() < (2022, 1)
         for rule in self._iter_new_rules(enrolled_machine, tags):
@@ -1156,17 +1221,27 @@ class MachineRuleManager(models.Manager):
                 rule.pop("custom_msg", None)
             if use_sha256_attr and Target.Type(rule["rule_type"]).has_sha256_identifier:
                 rule["sha256"] = rule.pop("identifier")
-            self.update_or_create(enrolled_machine=enrolled_machine,
-                                  target=Target(pk=target_id),
-                                  defaults={
-                                      "policy": policy,
-                                      "version": version,
-                                      "cursor": new_cursor,
-                                  })
+            machine_rules.append(MachineRule(enrolled_machine=enrolled_machine,
+                                             target_id=target_id,
+                                             policy=policy,
+                                             version=version,
+                                             cursor=new_cursor))
             rules.append(rule)
         response_cursor = None
         if len(rules):
+            # single upsert for the whole batch
+            self.bulk_create(machine_rules,
+                             update_conflicts=True,
+                             unique_fields=["enrolled_machine", "target"],
+                             update_fields=["policy", "version", "cursor"])
             response_cursor = new_cursor
+        elif rules_sync_fingerprint and rules_sync_fingerprint != enrolled_machine.rules_sync_fingerprint:
+            # in sync → record the fingerprint.
+            # atomic update, because the enrolled machine instance can be stale.
+            EnrolledMachine.objects.filter(pk=enrolled_machine.pk).update(
+                rules_sync_fingerprint=rules_sync_fingerprint
+            )
+            enrolled_machine.rules_sync_fingerprint = rules_sync_fingerprint
         return rules, response_cursor
 
 
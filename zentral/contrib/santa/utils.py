@@ -7,7 +7,7 @@ from django.urls import reverse
 import psycopg2.extras
 from zentral.conf import settings
 from zentral.utils.payloads import generate_payload_uuid, get_payload_identifier, sign_payload
-from .models import Rule, Target
+from .models import Configuration, Rule, Target
 
 
 def build_santa_enrollment_configuration(enrollment):
@@ -452,7 +452,8 @@ def update_voting_rules(configurations):
     """Update the voting rules for multiple configurations
 
     Applies the target states of multiple configurations, and inserts, updates or deletes the voting rules.
-    Non-voting rules are left untouched.
+    Non-voting rules are left untouched. The rules are written without the Rule signals, so the rules
+    version of the changed configurations is bumped here.
     """
     query = (
         "with configuration_locks as ("
@@ -550,6 +551,7 @@ def update_voting_rules(configurations):
     )
     replaced_rules = {}
     changed_rules = []
+    changed_configuration_pks = set()
     with transaction.atomic():
         with connection.cursor() as cursor:
             cursor.execute(query, {"configuration_ids": tuple(c.pk for c in configurations)})
@@ -561,6 +563,9 @@ def update_voting_rules(configurations):
                     replaced_rules[result["id"]] = result
                 else:
                     changed_rules.append((op, result))
+                    changed_configuration_pks.add(result["configuration_id"])
+        for configuration_pk in sorted(changed_configuration_pks):
+            Configuration.bump_rules_version(configuration_pk)
 
     def result_to_serialized_rule(result):
         configuration = {"pk": result.pop("configuration_pk"),
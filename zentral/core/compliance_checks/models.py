@@ -1,6 +1,7 @@
 from enum import Enum
 import functools
 import logging
+import django.dispatch
 from django.db import models
 from django.utils.functional import cached_property
 from . import compliance_check_class_from_model
@@ -82,3 +83,7 @@ class MachineStatus(models.Model):
 
     class Meta:
         unique_together = (("compliance_check", "serial_number",))
+
+
+# sent with the serial_number when some machine statuses are updated
+machine_statuses_updated = django.dispatch.Signal()
@@ -3,7 +3,7 @@ from django.db import connection
 import psycopg2.extras
 from . import compliance_check_classes
 from .compliance_checks import BaseComplianceCheck
-from .models import Status
+from .models import Status, machine_statuses_updated
 
 
 def update_machine_statuses(serial_number, compliance_check_statuses):
@@ -30,7 +30,9 @@ def update_machine_statuses(serial_number, compliance_check_statuses):
              for compliance_check, status, status_time in compliance_check_statuses),
             fetch=True
         )
-        return result
+    if result:
+        machine_statuses_updated.send(sender=update_machine_statuses, serial_number=serial_number)
+    return result
 
 
 def get_machine_compliance_check_statuses(serial_number, tags):
@@ -424,8 +424,7 @@ class BaseEvent(object):
 
     @classmethod
     def post_machine_request_payloads(cls, msn, user_agent, ip, payloads, get_created_at=None, observer=None):
-        for event in cls.build_from_machine_request_payloads(msn, user_agent, ip, payloads, get_created_at, observer):
-            event.post()
+        post_events(cls.build_from_machine_request_payloads(msn, user_agent, ip, payloads, get_created_at, observer))
 
     def __init__(self, metadata, payload):
         self.metadata = metadata
@@ -590,6 +589,15 @@ class CommandEvent(BaseEvent):
 register_event_type(CommandEvent)
 
 
+def post_events(events):
+    events = list(events)
+    if len(events) == 1:
+        events[0].post()
+    elif events:
+        # bulk publish
+        queues.post_events(events)
+
+
 def post_command_events(message, source, tags):
     if not message:
         return
@@ -2,7 +2,7 @@ import logging
 import geoip2.database
 from . import event_from_event_d
 from zentral.conf import settings
-from zentral.core.probes.conf import all_probes
+from zentral.core.probes.conf import all_probes_event_index
 from zentral.core.incidents.utils import apply_incident_updates
 
 
@@ -39,12 +39,12 @@ def enrich_event(event):
             event.metadata.request.set_geo_from_city(city)
 
     # probe matching
-    for probe in all_probes.event_filtered(event):
+    for probe in all_probes_event_index.iter_matching_probes(event):
         event.metadata.add_probe(probe)
 
     # incident status updates
     for incident_event in apply_incident_updates(event):
-        for probe in all_probes.event_filtered(incident_event):
+        for probe in all_probes_event_index.iter_matching_probes(incident_event):
             incident_event.metadata.add_probe(probe, with_incident_updates=False)
         yield incident_event
 
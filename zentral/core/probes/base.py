@@ -105,6 +105,22 @@ class MetadataFilter(object):
             return False
         return True
 
+    def iter_event_index_keys(self):
+        # only one attribute is required to select the candidate events.
+        # the event types are the most selective ones.
+        if self.event_types:
+            for event_type in self.event_types:
+                yield ("event_type", event_type)
+        elif self.event_tags:
+            for event_tag in self.event_tags:
+                yield ("tag", event_tag)
+        elif self.event_routing_keys:
+            for event_routing_key in self.event_routing_keys:
+                yield ("routing_key", event_routing_key)
+        else:
+            # empty filter, matches all the events
+            yield None
+
     def get_event_type_classes(self):
         etl = []
         for et in self.event_types:
@@ -150,24 +166,72 @@ class MetadataFiltersSerializer(serializers.Serializer):
         raise serializers.ValidationError("No event types or tags")
 
 
-def get_flattened_payload_values(payload, attrs):
+def iter_payload_values(payload, path, start=0):
+    """Yield the flattened payload values for the attribute path tuple"""
     if isinstance(payload, list):
         for nested_payload in payload:
-            yield from get_flattened_payload_values(nested_payload, list(attrs))
+            yield from iter_payload_values(nested_payload, path, start)
     elif isinstance(payload, dict):
-        attr = attrs.pop(0)
-        val = payload.get(attr)
+        val = payload.get(path[start])
         if val is None:
             return
-        if not attrs:
+        if start + 1 == len(path):
             if isinstance(val, (set, list)):
                 yield from (str(v) for v in val)
             else:
                 yield str(val)
         else:
-            yield from get_flattened_payload_values(val, attrs)
+            yield from iter_payload_values(val, path, start + 1)
     else:
-        logger.warning("Wrong payload filter attribute %s", attrs)
+        logger.warning("Wrong payload filter attribute %s", list(path[start:]))
+
+
+def get_flattened_payload_values(payload, attrs):
+    yield from iter_payload_values(payload, tuple(attrs))
+
+
+class PayloadPaths(object):
+    """
+    Compiled set of payload attribute paths.
+
+    The values for all the paths are extracted in a single pass over the payload.
+    """
+    def __init__(self, paths):
+        self.paths = frozenset(paths)
+        # attr → [path if the attr is the last element of the path, children]
+        self._trie = {}
+        for path in self.paths:
+            node = self._trie
+            for idx, attr in enumerate(path):
+                item = node.setdefault(attr, [None, {}])
+                if idx + 1 == len(path):
+                    item[0] = path
+                node = item[1]
+
+    def _walk(self, payload, node, values):
+        if isinstance(payload, list):
+            for nested_payload in payload:
+                self._walk(nested_payload, node, values)
+        elif isinstance(payload, dict):
+            for attr, (path, children) in node.items():
+                val = payload.get(attr)
+                if val is None:
+                    continue
+                if path is not None:
+                    if isinstance(val, (set, list)):
+                        values[path].update(str(v) for v in val)
+                    else:
+                        values[path].add(str(val))
+                if children:
+                    self._walk(val, children, values)
+        else:
+            logger.warning("Wrong payload filter attributes %s", sorted(node))
+
+    def extract(self, payload):
+        """Return a path → flattened payload value set dict"""
+        values = {path: set() for path in self.paths}
+        self._walk(payload, self._trie, values)
+        return values
 
 
 class PayloadFilter(object):
@@ -191,10 +255,20 @@ class PayloadFilter(object):
                 continue
             self.items.append((attribute, operator, values))
         self.items.sort()
-
-    def test_event_payload(self, payload):
-        for payload_attribute, operator, filter_value_set in self.items:
-            payload_value_set = set(get_flattened_payload_values(payload, payload_attribute.split(".")))
+        # attribute paths compiled once
+        self.compiled_items = [(tuple(attribute.split(".")), operator, values)
+                               for attribute, operator, values in self.items]
+
+    def iter_payload_paths(self):
+        for path, _, _ in self.compiled_items:
+            yield path
+
+    def test_event_payload(self, payload, payload_values=None):
+        for path, operator, filter_value_set in self.compiled_items:
+            if payload_values is not None and path in payload_values:
+                payload_value_set = payload_values[path]
+            else:
+                payload_value_set = set(iter_payload_values(payload, path))
             common_values = filter_value_set & payload_value_set
             if (operator == self.IN and not common_values) or (operator == self.NOT_IN and common_values):
                 # AND: all items of a payload filter must match
@@ -370,19 +444,44 @@ class BaseProbe(object):
                 return True
         return False
 
-    def _test_event_payload(self, payload):
+    def _test_event_payload(self, payload, payload_values=None):
         if not self.payload_filters:
             return True
         for payload_filter in self.payload_filters:
-            if payload_filter.test_event_payload(payload):
+            if payload_filter.test_event_payload(payload, payload_values):
                 # no need to check the other filters (OR)
                 return True
         return False
 
-    def test_event(self, event):
+    def iter_event_index_keys(self):
+        """
+        Yield the (attribute, value) keys used to select the candidate events for this probe.
+
+        A None key means that all the events are candidates.
+        """
+        if not self.loaded:
+            return
+        if self.forced_event_type:
+            yield ("event_type", self.forced_event_type)
+        elif not self.metadata_filters:
+            yield None
+        else:
+            for metadata_filter in self.metadata_filters:
+                yield from metadata_filter.iter_event_index_keys()
+
+    def iter_payload_paths(self):
+        if not self.loaded:
+            return
+        for payload_filter in self.payload_filters:
+            yield from payload_filter.iter_payload_paths()
+
+    def test_event(self, event, payload_values=None):
         """
         Test if the event is a match for this probe.
 
+        payload_values is an optional path → flattened payload value set dict,
+        shared between the probes tested against the same event.
+
         The probe sub classes can extend the tests.
         """
         if not self.loaded:
@@ -395,7 +494,7 @@ class BaseProbe(object):
                 return False
         elif not self._test_event_metadata(metadata):
             return False
-        if not self._test_event_payload(event.payload):
+        if not self._test_event_payload(event.payload, payload_values):
             return False
         return True
 
@@ -3,6 +3,7 @@ import os
 import threading
 import weakref
 from base.notifier import notifier
+from .base import PayloadPaths
 from .models import ProbeSource
 
 
@@ -116,6 +117,97 @@ class ProbeList(ProbeView):
             return probe.test_event(event)
         return self.filter(_filter)
 
+    def event_index(self):
+        child = ProbeEventIndex(self)
+        self._children.add(child)
+        return child
+
+
+class ProbeEventIndex(ProbeView):
+    """Index of the probes by event type, tag and routing key
+
+    Used to only test the events against the candidate probes.
+    """
+    def __init__(self, parent=None, with_sync=False):
+        super().__init__(parent, with_sync=with_sync)
+        self._index = None
+        self._catch_all = None
+        self._payload_paths = None
+
+    def clear(self, *args, **kwargs):
+        with self._lock:
+            self._probes = None
+            self._index = None
+            self._catch_all = None
+            self._payload_paths = None
+
+    def _load(self):
+        self._start_sync()
+        if self._probes is None:
+            probes = []
+            index = {}
+            catch_all = set()
+            for probe in self.iter_parent_probes():
+                probe_idx = len(probes)
+                probes.append(probe)
+                for key in probe.iter_event_index_keys():
+                    if key is None:
+                        catch_all.add(probe_idx)
+                    else:
+                        index.setdefault(key, set()).add(probe_idx)
+            self._index = index
+            self._catch_all = catch_all
+            # candidate probe indexes → compiled payload paths
+            self._payload_paths = {}
+            self._probes = probes
+
+    @staticmethod
+    def _iter_event_keys(event):
+        metadata = event.metadata
+        yield ("event_type", event.event_type)
+        for tag in metadata.all_tags:
+            yield ("tag", tag)
+        if metadata.routing_key:
+            yield ("routing_key", metadata.routing_key)
+
+    def _get_candidate_probes(self, event):
+        with self._lock:
+            self._load()
+            probes = self._probes
+            index = self._index
+            candidates = set(self._catch_all)
+            payload_paths_cache = self._payload_paths
+        for key in self._iter_event_keys(event):
+            probe_idx_set = index.get(key)
+            if probe_idx_set:
+                candidates.update(probe_idx_set)
+        # keep the order of the parent probes
+        candidates = tuple(sorted(candidates))
+        candidate_probes = [probes[probe_idx] for probe_idx in candidates]
+        try:
+            payload_paths = payload_paths_cache[candidates]
+        except KeyError:
+            payload_paths = None
+            paths = set(path for probe in candidate_probes for path in probe.iter_payload_paths())
+            if paths:
+                payload_paths = PayloadPaths(paths)
+            payload_paths_cache[candidates] = payload_paths
+        return candidate_probes, payload_paths
+
+    def iter_candidate_probes(self, event):
+        candidate_probes, _ = self._get_candidate_probes(event)
+        yield from candidate_probes
+
+    def iter_matching_probes(self, event):
+        candidate_probes, payload_paths = self._get_candidate_probes(event)
+        payload_values = None
+        if payload_paths:
+            # single pass over the payload for all the candidate probes
+            payload_values = payload_paths.extract(event.payload)
+        for probe in candidate_probes:
+            if probe.test_event(event, payload_values):
+                yield probe
+
 
 # used for the tests, to avoid having an extra DB connection
 zentral_probes_sync = os.environ.get("ZENTRAL_PROBES_SYNC", "1") == "1"
@@ -123,3 +215,4 @@ zentral_probes_sync = os.environ.get("ZENTRAL_PROBES_SYNC", "1") == "1"
 
 all_probes = ProbeList(with_sync=zentral_probes_sync)
 all_probes_dict = all_probes.dict(item_func=lambda p: [(p.pk, p)], unique_key=True)
+all_probes_event_index = all_probes.event_index()
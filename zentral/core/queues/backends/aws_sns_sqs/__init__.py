@@ -11,6 +11,7 @@ from django.utils.functional import cached_property
 from django.utils.text import slugify
 from zentral.conf import settings
 from zentral.core.queues.backends.base import BaseEventQueues
+from zentral.utils.local_cache import setup_local_cache_metrics
 from .consumer import BatchConsumer, ConcurrentConsumer, Consumer, ConsumerProducer
 from .sns import SNSPublishThread
 from .sqs import SQSSendThread
@@ -37,6 +38,7 @@ class WorkerMixin:
         if self.metrics_exporter:
             for name, label in self.counters:
                 self.metrics_exporter.add_counter(name, [label])
+            setup_local_cache_metrics(self.metrics_exporter)
             self.metrics_exporter.start()
 
     def inc_counter(self, name, label):
@@ -321,6 +323,7 @@ class BulkStoreWorker(WorkerMixin, BatchConsumer):
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
+        self.event_store.setup_metrics_exporter(self.metrics_exporter)
         super().run(*args, **kwargs)
 
     def process_events(self, batch):
@@ -544,7 +547,7 @@ class EventQueues(BaseEventQueues):
             self._threads.append(thread)
         self._raw_events_queue.put((None, routing_key, raw_event, time.monotonic()))
 
-    def post_event(self, event):
+    def _get_events_queue(self):
         self._setup_graceful_stop()
         if self._events_queue is None:
             self._events_queue = queue.Queue(maxsize=20)
@@ -557,7 +560,16 @@ class EventQueues(BaseEventQueues):
             )
             thread.start()
             self._threads.append(thread)
-        self._events_queue.put((None, None, event.serialize(machine_metadata=False), time.monotonic()))
+        return self._events_queue
+
+    def post_event(self, event):
+        self._get_events_queue().put((None, None, event.serialize(machine_metadata=False), time.monotonic()))
+
+    def post_events(self, events):
+        # the SQS send thread groups the events in SendMessageBatch calls
+        events_queue = self._get_events_queue()
+        for event in events:
+            events_queue.put((None, None, event.serialize(machine_metadata=False), time.monotonic()))
 
     def stop(self):
         if self._stop_event is None:
@@ -146,6 +146,8 @@ class SQSDeleteThread(threading.Thread):
 
 class SQSSendThread(threading.Thread):
     max_number_of_messages = 10
+    # SQS limit for the total payload of a batch
+    max_batch_payload_bytes = 256 * 1024
     max_event_age_seconds = 5
 
     def __init__(self, queue_url, stop_event, in_queue, out_queue, client_kwargs=None):
@@ -161,6 +163,7 @@ class SQSSendThread(threading.Thread):
     def run(self):
         logger.info("[%s] start on queue %s", self.name, self.queue_url)
         self.entries = {}
+        self.entries_payload_bytes = 0
         self.min_event_ts = None
         while True:
             logger.debug("[%s] %s event(s) to send", self.name, len(self.entries))
@@ -192,11 +195,26 @@ class SQSSendThread(threading.Thread):
                             "StringValue": routing_key
                         }
                     }
+                entry_payload_bytes = self.get_entry_payload_bytes(entry)
+                if self.entries and self.entries_payload_bytes + entry_payload_bytes > self.max_batch_payload_bytes:
+                    logger.debug("[%s] send %s event(s) because max batch payload size reached",
+                                 self.name, len(self.entries))
+                    self.send_entries()
                 self.entries[entry_id] = (receipt_handle, entry)
+                self.entries_payload_bytes += entry_payload_bytes
                 self.min_event_ts = min(self.min_event_ts or event_ts, event_ts)
                 if len(self.entries) == self.max_number_of_messages:
                     self.send_entries()
 
+    @staticmethod
+    def get_entry_payload_bytes(entry):
+        # message body + message attribute names, types and values
+        payload_bytes = len(entry["MessageBody"].encode("utf-8"))
+        for attribute_name, attribute in entry.get("MessageAttributes", {}).items():
+            payload_bytes += len(attribute_name.encode("utf-8")) + len(attribute["DataType"].encode("utf-8"))
+            payload_bytes += len(attribute["StringValue"].encode("utf-8"))
+        return payload_bytes
+
     def send_entries(self):
         entry_count = len(self.entries)
         logger.debug("[%s] send %s event(s)", self.name, entry_count)
@@ -230,4 +248,5 @@ class SQSSendThread(threading.Thread):
                 logger.error("[%s] %s/%s event sending error(s)", self.name, failed_entry_count, entry_count)
         # update state
         self.entries = {}
+        self.entries_payload_bytes = 0
         self.min_event_ts = None
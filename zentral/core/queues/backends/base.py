@@ -24,6 +24,11 @@ class BaseEventQueues:
     def post_event(self, event):
         raise NotImplementedError
 
+    def post_events(self, events):
+        """Post multiple events. Override to publish them in bulk"""
+        for event in events:
+            self.post_event(event)
+
     # stop
 
     def stop(self):
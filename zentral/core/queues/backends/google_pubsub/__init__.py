@@ -263,6 +263,11 @@ class BulkStoreWorker(BaseWorker):
         self.batch = deque()
         self.batch_start_ts = None
 
+    def start_metrics_exporter(self, metrics_exporter):
+        # the store counters must be added before the exporter is started
+        self.event_store.setup_metrics_exporter(metrics_exporter)
+        super().start_metrics_exporter(metrics_exporter)
+
     def _skip_event(self, event_d):
         event_type = event_d['_zentral']['type']
         if not self.event_store.is_serialized_event_included(event_d):
@@ -398,11 +403,18 @@ class EventQueues(BaseEventQueues):
 
         # publisher client
         self.publisher_client = None
+        self.publisher_batch_settings = None
+        batch_settings = config_d.get("publisher_batch_settings")
+        if batch_settings:
+            self.publisher_batch_settings = pubsub_v1.types.BatchSettings(**batch_settings)
 
     def _publish(self, topic, event_dict, **attributes):
         message = json.dumps(event_dict).encode("utf-8")
         if self.publisher_client is None:
-            self.publisher_client = pubsub_v1.PublisherClient(credentials=self.credentials)
+            client_kwargs = {"credentials": self.credentials}
+            if self.publisher_batch_settings:
+                client_kwargs["batch_settings"] = self.publisher_batch_settings
+            self.publisher_client = pubsub_v1.PublisherClient(**client_kwargs)
         self.publisher_client.publish(topic, message, **attributes)
 
     def get_preprocess_worker(self):
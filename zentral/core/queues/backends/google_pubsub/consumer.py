@@ -4,6 +4,7 @@ from kombu.utils import json
 from django.utils.functional import cached_property
 from google.api_core.exceptions import AlreadyExists
 from google.cloud import pubsub_v1
+from zentral.utils.local_cache import setup_local_cache_metrics
 
 
 logger = logging.getLogger('zentral.core.queues.backends.google_pubsub.consumer')
@@ -74,6 +75,7 @@ class BaseWorker:
         if self.metrics_exporter:
             for name, label in self.counters:
                 self.metrics_exporter.add_counter(name, [label])
+            setup_local_cache_metrics(self.metrics_exporter)
             self.metrics_exporter.start()
 
     def inc_counter(self, name, label):
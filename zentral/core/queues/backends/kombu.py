@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from importlib import import_module
 import logging
 import time
@@ -5,9 +6,11 @@ from zentral.conf import settings
 from kombu import Connection, Consumer, Exchange, Queue
 from kombu.mixins import ConsumerMixin, ConsumerProducerMixin
 from kombu.pools import producers
+from kombu.transport import virtual
 from zentral.core.queues.backends.base import BaseEventQueues
 from zentral.core.queues.exceptions import RetryLater
 from zentral.utils.json import save_dead_letter
+from zentral.utils.local_cache import setup_local_cache_metrics
 
 
 logger = logging.getLogger('zentral.core.queues.backends.kombu')
@@ -34,6 +37,7 @@ class BaseWorker:
         if self.metrics_exporter:
             for name, label in self.counters:
                 self.metrics_exporter.add_counter(name, [label])
+            setup_local_cache_metrics(self.metrics_exporter)
             self.metrics_exporter.start()
 
     def inc_counter(self, name, label):
@@ -53,6 +57,78 @@ class BaseWorker:
         self.log(msg, logging.ERROR, *args)
 
 
+class BatchWorkerMixin:
+    """Accumulate the consumed messages and process them in batches
+
+    Batching is only enabled if batch_size > 1. The broker is asked to prefetch
+    batch_size messages, and the batch is processed when it is full, or when
+    the oldest message in the batch is older than flush_interval seconds.
+    """
+    default_flush_interval = 1  # in seconds
+
+    def setup_batch(self, batch_size, flush_interval):
+        self.batch_size = max(1, batch_size or 1)
+        self.flush_interval = flush_interval or self.default_flush_interval
+        self.batch = []
+        self.batch_start_ts = None
+
+    def get_batch_consumer(self, channel, queue, callback, batch_callback):
+        consumer_kwargs = {"queues": [queue], "accept": ["json"]}
+        if self.batch_size > 1:
+            consumer_kwargs["callbacks"] = [batch_callback]
+            consumer_kwargs["prefetch_count"] = self.batch_size
+        else:
+            consumer_kwargs["callbacks"] = [callback]
+        return Consumer(channel, **consumer_kwargs)
+
+    def add_message_to_batch(self, body, message):
+        self.batch.append((body, message))
+        if self.batch_start_ts is None:
+            self.batch_start_ts = time.monotonic()
+        if len(self.batch) >= self.batch_size:
+            self.log_debug("process batch because max batch size reached")
+            self.flush_batch()
+
+    def flush_batch(self):
+        batch = self.batch
+        self.batch = []
+        self.batch_start_ts = None
+        if batch:
+            self.process_batch(batch)
+
+    def process_batch(self, batch):
+        raise NotImplementedError
+
+    def ack_messages(self, messages):
+        if not messages:
+            return
+        last_message = messages[-1]
+        if isinstance(last_message.channel, virtual.Channel):
+            # the virtual transports ignore the multiple flag
+            for message in messages:
+                message.ack()
+        else:
+            # all the messages are consumed from the same channel
+            last_message.ack(multiple=True)
+
+    # kombu ConsumerMixin hooks
+
+    def on_iteration(self):
+        if self.batch and time.monotonic() > self.batch_start_ts + self.flush_interval:
+            self.log_debug("process batch because flush interval reached")
+            self.flush_batch()
+
+    @contextmanager
+    def extra_context(self, connection, channel):
+        # the unacknowledged messages of a previous connection are redelivered by the broker
+        self.batch = []
+        self.batch_start_ts = None
+        yield
+        if self.batch:
+            self.log_debug("process batch before exit")
+            self.flush_batch()
+
+
 class PreprocessWorker(ConsumerProducerMixin, BaseWorker):
     name = "preprocess worker"
     counters = (
@@ -117,17 +193,18 @@ class PreprocessWorker(ConsumerProducerMixin, BaseWorker):
         self.inc_counter("preprocessed_events", routing_key or "UNKNOWN")
 
 
-class EnrichWorker(ConsumerProducerMixin, BaseWorker):
+class EnrichWorker(BatchWorkerMixin, ConsumerProducerMixin, BaseWorker):
     name = "enrich worker"
     counters = (
         ("enriched_events", "event_type"),
         ("produced_events", "event_type"),
     )
 
-    def __init__(self, connection, enrich_event):
+    def __init__(self, connection, enrich_event, batch_size=1, flush_interval=None):
         self.connection = connection
         self.enrich_event = enrich_event
         self.name = "enrich worker"
+        self.setup_batch(batch_size, flush_interval)
 
     def run(self, *args, **kwargs):
         self.log_info("run")
@@ -135,10 +212,8 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
         super().run(*args, **kwargs)
 
     def get_consumers(self, _, default_channel):
-        return [Consumer(default_channel,
-                         queues=[enrich_events_queue],
-                         accept=['json'],
-                         callbacks=[self.do_enrich_event])]
+        return [self.get_batch_consumer(default_channel, enrich_events_queue,
+                                        self.do_enrich_event, self.add_message_to_batch)]
 
     def do_enrich_event(self, body, message):
         self.log_debug("enrich event")
@@ -157,16 +232,48 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
             message.ack()
             self.inc_counter("enriched_events", event.event_type)
 
+    def process_batch(self, batch):
+        self.log_debug("enrich %d event(s)", len(batch))
+        enriched_messages = []
+        produced_events = []
+        requeued_message_count = 0
+        for body, message in batch:
+            try:
+                events = list(self.enrich_event(body))
+            except Exception as exception:
+                logger.exception("Requeuing message: %s", exception)
+                message.requeue()
+                requeued_message_count += 1
+            else:
+                enriched_messages.append((message, events[-1].event_type))
+                produced_events.extend(events)
+        # bulk publish with a single producer
+        producer = self.producer
+        for event in produced_events:
+            producer.publish(event.serialize(machine_metadata=True),
+                             serializer='json',
+                             exchange=enriched_events_exchange,
+                             declare=[enriched_events_exchange])
+            self.inc_counter("produced_events", event.event_type)
+        # bulk ack
+        self.ack_messages([message for message, _ in enriched_messages])
+        for _, event_type in enriched_messages:
+            self.inc_counter("enriched_events", event_type)
+        if requeued_message_count:
+            self.log_error("%s/%s message(s) requeued. 1s delay", requeued_message_count, len(batch))
+            time.sleep(1)
+
 
-class ProcessWorker(ConsumerMixin, BaseWorker):
+class ProcessWorker(BatchWorkerMixin, ConsumerMixin, BaseWorker):
     name = "process worker"
     counters = (
         ("processed_events", "event_type"),
     )
 
-    def __init__(self, connection, process_event):
+    def __init__(self, connection, process_event, batch_size=1, flush_interval=None):
         self.connection = connection
         self.process_event = process_event
+        self.setup_batch(batch_size, flush_interval)
 
     def run(self, *args, **kwargs):
         self.log_info("run")
@@ -174,10 +281,8 @@ class ProcessWorker(ConsumerMixin, BaseWorker):
         super().run(*args, **kwargs)
 
     def get_consumers(self, _, default_channel):
-        return [Consumer(default_channel,
-                         queues=[process_events_queue],
-                         accept=['json'],
-                         callbacks=[self.do_process_event])]
+        return [self.get_batch_consumer(default_channel, process_events_queue,
+                                        self.do_process_event, self.add_message_to_batch)]
 
     def do_process_event(self, body, message):
         self.log_debug("process event")
@@ -186,6 +291,27 @@ class ProcessWorker(ConsumerMixin, BaseWorker):
         message.ack()
         self.inc_counter("processed_events", event_type)
 
+    def process_batch(self, batch):
+        self.log_debug("process %d event(s)", len(batch))
+        processed_messages = []
+        rejected_message_count = 0
+        for body, message in batch:
+            try:
+                self.process_event(body)
+            except Exception as exception:
+                # rejected, not requeued, to not trigger the actions of the other probes twice
+                logger.exception("Rejecting message: %s", exception)
+                message.reject()
+                rejected_message_count += 1
+            else:
+                processed_messages.append((message, body['_zentral']['type']))
+        # bulk ack
+        self.ack_messages([message for message, _ in processed_messages])
+        for _, event_type in processed_messages:
+            self.inc_counter("processed_events", event_type)
+        if rejected_message_count:
+            self.log_error("%s/%s message(s) rejected", rejected_message_count, len(batch))
+
 
 class StoreWorker(ConsumerMixin, BaseWorker):
     counters = (
@@ -235,6 +361,13 @@ class EventQueues(BaseEventQueues):
         super().__init__(config_d)
         self.backend_url = config_d['backend_url']
         self.transport_options = config_d.get('transport_options')
+        self.worker_batch_kwargs = {}
+        for worker_key in ("enrich_worker", "process_worker"):
+            worker_config_d = config_d.get(worker_key) or {}
+            self.worker_batch_kwargs[worker_key] = {
+                "batch_size": int(worker_config_d.get("batch_size", 1)),
+                "flush_interval": worker_config_d.get("flush_interval"),
+            }
         self.connection = self._get_connection()
 
     def _get_connection(self):
@@ -244,10 +377,12 @@ class EventQueues(BaseEventQueues):
         return PreprocessWorker(self._get_connection())
 
     def get_enrich_worker(self, enrich_event):
-        return EnrichWorker(self._get_connection(), enrich_event)
+        return EnrichWorker(self._get_connection(), enrich_event,
+                            **self.worker_batch_kwargs["enrich_worker"])
 
     def get_process_worker(self, process_event):
-        return ProcessWorker(self._get_connection(), process_event)
+        return ProcessWorker(self._get_connection(), process_event,
+                             **self.worker_batch_kwargs["process_worker"])
 
     def get_store_worker(self, event_store):
         return StoreWorker(self._get_connection(), event_store)
@@ -260,9 +395,18 @@ class EventQueues(BaseEventQueues):
                              routing_key=routing_key,
                              declare=[raw_events_exchange])
 
+    def _publish_event(self, producer, event):
+        producer.publish(event.serialize(machine_metadata=False),
+                         serializer='json',
+                         exchange=events_exchange,
+                         declare=[events_exchange])
+
     def post_event(self, event):
         with producers[self.connection].acquire(block=True) as producer:
-            producer.publish(event.serialize(machine_metadata=False),
-                             serializer='json',
-                             exchange=events_exchange,
-                             declare=[events_exchange])
+            self._publish_event(producer, event)
+
+    def post_events(self, events):
+        # one producer, one channel for all the events
+        with producers[self.connection].acquire(block=True) as producer:
+            for event in events:
+                self._publish_event(producer, event)
@@ -41,6 +41,7 @@ def datetime_to_iso8601z_truncated_to_milliseconds(dt):
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 100
     log_type = "ZentralEvent"
     content_type = "application/json"
     resource = "/api/logs"
@@ -76,10 +77,9 @@ class EventStore(BaseEventStore):
         return dict(items)
 
     def _prepare_event(self, event):
-        if not isinstance(event, dict):
-            event_d = event.serialize()
-        else:
-            event_d = event
+        if isinstance(event, dict):
+            event = event_from_event_d(event)
+        event_d = event.serialize()
 
         metadata = event_d.pop("_zentral")
 
@@ -109,16 +109,25 @@ class EventStore(BaseEventStore):
                 digestmod=hashlib.sha256).digest()
         )
 
-    def store(self, event):
+    def _post_azure_events(self, azure_events):
         # Build and send a request to the POST API
-        if isinstance(event, dict):
-            event = event_from_event_d(event)
-        data = json.dumps(self._prepare_event(event)).encode("utf-8")
+        data = json.dumps(azure_events).encode("utf-8")
         rfc1123_date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
         signature = self._build_signature(rfc1123_date, len(data))
         self._session.headers.update({
             'Authorization': "SharedKey {}:{}".format(self.customer_id, signature.decode("utf-8")),
             'x-ms-date': rfc1123_date,
         })
-        r = self._session.post(self._url, data=data)
+        return self._session.post(self._url, data=data)
+
+    def store(self, event):
+        r = self._post_azure_events(self._prepare_event(event))
         r.raise_for_status()
+
+    def bulk_store(self, events):
+        event_keys, prepared_events = self.prepare_event_batch(events, self._prepare_event)
+        azure_events = [azure_event for prepared_event in prepared_events for azure_event in prepared_event]
+        if azure_events:
+            # the signature is computed for each attempt, with a fresh date
+            self.send_with_retries(lambda: self._post_azure_events(azure_events), "bulk store request")
+        return event_keys
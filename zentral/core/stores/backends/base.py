@@ -1,11 +1,18 @@
+import logging
+import random
+import time
 import warnings
 from zentral.core.events.filter import EventFilterSet
 
 
+logger = logging.getLogger("zentral.core.stores.backends.base")
+
+
 class BaseEventStore(object):
     read_only = False  # if read only, we do not need a store worker
     max_batch_size = 1
     max_concurrency = 1
+    max_retries = 3
     machine_events = False
     machine_events_url = False
     last_machine_heartbeats = False
@@ -24,6 +31,7 @@ class BaseEventStore(object):
         self.configured = False
         self.batch_size = min(self.max_batch_size, max(config_d.get("batch_size") or 1, 1))
         self.concurrency = min(self.max_concurrency, max(config_d.get("concurrency") or 1, 1))
+        self.metrics_exporter = None
         self.event_filter_set = EventFilterSet.from_mapping(config_d)
         # legacy included / excluded event types attrs ?
         # TODO remove later
@@ -54,10 +62,53 @@ class BaseEventStore(object):
     def wait_and_configure(self):
         self.configured = True
 
+    def setup_metrics_exporter(self, metrics_exporter):
+        self.metrics_exporter = metrics_exporter
+
     def wait_and_configure_if_necessary(self):
         if not self.configured:
             self.wait_and_configure()
 
+    # bulk store helpers
+
+    @staticmethod
+    def get_event_key(event):
+        if isinstance(event, dict):
+            metadata = event["_zentral"]
+            return metadata["id"], metadata["index"]
+        else:
+            return str(event.metadata.uuid), event.metadata.index
+
+    def prepare_event_batch(self, events, serialize_event):
+        """Serialize a batch of events for the bulk_store method
+
+        Returns the list of the event keys, and the list of the serialized events.
+        """
+        if self.batch_size < 2:
+            raise RuntimeError("bulk_store is not available when batch_size < 2")
+        event_keys = []
+        serialized_events = []
+        for event in events:
+            # the key first, the serialization can pop the metadata
+            event_keys.append(self.get_event_key(event))
+            serialized_events.append(serialize_event(event))
+        return event_keys, serialized_events
+
+    def send_with_retries(self, send_request, description="store request"):
+        """Send a HTTP request, retry if there is a temporary server error"""
+        for i in range(self.max_retries):
+            response = send_request()
+            if response.ok:
+                return response
+            if response.status_code == 429 or response.status_code >= 500:
+                logger.error("Store %s: status code %s for %s", self.name, response.status_code, description)
+                if i + 1 < self.max_retries:
+                    seconds = random.uniform(3, 4) * (i + 1)
+                    logger.error("Store %s: retry %s in %.1fs", self.name, description, seconds)
+                    time.sleep(seconds)
+                    continue
+            response.raise_for_status()
+
     # machine events
 
     def fetch_machine_events(self, serial_number, from_dt, to_dt=None, event_type=None, limit=10, cursor=None):
@@ -1,7 +1,7 @@
 import logging
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import streaming_bulk
-from elasticsearch.exceptions import ConnectionError, RequestError
+from elasticsearch.exceptions import ApiError, ConnectionError, RequestError
 from .es_os_base import ESOSEventStore
 
 
@@ -12,6 +12,7 @@ class EventStore(ESOSEventStore):
     client_class = Elasticsearch
     connection_error_class = ConnectionError
     request_error_class = RequestError
+    transport_error_class = ApiError
 
     def _streaming_bulk(self, *args, **kwargs):
         return streaming_bulk(*args, **kwargs)
@@ -1,9 +1,14 @@
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
+import math
 import random
+import threading
 import time
 from urllib.parse import urlencode, urljoin, urlparse
 from dateutil import parser
+from django.core.serializers.json import DjangoJSONEncoder
 from zentral.core.events import event_from_event_d, event_types
 from zentral.core.events.filter import EventFilterSet
 from zentral.core.exceptions import ImproperlyConfigured
@@ -23,8 +28,18 @@ class ESOSEventStore(BaseEventStore):
     streaming_bulk = None
     connection_error_class = Exception
     request_error_class = Exception
+    transport_error_class = Exception
 
     max_batch_size = 500
+    max_bulk_concurrency = 10
+    default_bulk_max_chunk_bytes = 5 * 2**20  # 5MB
+    bulk_initial_backoff = 1  # seconds
+    bulk_max_backoff = 60  # seconds
+    bulk_counters = (
+        ("store_bulk_chunks", ["store", "status"]),
+        ("store_bulk_chunk_seconds", ["store"]),
+        ("store_bulk_rejected_events", ["store"]),
+    )
     machine_events = True
     last_machine_heartbeats = True
     object_events = True
@@ -147,6 +162,13 @@ class ESOSEventStore(BaseEventStore):
         self._client = self.client_class(**self._get_client_kwargs(config_d))
         self.test = test
 
+        # parallel bulk
+        self.bulk_concurrency = min(self.max_bulk_concurrency, max(config_d.get("bulk_concurrency") or 1, 1))
+        self.bulk_max_chunk_bytes = max(config_d.get("bulk_max_chunk_bytes") or self.default_bulk_max_chunk_bytes, 1)
+        self._bulk_executor = None
+        self._bulk_backoff = 0
+        self._bulk_backoff_lock = threading.Lock()
+
         self.version = None
         self.use_mapping_types = None
 
@@ -324,6 +346,31 @@ class ESOSEventStore(BaseEventStore):
         if self.test:
             self._client.indices.refresh(index=index)
 
+    def setup_metrics_exporter(self, metrics_exporter):
+        super().setup_metrics_exporter(metrics_exporter)
+        if self.metrics_exporter:
+            for name, labels in self.bulk_counters:
+                self.metrics_exporter.add_counter(name, labels)
+
+    def _inc_bulk_counter(self, name, *label_values, value=1):
+        if self.metrics_exporter:
+            self.metrics_exporter.inc(name, self.name, *label_values, value=value)
+
+    @staticmethod
+    def _log_bulk_item_error(event_id, event_index, item):
+        error = item.get("error")
+        error_type = reason = None
+        if error:
+            if isinstance(error, dict):
+                error_type = error.get("type")
+                reason = error.get("reason")
+            elif isinstance(error, str):
+                reason = error
+            else:
+                reason = "UNKNOWN"
+        logger.error("could not index event %s %s: %s %s",
+                     event_id, event_index, error_type or "-", reason or "-")
+
     def bulk_store(self, events):
         self.wait_and_configure_if_necessary()
         if self.batch_size < 2:
@@ -331,6 +378,10 @@ class ESOSEventStore(BaseEventStore):
         if self.version < [7]:
             raise RuntimeError("bulk_store is not available for elasticsearch < 7")
 
+        if self.bulk_concurrency > 1:
+            yield from self._parallel_bulk_store(events)
+            return
+
         ID_SEP = "_"
 
         def iter_actions():
@@ -353,18 +404,112 @@ class ESOSEventStore(BaseEventStore):
                 if ok:
                     yield event_id, event_index
                 else:
-                    error = item["index"].get("error")
-                    error_type = reason = None
-                    if error:
-                        if isinstance(error, dict):
-                            error_type = error.get("type")
-                            reason = error.get("reason")
-                        elif isinstance(error, str):
-                            reason = error
-                        else:
-                            reason = "UNKNOWN"
-                    logger.error("could not index event %s %s: %s %s",
-                                 event_id, event_index, error_type or "-", reason or "-")
+                    self._log_bulk_item_error(event_id, event_index, item["index"])
+
+    # parallel bulk
+
+    def _serialize_bulk_action(self, event):
+        index, _, doc = self._serialize_event(event)
+        event_key = (doc["id"], doc["index"])
+        header = {"index": {"_index": index, "_id": f"{event_key[0]}_{event_key[1]}"}}
+        payload = (json.dumps(header) + "\n" + json.dumps(doc, cls=DjangoJSONEncoder) + "\n").encode("utf-8")
+        return event_key, payload
+
+    def _iter_bulk_chunks(self, actions):
+        """Group the bulk actions in chunks, by payload size
+
+        The chunk size is capped to spread the actions over all the concurrent requests.
+        """
+        max_chunk_bytes = min(
+            self.bulk_max_chunk_bytes,
+            math.ceil(sum(len(payload) for _, payload in actions) / self.bulk_concurrency)
+        )
+        chunk = []
+        chunk_bytes = 0
+        for action in actions:
+            action_bytes = len(action[1])
+            if chunk and chunk_bytes + action_bytes > max_chunk_bytes:
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(action)
+            chunk_bytes += action_bytes
+        if chunk:
+            yield chunk
+
+    def _update_bulk_backoff(self, rejected):
+        # exponential increase on rejections, progressive decrease on success
+        with self._bulk_backoff_lock:
+            if rejected:
+                self._bulk_backoff = min(self.bulk_max_backoff, max(self.bulk_initial_backoff, 2 * self._bulk_backoff))
+            elif self._bulk_backoff:
+                self._bulk_backoff /= 2
+                if self._bulk_backoff < self.bulk_initial_backoff:
+                    self._bulk_backoff = 0
+
+    def _send_bulk_chunk(self, chunk):
+        """Send a chunk of bulk actions
+
+        Returns the stored event keys, and the rejected actions (429) to retry.
+        """
+        backoff = self._bulk_backoff
+        if backoff:
+            time.sleep(backoff * random.uniform(0.5, 1.5))
+        stored_event_keys = []
+        rejected_actions = []
+        start_t = time.monotonic()
+        try:
+            response = self._client.bulk(body=b"".join(payload for _, payload in chunk))
+        except self.transport_error_class as exception:
+            if getattr(exception, "status_code", None) != 429:
+                raise
+            rejected_actions = chunk
+        else:
+            for action, item in zip(chunk, response["items"]):
+                event_key = action[0]
+                item = item.get("index", {})
+                status = item.get("status", 500)
+                if 200 <= status < 300:
+                    stored_event_keys.append(event_key)
+                elif status == 429:
+                    rejected_actions.append(action)
+                else:
+                    self._log_bulk_item_error(*event_key, item)
+        latency = time.monotonic() - start_t
+        logger.debug("Store %s: bulk chunk of %s event(s) sent in %.3fs, %s rejected",
+                     self.name, len(chunk), latency, len(rejected_actions))
+        self._update_bulk_backoff(bool(rejected_actions))
+        self._inc_bulk_counter("store_bulk_chunks", "rejected" if rejected_actions else "ok")
+        self._inc_bulk_counter("store_bulk_chunk_seconds", value=latency)
+        if rejected_actions:
+            self._inc_bulk_counter("store_bulk_rejected_events", value=len(rejected_actions))
+        return stored_event_keys, rejected_actions
+
+    def _send_bulk_chunk_or_fail(self, chunk):
+        try:
+            return self._send_bulk_chunk(chunk)
+        except Exception:
+            logger.exception("Store %s: could not send bulk chunk of %s event(s)", self.name, len(chunk))
+            self._inc_bulk_counter("store_bulk_chunks", "error")
+            return [], []
+
+    def _parallel_bulk_store(self, events):
+        if self._bulk_executor is None:
+            self._bulk_executor = ThreadPoolExecutor(max_workers=self.bulk_concurrency,
+                                                     thread_name_prefix=f"{self.name} bulk")
+        actions = [self._serialize_bulk_action(event) for event in events]
+        for i in range(self.max_retries):
+            if not actions:
+                break
+            rejected_actions = []
+            for stored_event_keys, chunk_rejected_actions in self._bulk_executor.map(
+                self._send_bulk_chunk_or_fail, self._iter_bulk_chunks(actions)
+            ):
+                yield from stored_event_keys
+                rejected_actions.extend(chunk_rejected_actions)
+            actions = rejected_actions
+        if actions:
+            logger.error("Store %s: %s event(s) rejected after %s attempts", self.name, len(actions), self.max_retries)
 
     def _build_kibana_url(self, body, from_dt=None, to_dt=None):
         if not self.kibana_discover_url:
@@ -754,4 +899,7 @@ class ESOSEventStore(BaseEventStore):
                 for b in r['aggregations']['buckets']['buckets']]
 
     def close(self):
+        if self._bulk_executor is not None:
+            self._bulk_executor.shutdown()
+            self._bulk_executor = None
         self._client.close()
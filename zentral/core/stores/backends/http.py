@@ -40,7 +40,7 @@ class HTTPStoreClient:
             r = self.session.post(self.endpoint_url, json=payload)
             if r.ok:
                 return
-            if r.status_code > 500:
+            if r.status_code >= 500:
                 logger.error("[%s] temporary server error", self.name)
                 if i + 1 < self.max_retries:
                     seconds = random.uniform(3, 4) * (i + 1)
@@ -84,6 +84,7 @@ class EventStoreThread(threading.Thread):
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 100
     max_retries = 3
     max_concurrency = 20
 
@@ -112,3 +113,11 @@ class EventStore(BaseEventStore):
 
     def store(self, event):
         self.client.store_event(event)
+
+    def bulk_store(self, events):
+        # the batch is POSTed as a JSON array
+        event_keys, payloads = self.prepare_event_batch(events, self.client._serialize_event)
+        if payloads:
+            self.send_with_retries(lambda: self.client.session.post(self.endpoint_url, json=payloads),
+                                   "bulk store request")
+        return event_keys
@@ -1,3 +1,5 @@
+import gzip
+import json
 import logging
 from urllib.parse import urljoin
 import requests
@@ -7,6 +9,7 @@ logger = logging.getLogger('zentral.core.stores.backends.humio')
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 100
 
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
@@ -38,3 +41,23 @@ class EventStore(BaseEventStore):
     def store(self, event):
         r = self._session.post(self.ingest_url, json=self._serialize_event(event))
         r.raise_for_status()
+
+    def bulk_store(self, events):
+        event_keys, serialized_events = self.prepare_event_batch(events, self._serialize_event)
+        if not serialized_events:
+            return event_keys
+        # one humio entry per event type
+        entries = {}
+        for serialized_event in serialized_events:
+            for entry in serialized_event:
+                event_type = entry["tags"]["event_type"]
+                try:
+                    entries[event_type]["events"].extend(entry["events"])
+                except KeyError:
+                    entries[event_type] = entry
+        data = gzip.compress(json.dumps(list(entries.values())).encode("utf-8"))
+        self.send_with_retries(
+            lambda: self._session.post(self.ingest_url, data=data, headers={"Content-Encoding": "gzip"}),
+            "bulk store request"
+        )
+        return event_keys
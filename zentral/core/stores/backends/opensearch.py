@@ -2,7 +2,7 @@ import logging
 import boto3
 from opensearchpy import AWSV4SignerAuth, OpenSearch, RequestsHttpConnection
 from opensearchpy.helpers import streaming_bulk
-from opensearchpy.exceptions import ConnectionError, RequestError
+from opensearchpy.exceptions import ConnectionError, RequestError, TransportError
 from zentral.core.exceptions import ImproperlyConfigured
 from .es_os_base import ESOSEventStore
 
@@ -14,6 +14,7 @@ class EventStore(ESOSEventStore):
     client_class = OpenSearch
     connection_error_class = ConnectionError
     request_error_class = RequestError
+    transport_error_class = TransportError
 
     def _get_client_kwargs(self, config_d):
         kwargs = super()._get_client_kwargs(config_d)
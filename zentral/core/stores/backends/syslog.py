@@ -25,6 +25,7 @@ class EventStore(BaseEventStore):
     DEFAULT_PROTOCOL = "udp"
     DEFAULT_PORT = 514
     MAX_CONNECTION_ATTEMPTS = 10
+    max_batch_size = 100
 
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
@@ -97,15 +98,31 @@ class EventStore(BaseEventStore):
         else:
             raise Exception('Could not connect socket')
 
-    def store(self, event):
-        self.wait_and_configure_if_necessary()
+    def _serialize_event(self, event):
         if not isinstance(event, dict):
             event = event.serialize()
         msg = json.dumps(remove_null_character(event))
         if self.prepend_ecc:
             msg = "@ecc: " + msg
-        msg = self.priority + msg.encode("utf-8")
+        return self.priority + msg.encode("utf-8")
+
+    def store(self, event):
+        self.wait_and_configure_if_necessary()
+        msg = self._serialize_event(event)
         if self.socket_protocol == socket.SOCK_STREAM:
             self.socket.sendall(msg + b'\x00')
         else:
             self.socket.send(msg)
+
+    def bulk_store(self, events):
+        self.wait_and_configure_if_necessary()
+        event_keys, msgs = self.prepare_event_batch(events, self._serialize_event)
+        if self.socket_protocol == socket.SOCK_STREAM:
+            # null terminated messages, in a single write
+            if msgs:
+                self.socket.sendall(b''.join(msg + b'\x00' for msg in msgs))
+        else:
+            # one datagram per message
+            for msg in msgs:
+                self.socket.send(msg)
+        return event_keys
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+# metrics
+
+HITS_COUNTER = "local_cache_hits"
+MISSES_COUNTER = "local_cache_misses"
+_metrics_exporter = None
+
+
+def setup_local_cache_metrics(metrics_exporter):
+    """Report the hits and misses of the local caches of this process to the worker metrics exporter"""
+    global _metrics_exporter
+    if metrics_exporter is None:
+        return
+    for counter in (HITS_COUNTER, MISSES_COUNTER):
+        metrics_exporter.add_counter(counter, ["cache"])
+    _metrics_exporter = metrics_exporter
+
+
+class LocalCache:
+    """Bounded in-process LRU cache, with a TTL
+
+    A max_size or a ttl of 0 disables the cache.
+    """
+    def __init__(self, name, max_size=1024, ttl=30):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    @staticmethod
+    def _get_time():
+        # to help with tests
+        return time.monotonic()
+
+    def _inc_counter(self, counter):
+        if _metrics_exporter:
+            _metrics_exporter.inc(counter, self.name)
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        with self._lock:
+            try:
+                expiry, value = self._items[key]
+            except KeyError:
+                value = default
+                hit = False
+            else:
+                if self._get_time() < expiry:
+                    self._items.move_to_end(key)
+                    hit = True
+                else:
+                    del self._items[key]
+                    value = default
+                    hit = False
+        self._inc_counter(HITS_COUNTER if hit else MISSES_COUNTER)
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items[key] = (self._get_time() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
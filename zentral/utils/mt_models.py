@@ -4,7 +4,7 @@ import hashlib
 from django.core.exceptions import FieldDoesNotExist
 from django.utils.functional import cached_property
 from django.utils.timezone import is_aware, make_naive
-from django.db import IntegrityError, models, transaction
+from django.db import connection, IntegrityError, models, transaction
 
 
 class MTOError(Exception):
@@ -167,6 +167,205 @@ class MTObjectManager(models.Manager):
                 created = True
         return obj, created
 
+    # bulk commit
+
+    @staticmethod
+    def _get_mt_probe(model, probes):
+        # instance used to get the MT fields
+        try:
+            return probes[model]
+        except KeyError:
+            probe = probes[model] = model()
+            return probe
+
+    @classmethod
+    def _iter_bulk_commit_children(cls, model, tree, probes):
+        probe = cls._get_mt_probe(model, probes)
+        for k, v in tree.items():
+            if k == "mt_hash":
+                continue
+            if isinstance(v, dict):
+                try:
+                    f = probe.get_mt_field(k, many_to_one=True)
+                except MTOError:
+                    f = probe.get_mt_field(k)
+                    if not isinstance(f, models.JSONField):
+                        raise MTOError('Cannot set field "{}" to dict value'.format(k))
+                else:
+                    yield f.related_model, v
+            elif isinstance(v, list):
+                f = probe.get_mt_field(k, many_to_many=True)
+                for sv in v:
+                    yield f.related_model, sv
+
+    @staticmethod
+    def _build_bulk_commit_obj(model, tree, pks, probe):
+        obj = model(mt_hash=tree["mt_hash"])
+        fk_hashes = {}
+        m2m_hashes = {}
+        m2m_pks = []
+        for k, v in tree.items():
+            if k == "mt_hash":
+                continue
+            if isinstance(v, dict):
+                try:
+                    f = probe.get_mt_field(k, many_to_one=True)
+                except MTOError:
+                    t = copy.deepcopy(v)
+                    cleanup_commit_tree(t)
+                    setattr(obj, k, t)
+                else:
+                    setattr(obj, f.attname, pks[(f.related_model, v["mt_hash"])])
+                    fk_hashes[k] = v["mt_hash"]
+            elif isinstance(v, list):
+                f = probe.get_mt_field(k, many_to_many=True)
+                m2m_hashes[k] = [sv["mt_hash"] for sv in v]
+                m2m_pks.append((f, [pks[(f.related_model, sv["mt_hash"])] for sv in v]))
+            else:
+                probe.get_mt_field(k)
+                setattr(obj, k, v)
+        # same verifications as in commit, without the DB queries
+        obj.full_clean(exclude=list(fk_hashes.keys()) + list(m2m_hashes.keys()),
+                       validate_unique=False, validate_constraints=False)
+        h = Hasher()
+        for f in model._meta.get_fields():
+            if f.name in probe.mt_excluded_field_set or f.auto_created:
+                continue
+            if f.many_to_many:
+                v = m2m_hashes.get(f.name)
+            elif f.many_to_one:
+                v = fk_hashes.get(f.name)
+            else:
+                v = getattr(obj, f.name)
+                if isinstance(f, models.JSONField) and v:
+                    t = copy.deepcopy(v)
+                    prepare_commit_tree(t)
+                    v = t['mt_hash']
+            h.add_field(f.name, v)
+        if h.hexdigest() != obj.mt_hash:
+            raise MTOError('Obj {} Hash missmatch!!!'.format(obj))
+        return obj, m2m_pks
+
+    @classmethod
+    def _bulk_commit_level_model(cls, model, trees, pks, created_keys, probes):
+        """Create all the missing objects of a model at a tree level"""
+        missing_hashes = sorted(trees.keys())
+        if model.save is not models.Model.save:
+            # custom save methods are not called by bulk_create
+            for mt_hash in missing_hashes:
+                obj, created = model.objects.commit(trees[mt_hash])
+                pks[(model, mt_hash)] = obj.pk
+                if created:
+                    created_keys.add((model, mt_hash))
+            return
+        probe = cls._get_mt_probe(model, probes)
+        objs = []
+        m2m_pks = {}
+        for mt_hash in missing_hashes:  # sorted, to always take the locks in the same order
+            obj, obj_m2m_pks = cls._build_bulk_commit_obj(model, trees[mt_hash], pks, probe)
+            objs.append(obj)
+            m2m_pks[mt_hash] = obj_m2m_pks
+        with transaction.atomic():
+            # the pks are allocated upfront, to find the objects actually inserted by this call
+            with connection.cursor() as cursor:
+                cursor.execute("select nextval(pg_get_serial_sequence(%s, %s)) from generate_series(1, %s)",
+                               [model._meta.db_table, model._meta.pk.column, len(objs)])
+                for obj, (pk,) in zip(objs, cursor.fetchall()):
+                    obj.pk = pk
+            # the objects concurrently created are skipped
+            model.objects.bulk_create(objs, ignore_conflicts=True)
+            for mt_hash, pk in model.objects.filter(mt_hash__in=missing_hashes).values_list("mt_hash", "pk"):
+                pks[(model, mt_hash)] = pk
+            for obj in objs:
+                try:
+                    pk = pks[(model, obj.mt_hash)]
+                except KeyError:
+                    raise MTOError("{} {} not found after the bulk create".format(
+                        model._meta.object_name, obj.mt_hash
+                    ))
+                if pk == obj.pk:
+                    created_keys.add((model, obj.mt_hash))
+            through_objs = {}
+            for mt_hash, obj_m2m_pks in m2m_pks.items():
+                obj_pk = pks[(model, mt_hash)]
+                for f, related_pks in obj_m2m_pks:
+                    through_model = f.remote_field.through
+                    through_objs.setdefault(through_model, []).extend(
+                        through_model(**{f.m2m_column_name(): obj_pk, f.m2m_reverse_name(): related_pk})
+                        for related_pk in related_pks
+                    )
+            for through_model, objs in through_objs.items():
+                through_model.objects.bulk_create(objs, ignore_conflicts=True)
+
+    def bulk_commit(self, trees, pk_cache=None):
+        """Commit a list of trees, level by level
+
+        The whole trees are hashed first. The existing objects are resolved top-down,
+        with one query per model and level. The missing objects are then created
+        bottom-up, in bulk.
+        pk_cache is an optional {model: {mt_hash: pk}} dict, shared between calls.
+        The objects of its models are only resolved once.
+        Returns a list of (obj, created) tuples, in the order of the trees.
+        """
+        if pk_cache is None:
+            pk_cache = {}
+        probes = {}
+        pks = {}
+        # resolve the existing objects, top-down
+        missing_nodes = {}
+        frontier = {}
+        for tree in trees:
+            prepare_commit_tree(tree)
+            frontier[(self.model, tree["mt_hash"])] = tree
+        while frontier:
+            model_hashes = {}
+            for model, mt_hash in frontier:
+                try:
+                    pks[(model, mt_hash)] = pk_cache[model][mt_hash]
+                except KeyError:
+                    model_hashes.setdefault(model, []).append(mt_hash)
+            for model, hashes in model_hashes.items():
+                for mt_hash, pk in model.objects.filter(mt_hash__in=hashes).values_list("mt_hash", "pk"):
+                    pks[(model, mt_hash)] = pk
+            next_frontier = {}
+            for key, tree in frontier.items():
+                if key in pks:
+                    continue
+                missing_nodes[key] = tree
+                for child_model, child_tree in self._iter_bulk_commit_children(key[0], tree, probes):
+                    child_key = (child_model, child_tree["mt_hash"])
+                    if child_key not in missing_nodes and child_key not in pks:
+                        next_frontier[child_key] = child_tree
+            frontier = next_frontier
+        # create the missing objects, bottom-up
+        heights = {}
+
+        def get_height(key):
+            try:
+                return heights[key]
+            except KeyError:
+                height = heights[key] = 1 + max(
+                    (get_height((child_model, child_tree["mt_hash"]))
+                     for child_model, child_tree in self._iter_bulk_commit_children(key[0], missing_nodes[key], probes)
+                     if (child_model, child_tree["mt_hash"]) in missing_nodes),
+                    default=-1
+                )
+                return height
+
+        levels = {}
+        for key, tree in missing_nodes.items():
+            levels.setdefault(get_height(key), {}).setdefault(key[0], {})[key[1]] = tree
+        created_keys = set()
+        for height in sorted(levels.keys()):
+            for model, model_trees in sorted(levels[height].items(), key=lambda t: t[0]._meta.label):
+                self._bulk_commit_level_model(model, model_trees, pks, created_keys, probes)
+        for (model, mt_hash), pk in pks.items():
+            if model in pk_cache:
+                pk_cache[model][mt_hash] = pk
+        objs = self.in_bulk([pks[(self.model, tree["mt_hash"])] for tree in trees])
+        return [(objs[pks[(self.model, tree["mt_hash"])]], (self.model, tree["mt_hash"]) in created_keys)
+                for tree in trees]
+
 
 class AbstractMTObject(models.Model):
     mt_hash = models.CharField(max_length=40, unique=True)
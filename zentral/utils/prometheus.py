@@ -21,9 +21,9 @@ class PrometheusMetricsExporter:
         description = name.replace("_", " ").capitalize()
         self.counters[name] = Counter(name, description, labels)
 
-    def inc(self, counter_name, *label_values):
+    def inc(self, counter_name, *label_values, value=1):
         try:
-            self.counters[counter_name].labels(*label_values).inc()
+            self.counters[counter_name].labels(*label_values).inc(value)
         except KeyError:
             logger.error("Missing counter %s", counter_name)
 
@@ -31,9 +31,9 @@ class StatsdMetricsExporter:
     def add_counter(self, name, labels):
         self._counters[name] = [label.replace(":", ".") for label in labels]
 
-    def inc(self, counter_name, *label_values):
+    def inc(self, counter_name, *label_values, value=1):
         counter_name = counter_name.replace(":", ".")
-        data = "{}{}:1|c".format(self._prefix, counter_name)
+        data = "{}{}:{}|c".format(self._prefix, counter_name, value)
         if label_values:
             tags = zip(self._counters.get(counter_name, []),
                        (s.replace(",", ".") for s in label_values))
@@ -1,3 +1,4 @@
+import os
 from django.core.files.storage import storages, InvalidStorageError
 
 
@@ -14,3 +15,18 @@ def select_dist_storage():
         return storages["dist"]
     except InvalidStorageError:
         return storages["default"]
+
+
+def open_storage_file_for_writing(storage, name):
+    """Open a storage file to stream its content
+
+    The S3 storage files use multipart uploads.
+    """
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        pass
+    else:
+        # local file system storage
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return storage.open(name, "wb")